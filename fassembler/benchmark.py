@@ -0,0 +1,582 @@
+"""
+Benchmarks of fassembler's own overhead (not of the builds it runs).
+
+Run it like::
+
+    python -m fassembler.benchmark -o results.json
+    python -m fassembler.benchmark --compare old-results.json
+
+Everything runs in a temporary base directory, without touching the
+network or running real builds.  The results are written as JSON;
+with ``--compare`` the times are shown next to the times in an
+earlier result file, so regressions can be spotted between versions.
+"""
+
+import gzip
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from optparse import OptionParser
+import pkg_resources
+from cmdutils.log import Logger
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from fassembler.config import ConfigParser
+from fassembler.environ import Environment
+from fassembler.filemaker import Maker
+from fassembler.namespace import Namespace, template_cache
+from fassembler.tasks import InstallSpec
+from fassembler.util import walk
+
+BUILD_INI = """\
+[general]
+base_port = 10000
+var = %(base)s/var
+etc_svn_repository = file:///dev/null
+admin_info_filename = %(base)s/var/admin.txt
+"""
+
+# Output of ``python setup.py develop`` (with easy_install pulling in
+# dependencies), for when no --install-log is given:
+INSTALL_LOG = """\
+running develop
+running egg_info
+writing requirements to opencore.egg-info/requires.txt
+writing opencore.egg-info/PKG-INFO
+writing top-level names to opencore.egg-info/top_level.txt
+writing dependency_links to opencore.egg-info/dependency_links.txt
+writing entry points to opencore.egg-info/entry_points.txt
+writing manifest file 'opencore.egg-info/SOURCES.txt'
+reading manifest template 'MANIFEST.in'
+running build_ext
+Creating /usr/local/topp/opencore/lib/python2.4/site-packages/opencore.egg-link (link to .)
+Adding opencore 0.1dev to easy-install.pth file
+
+Installed /usr/local/topp/opencore/src/opencore
+Processing dependencies for opencore==0.1dev
+Searching for simplejson>=1.7
+Reading http://dist.socialplanning.org/eggs/
+Best match: simplejson 1.9.2
+Downloading http://dist.socialplanning.org/eggs/simplejson-1.9.2.tar.gz
+Processing simplejson-1.9.2.tar.gz
+Running simplejson-1.9.2/setup.py -q bdist_egg --dist-dir /tmp/easy_install-xtW9WZ/simplejson-1.9.2/egg-dist-tmp-2fZyso
+zip_safe flag not set; analyzing archive contents...
+simplejson.tests.__init__: module references __file__
+simplejson.tests.test_recursion: module MAY be using inspect.stack
+Adding simplejson 1.9.2 to easy-install.pth file
+
+Installed /usr/local/topp/opencore/lib/python2.4/site-packages/simplejson-1.9.2-py2.4-linux-i686.egg
+Searching for PIL
+Best match: PIL 1.1.6
+Processing PIL-1.1.6.tar.gz
+libImaging/Quant.c:1023: warning: 'compute_palette_from_median_cut' defined but not used
+Extracting PIL-1.1.6-py2.4-linux-i686.egg to /usr/local/topp/opencore/lib/python2.4/site-packages
+Installing pilprint.py script to /usr/local/topp/opencore/bin
+Installing pildriver.py script to /usr/local/topp/opencore/bin
+create build/bdist.linux-i686/egg/EGG-INFO/PKG-INFO
+Finished processing dependencies for opencore==0.1dev
+"""
+
+class BenchmarkError(Exception):
+    """
+    Raised when a benchmark can't measure what it is meant to.
+    """
+
+class Benchmarks(object):
+    """
+    Each ``bench_*`` method is one benchmark; it returns
+    ``(operations, seconds)``, usually from ``self.timeit()``.
+    """
+
+    def __init__(self, files=1000, repeat=3, project_names=None, logger=None,
+                 entries=50000, install_logs=None):
+        self.files = files
+        self.entries = entries
+        self.install_logs = install_logs
+        self.repeat = repeat
+        self.project_names = project_names
+        if logger is None:
+            logger = Logger([(Logger.WARN, sys.stderr)])
+        self.logger = logger
+
+    def setup(self):
+        self.base = tempfile.mkdtemp(prefix='fassembler-bench-')
+        os.makedirs(os.path.join(self.base, 'etc'))
+        f = open(os.path.join(self.base, 'etc', 'build.ini'), 'w')
+        f.write(BUILD_INI % {'base': self.base})
+        f.close()
+        self.environ = Environment(self.base, logger=self.logger)
+        self.maker = Maker(self.base, logger=self.logger, interactive=False)
+        self.environ.maker = self.maker
+        self.config = ConfigParser()
+
+    def teardown(self):
+        shutil.rmtree(self.base)
+
+    def names(self):
+        return [name[len('bench_'):] for name in dir(self)
+                if name.startswith('bench_')]
+
+    def run(self, names=None):
+        """
+        Runs the benchmarks (all of them, or the given names), and
+        returns ``{name: result}``.
+        """
+        results = {}
+        for name in names or self.names():
+            self.setup()
+            try:
+                template_cache.clear()
+                ops, seconds = getattr(self, 'bench_' + name)()
+            finally:
+                self.teardown()
+            results[name] = {'ops': ops, 'seconds': seconds}
+            if ops:
+                results[name]['per_op'] = seconds / ops
+        return results
+
+    def timeit(self, func, ops, setup=None):
+        """
+        Calls ``func()`` (after ``setup()``, which isn't timed)
+        ``self.repeat`` times, and returns ``(ops, best time)``.
+        """
+        best = None
+        for i in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return ops, best
+
+    def project_classes(self):
+        """
+        The registered project classes (or the ones named like
+        ``module:Class`` in ``self.project_names``).
+        """
+        if self.project_names:
+            classes = []
+            for name in self.project_names:
+                module_name, class_name = name.split(':', 1)
+                __import__(module_name)
+                classes.append((name, getattr(sys.modules[module_name], class_name)))
+            return classes
+        classes = []
+        eps = list(pkg_resources.iter_entry_points('fassembler.project'))
+        if not eps:
+            self.logger.warn(
+                "fassembler's entry points aren't installed (running from a "
+                "checkout?); using the projects in fassembler/topp*.py")
+            return self.builtin_project_classes()
+        for ep in eps:
+            try:
+                classes.append((ep.name, ep.load()))
+            except Exception, e:
+                self.logger.warn('Cannot load project %s: %s' % (ep.name, e))
+        return classes
+
+    def builtin_project_classes(self):
+        """
+        The project classes defined in the ``fassembler.topp*``
+        modules, the ones ``setup.py`` registers.
+        """
+        from fassembler.project import Project
+        classes = []
+        filenames = os.listdir(os.path.dirname(__file__))
+        filenames.sort()
+        for filename in filenames:
+            if not filename.startswith('topp') or not filename.endswith('.py'):
+                continue
+            module_name = 'fassembler.' + filename[:-3]
+            try:
+                __import__(module_name)
+            except Exception, e:
+                self.logger.warn('Cannot load %s: %s' % (module_name, e))
+                continue
+            module = sys.modules[module_name]
+            for name, value in sorted(vars(module).items()):
+                if (isinstance(value, type) and issubclass(value, Project)
+                    and value.__module__ == module_name and value.name):
+                    classes.append(('%s:%s' % (module_name, name), value))
+        return classes
+
+    def make_project(self, name, ProjectClass):
+        project = ProjectClass(name, self.maker, self.environ, self.logger, self.config)
+        if not self.config.has_section(project.config_section):
+            self.config.add_section(project.config_section)
+        for setting in project.settings:
+            if (not self.config.has_option(project.config_section, setting.name)
+                and not setting.has_default(self.environ)):
+                self.config.set(project.config_section, setting.name, 'x')
+        return project
+
+    def bench_describe_projects(self):
+        """
+        Binding and describing (``make_description``) every project.
+        """
+        projects = []
+        for name, ProjectClass in self.project_classes():
+            project = self.make_project(name, ProjectClass)
+            try:
+                project.make_description()
+            except Exception, e:
+                self.logger.warn('Cannot describe project %s: %s' % (name, e))
+                continue
+            projects.append(project)
+        if not projects:
+            raise BenchmarkError('No project could be described')
+        def describe():
+            for project in projects:
+                project.make_description()
+        return self.timeit(describe, len(projects))
+
+    def bench_interpolate(self, count=2000):
+        """
+        Interpolating strings that use config settings (which are
+        themselves templates) through a `Namespace`.
+        """
+        self.config.add_section('bench')
+        self.config.set('bench', 'port', '{{env.base_port+1}}')
+        self.config.set('bench', 'url', 'http://localhost:{{config.port}}/')
+        ns = Namespace('bench')
+        ns['env'] = self.environ
+        ns['maker'] = self.maker
+        ns.add_all_sections(self.config)
+        ns['config'] = ns['bench']
+        strings = ['{{config.url}}path%s' % i for i in range(50)]
+        templates = [template_cache.get(string) for string in strings]
+        def interpolate():
+            for i in range(count // len(templates)):
+                for tmpl in templates:
+                    ns.execute_template(tmpl)
+        return self.timeit(interpolate, count)
+
+    def bench_task_interpolate(self, count=2000):
+        """
+        Interpolating strings through ``Task.interpolate``, which
+        overlays the task on the project's namespace each time, with
+        a build.ini of many sections.
+        """
+        from fassembler.project import Project, Setting
+        from fassembler.tasks import Task
+        for i in range(50):
+            self.config.add_section('other%s' % i)
+            self.config.set('other%s' % i, 'port', str(i))
+        class BenchProject(Project):
+            name = 'bench'
+            settings = [Setting('port', default='{{env.base_port+1}}')]
+        project = self.make_project('bench', BenchProject)
+        project.setup_config()
+        task = Task('bench task')
+        task.bind(maker=self.maker, environ=self.environ, logger=self.logger,
+                  config=self.config, project=project)
+        strings = ['{{config.port}}/{{task.name}}/%s' % i for i in range(50)]
+        def interpolate():
+            for i in range(count // len(strings)):
+                for string in strings:
+                    task.interpolate(string, name='bench')
+        return self.timeit(interpolate, count)
+
+    def bench_section_namespace(self, count=20000):
+        """
+        Looking up settings through a `SectionNamespace`.
+        """
+        self.config.add_section('bench')
+        self.config.set('bench', 'port', '{{env.base_port+1}}')
+        self.config.set('bench', 'plain', 'value')
+        ns = Namespace('bench')
+        ns['env'] = self.environ
+        ns['maker'] = self.maker
+        ns.add_all_sections(self.config)
+        section = ns['bench']
+        def lookup():
+            for i in range(count // 2):
+                section.port
+                section.plain
+        return self.timeit(lookup, count)
+
+    def make_tree(self, dir, files):
+        """
+        Makes a tree of ``files`` files in ``dir``, a quarter of them
+        ``_tmpl`` templates and some with ``+var+`` in their names.
+        """
+        for i in range(files):
+            subdir = os.path.join(dir, 'dir%s' % (i // 100), 'sub%s' % (i % 10))
+            if not os.path.exists(subdir):
+                os.makedirs(subdir)
+            if i % 4 == 0:
+                filename = 'file%s.txt_tmpl' % i
+                content = 'port={{config.port}}\nname={{name}}\n' * 20
+            elif i % 4 == 1:
+                filename = 'file%s-+name+.txt' % i
+                content = 'static content %s\n' % i * 40
+            else:
+                filename = 'file%s.txt' % i
+                content = 'static content %s\n' % i * 40
+            f = open(os.path.join(subdir, filename), 'wb')
+            f.write(content)
+            f.close()
+
+    def copy_dir_vars(self):
+        class Config(object):
+            port = '10001'
+        return {'config': Config(), 'name': 'bench'}
+
+    def bench_copy_dir(self):
+        """
+        ``Maker.copy_dir`` of a synthetic tree into an empty directory.
+        """
+        src = os.path.join(self.base, 'src')
+        self.make_tree(src, self.files)
+        dest = os.path.join(self.base, 'dest')
+        vars = self.copy_dir_vars()
+        def clean():
+            if os.path.exists(dest):
+                self.maker.rmtree(dest)
+        def copy():
+            self.maker.copy_dir(src, dest, template_vars=vars)
+        return self.timeit(copy, self.files, setup=clean)
+
+    def bench_copy_dir_unchanged(self):
+        """
+        ``Maker.copy_dir`` of a synthetic tree over an earlier copy.
+        """
+        src = os.path.join(self.base, 'src')
+        self.make_tree(src, self.files)
+        dest = os.path.join(self.base, 'dest')
+        vars = self.copy_dir_vars()
+        def copy():
+            self.maker.copy_dir(src, dest, template_vars=vars)
+        copy()
+        return self.timeit(copy, self.files)
+
+    def bench_ensure_file_unchanged(self):
+        """
+        ``Maker.ensure_file`` for files that already have the content.
+        """
+        content = 'some content\n' * 500
+        filenames = []
+        for i in range(self.files):
+            filename = os.path.join(self.base, 'files', 'file%s.txt' % i)
+            self.maker.ensure_file(filename, content, svn_add=False)
+            filenames.append(filename)
+        def ensure():
+            for filename in filenames:
+                self.maker.ensure_file(filename, content, svn_add=False)
+        return self.timeit(ensure, len(filenames))
+
+    def make_svn_tree(self, dir, entries):
+        """
+        Makes a tree of about ``entries`` files and directories in
+        ``dir``, shaped like an svn checkout: every directory has a
+        ``.svn`` directory with a copy of each file in it.
+        """
+        count = 0
+        i = 0
+        while count < entries:
+            subdir = os.path.join(dir, 'dir%s' % (i // 20), 'sub%s' % (i % 20))
+            os.makedirs(os.path.join(subdir, '.svn', 'text-base'))
+            for name in ['entries', 'format']:
+                open(os.path.join(subdir, '.svn', name), 'w').close()
+            for j in range(10):
+                open(os.path.join(subdir, 'file%s.txt' % j), 'w').close()
+                open(os.path.join(subdir, '.svn', 'text-base', 'file%s.txt.svn-base' % j), 'w').close()
+            count += 25
+            i += 1
+
+    def bench_walk(self):
+        """
+        Walking a tree like ``copy_dir`` does, skipping hidden
+        directories, with `fassembler.util.walk`.
+        """
+        src = os.path.join(self.base, 'src')
+        self.make_svn_tree(src, self.entries)
+        def walk_tree():
+            for dirpath, dirnames, filenames in walk(src):
+                dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+                dirnames.sort()
+                filenames.sort()
+        return self.timeit(walk_tree, self.entries)
+
+    def bench_walk_os(self):
+        """
+        Like `bench_walk`, but the way ``copy_dir`` used to walk: with
+        ``os.walk``, skipping hidden directories only after walking
+        into them.
+        """
+        src = os.path.join(self.base, 'src')
+        self.make_svn_tree(src, self.entries)
+        def walk_tree():
+            skips = []
+            for dirpath, dirnames, filenames in os.walk(src):
+                dirnames.sort()
+                filenames.sort()
+                if os.path.basename(dirpath).startswith('.'):
+                    skips.append(dirpath)
+                    continue
+                for skip in skips:
+                    if dirpath.startswith(skip):
+                        break
+        return self.timeit(walk_tree, self.entries)
+
+    def bench_run_command(self, count=100):
+        """
+        ``Maker.run_command`` of a stub script that does nothing.
+        """
+        stub = os.path.join(self.base, 'stub')
+        f = open(stub, 'w')
+        f.write('#!/bin/sh\nexit 0\n')
+        f.close()
+        os.chmod(stub, 0755)
+        def run():
+            for i in range(count):
+                self.maker.run_command(stub)
+        return self.timeit(run, count)
+
+    def read_install_logs(self):
+        """
+        The lines of ``self.install_logs`` (the output of installs,
+        like ``logs/tasks/*.log.gz``), or of `INSTALL_LOG`.
+        """
+        if not self.install_logs:
+            return INSTALL_LOG.splitlines()
+        lines = []
+        for filename in self.install_logs:
+            if filename.endswith('.gz'):
+                f = gzip.open(filename)
+            else:
+                f = open(filename)
+            try:
+                lines.extend([line.rstrip('\r\n') for line in f
+                              if not line.startswith('== ')])
+            finally:
+                f.close()
+        return lines
+
+    def bench_install_log_filter(self, count=100000):
+        """
+        The ``log_filter`` of `InstallSpec` over (recorded) output of
+        ``setup.py develop`` and ``easy_install``.
+        """
+        task = InstallSpec('bench', 'requirements.txt')
+        task.logger = self.logger
+        lines = self.read_install_logs()
+        lines = (lines * (count // len(lines) + 1))[:count]
+        def filter_lines():
+            log_filter = task.make_log_filter()
+            for line in lines:
+                log_filter(line)
+        return self.timeit(filter_lines, count)
+
+
+def format_results(results, compare=None):
+    lines = []
+    names = results.keys()
+    names.sort()
+    for name in names:
+        result = results[name]
+        line = '%-28s %10.4fs %8s ops' % (name, result['seconds'], result['ops'])
+        if result.get('per_op'):
+            line += ' %10.1fus/op' % (result['per_op'] * 1000000)
+        if compare and name in compare and compare[name]['seconds']:
+            line += '  (%.2fx of before)' % (result['seconds'] / compare[name]['seconds'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+parser = OptionParser(
+    usage='%prog [OPTIONS] [BENCHMARK...]',
+    description="Benchmark fassembler's own overhead")
+parser.add_option(
+    '-o', '--output',
+    metavar='FILE',
+    help='Write the results to FILE as JSON')
+parser.add_option(
+    '--compare',
+    metavar='FILE',
+    help='Compare with the results in FILE (from an earlier --output)')
+parser.add_option(
+    '--files',
+    metavar='N',
+    type='int',
+    default=1000,
+    help='The number of files to use in the file benchmarks (default %default)')
+parser.add_option(
+    '--entries',
+    metavar='N',
+    type='int',
+    default=50000,
+    help='The number of files and directories in the tree the walk benchmarks '
+    'walk (default %default)')
+parser.add_option(
+    '--install-log',
+    metavar='FILE',
+    dest='install_logs',
+    action='append',
+    help='Use the install output in FILE (like logs/tasks/*.log.gz) in the '
+    'install_log_filter benchmark')
+parser.add_option(
+    '--repeat',
+    metavar='N',
+    type='int',
+    default=3,
+    help='Run each benchmark N times and keep the best time (default %default)')
+parser.add_option(
+    '--project',
+    metavar='MODULE:CLASS',
+    dest='projects',
+    action='append',
+    help='Describe this project class instead of all the registered projects')
+
+def main(args=None):
+    options, args = parser.parse_args(args)
+    benchmarks = Benchmarks(files=options.files, repeat=options.repeat,
+                            project_names=options.projects,
+                            entries=options.entries,
+                            install_logs=options.install_logs)
+    for name in args:
+        if name not in benchmarks.names():
+            parser.error('No benchmark %s (there are: %s)'
+                         % (name, ', '.join(benchmarks.names())))
+    try:
+        results = benchmarks.run(args)
+    except BenchmarkError, e:
+        print >> sys.stderr, 'Error: %s' % e
+        sys.exit(1)
+    compare = None
+    if options.compare:
+        f = open(options.compare)
+        try:
+            compare = json.load(f)['results']
+        finally:
+            f.close()
+    print format_results(results, compare)
+    if options.output:
+        try:
+            version = pkg_resources.get_distribution('fassembler').version
+        except pkg_resources.DistributionNotFound:
+            version = None
+        f = open(options.output, 'w')
+        try:
+            json.dump({
+                'fassembler_version': version,
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'date': datetime.now().isoformat(),
+                'options': {'files': options.files, 'entries': options.entries,
+                            'repeat': options.repeat,
+                            'install_logs': options.install_logs},
+                'results': results,
+                }, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+if __name__ == '__main__':
+    main()
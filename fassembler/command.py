@@ -5,6 +5,7 @@ It implements the command-line API, and some of the outermost level of setup.
 """
 
 
+import atexit
 import sys
 import os
 import re
@@ -15,6 +16,12 @@ from fassembler.filemaker import Maker
 from fassembler.config import ConfigParser
 from fassembler.text import indent
 from fassembler.environ import Environment
+from fassembler.namespace import template_cache
+from fassembler.scheduler import ProjectScheduler
+from fassembler.renderdeps import RenderedFiles
+from fassembler.profiler import profiler
+from fassembler.plan import write_plan, read_plan, load_plan_config, thaw_project
+from fassembler.util import sync_files
 
 description = """\
 fassembler assembles files.
@@ -32,6 +39,10 @@ If you give 'all' for a project, then all projects listed in
 requirements/all-projects.txt will be built/updated.  If you give
 'missing' then just unbuilt projects from all-projects.txt will be
 built.
+
+Use '%prog rerender KEY...' to re-render only the generated files
+(from earlier builds) that use any of the settings KEY (like
+base_port or opencore.port), after changing those settings.
 """
 
 parser = OptionParser(
@@ -80,6 +91,90 @@ parser.add_option(
     dest='beep',
     help='Beep everytime a question is asked')
 
+parser.add_option(
+    '-j', '--jobs',
+    metavar='N',
+    dest='jobs',
+    type='int',
+    default=1,
+    help='Build up to N projects at once, in separate processes (projects are '
+    'still built after the projects they depend on); implies --no-interactive '
+    'for the project builds')
+
+parser.add_option(
+    '--task-jobs',
+    metavar='N',
+    dest='task_jobs',
+    type='int',
+    default=1,
+    help='Run up to N tasks of a project at once, in threads; only tasks that '
+    'declare their inputs and outputs are run concurrently')
+
+parser.add_option(
+    '--force-task',
+    metavar='TASK',
+    dest='force_tasks',
+    action='append',
+    default=[],
+    help='Run TASK (a task name or PROJECT.TASK; wildcards allowed) even if '
+    'it hasn\'t changed since the last build.  Use --force-task=\'*\' to '
+    'run all tasks.  May be given several times')
+
+parser.add_option(
+    '--refresh-probes',
+    action='store_true',
+    help='Run the commands that ask programs (like httpd or php) about '
+    'themselves again, instead of using the results saved by earlier builds')
+
+parser.add_option(
+    '--download-cache',
+    metavar='DIR',
+    default='~/.fassembler/cache',
+    help='Keep downloaded files (like tarballs) in DIR, to share them '
+    'between builds (default %default)')
+
+parser.add_option(
+    '--no-download-cache',
+    dest='download_cache',
+    action='store_const',
+    const=None,
+    help='Don\'t keep downloaded files')
+
+parser.add_option(
+    '--link-mode',
+    metavar='MODE',
+    dest='link_mode',
+    type='choice',
+    choices=list(Maker.link_modes),
+    default='copy',
+    help='How to copy files that are not templates: copy (the default), '
+    'hardlink (hard links to fassembler\'s own files; don\'t edit them in '
+    'place!) or reflink (copy-on-write clones, where the filesystem supports '
+    'them).  Files are copied when they cannot be linked')
+
+parser.add_option(
+    '--plan-out',
+    metavar='FILE',
+    dest='plan_out',
+    help='Don\'t build anything; write the plan for building the projects '
+    '(every task, with all its settings resolved) to FILE')
+
+parser.add_option(
+    '--plan-in',
+    metavar='FILE',
+    dest='plan_in',
+    help='Build the projects in the plan FILE written by --plan-out, without '
+    'working out the tasks and their settings again.  Don\'t give any '
+    'projects when you use this')
+
+parser.add_option(
+    '--profile',
+    metavar='FILE',
+    dest='profile',
+    help='Record how long each project and task takes (and how much of that '
+    'is spent in subprocesses, templates and file I/O); FILE is written in the '
+    'Chrome trace event format, and a summary is shown at the end')
+
 parser.add_option(
     '-H', '--project-help',
     action='store_true',
@@ -122,9 +217,12 @@ def main(options, args):
                 "You cannot use arguments with --list-projects")
         list_projects(options)
         return
-    if len(args) < 1:
+    if len(args) < 1 and not options.plan_in:
         raise CommandError(
             "You must provide at least one project")
+    if options.plan_in and options.plan_out:
+        raise CommandError(
+            "You cannot use --plan-in and --plan-out together")
     base_path = options.base_path
     if base_path and base_path.startswith('ase=') or base_path == 'ase':
         # Sign that you used -base instead of --base
@@ -165,6 +263,14 @@ def main(options, args):
         logger.notify('Building projects: %s' % ', '.join(extra_projects))
         project_names += extra_projects
     config = load_configs(options.configs)
+    plan = None
+    if options.plan_in:
+        if project_names:
+            raise CommandError(
+                "You cannot give projects with --plan-in (the plan gives them)")
+        plan = read_plan(options.plan_in, base_path)
+        load_plan_config(plan, config, options.plan_in)
+        project_names = [project_plan['name'] for project_plan in plan['projects']]
     for section, name, value in variables:
         section = section or 'DEFAULT'
         if not config.has_section(section):
@@ -176,8 +282,20 @@ def main(options, args):
     merge_config(config, environ.config, overwrite=True)
     maker = Maker(base_path, simulate=options.simulate,
                   interactive=not options.no_interactive, logger=logger,
-                  quick=options.quick, beep=options.beep)
+                  quick=options.quick, beep=options.beep,
+                  task_jobs=options.task_jobs, force_tasks=options.force_tasks,
+                  link_mode=options.link_mode,
+                  refresh_probes=options.refresh_probes,
+                  download_cache=options.download_cache)
     environ.maker = maker
+    if options.profile:
+        profiler.start(os.path.abspath(options.profile))
+        # Registered with atexit so a failed build is profiled too:
+        atexit.register(profiler.finish, logger)
+
+    if project_names and project_names[0] == 'rerender':
+        rerender(project_names[1:], maker, environ, logger, config)
+        return
     
     projects = []
     for project_name in project_names:
@@ -214,41 +332,86 @@ def main(options, args):
         ## FIXME: maybe ask if they want to see effective configuration here?
         #config.write(sys.stdout)
         raise CommandError('Errors in configuration', show_usage=False)
-    for project in projects:
-        if options.project_help:
-            description = project.make_description()
-            print description
-        else:
-            if len(projects) > 1:
-                logger.notify(' Starting project %s' % project.project_name, color='black green_bg')
-                logger.indent += 2
-            try:
+    if options.plan_out:
+        write_plan(options.plan_out, projects, config, maker, logger)
+        return
+    if plan is not None:
+        for project, project_plan in zip(projects, plan['projects']):
+            thaw_project(project, project_plan)
+    if options.jobs < 1:
+        raise CommandError('--jobs must be at least 1', show_usage=False)
+    if options.jobs > 1 and len(projects) > 1 and not options.project_help:
+        def resolve(project_name):
+            return find_project_class(project_name, logger)[1]
+        scheduler = ProjectScheduler(projects, options.jobs, maker, environ,
+                                     logger, resolve)
+        success = scheduler.run()
+    else:
+        for project in projects:
+            if options.project_help:
+                description = project.make_description()
+                print description
+            else:
+                if len(projects) > 1:
+                    logger.notify(' Starting project %s' % project.project_name, color='black green_bg')
+                    logger.indent += 2
                 try:
-                    project.run()
-                    logger.notify('Done with project %s' % project.project_name)
-                    environ.save()
-                finally:
-                    if len(projects) > 1:
-                        logger.indent -= 2
-            except CommandError:
-                raise
-            except KeyboardInterrupt:
-                raise CommandError('^C', show_usage=False)
-            except Exception, e:
-                success = False
-                continue_projects = maker.handle_exception(sys.exc_info())
-                if continue_projects:
-                    continue
-                else:
-                    break
-                ## FIXME: should revert environ here
+                    try:
+                        project.run()
+                        logger.notify('Done with project %s' % project.project_name)
+                        environ.save()
+                        maker.flush_svn_adds()
+                        sync_files()
+                    finally:
+                        maker.close_command_logs()
+                        if len(projects) > 1:
+                            logger.indent -= 2
+                except CommandError:
+                    raise
+                except KeyboardInterrupt:
+                    raise CommandError('^C', show_usage=False)
+                except Exception, e:
+                    success = False
+                    continue_projects = maker.handle_exception(sys.exc_info())
+                    if continue_projects:
+                        continue
+                    else:
+                        break
+                    ## FIXME: should revert environ here
     if not options.project_help:
         if success:
             logger.notify('Installation successful.')
         else:
             logger.notify('Installation not completely successful.')
+    logger.debug('Template cache: %s templates, %s hits, %s misses'
+                 % (len(template_cache), template_cache.hits, template_cache.misses))
     ## FIXME: commit etc/?
 
+def rerender(settings, maker, environ, logger, config):
+    """
+    Implements ``fassembler rerender KEY...``
+    """
+    if not settings:
+        raise CommandError(
+            "You must give the settings whose files should be re-rendered (like base_port)")
+    count = 0
+    for project_name in RenderedFiles.all_project_names(maker):
+        project_name, ProjectClass = find_project_class(project_name, logger)
+        if ProjectClass is None:
+            logger.warn('Could not find project %s; not re-rendering its files' % project_name)
+            continue
+        project = ProjectClass(project_name, maker, environ, logger, config)
+        try:
+            count += len(project.rerender(settings))
+        except ValueError, e:
+            raise CommandError('Error in project %s: %s' % (project_name, e), show_usage=False)
+    maker.flush_svn_adds()
+    sync_files()
+    if count:
+        logger.notify('Re-rendered %s files' % count)
+    else:
+        logger.notify('No files use %s' % ', '.join(settings))
+
 _var_re = re.compile(r'^(?:\[(\w+)\])?\s*(\w+)=(.*)$')
 _dot_var_re = re.compile(r'^(\w+)\.(\w+)=([^=>].*)$')
 
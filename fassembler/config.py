@@ -5,9 +5,25 @@ The configuration file loader (based on INITools)
 from initools import configparser
 import re
 import urllib
+from fassembler.renderdeps import record_read
 
 _url_re = re.compile(r'^https?://')
 
+# Bumped whenever any configuration changes, so that cached values
+# derived from the configuration (see SectionNamespace) can be
+# thrown away:
+_generation = [0]
+
+def config_generation():
+    """
+    Returns a number that changes whenever any ConfigParser is
+    changed (or ``config_changed()`` is called).
+    """
+    return _generation[0]
+
+def config_changed():
+    _generation[0] += 1
+
 class ConfigParser(configparser.RawConfigParser):
     global_section = True
     inherit_defaults = False
@@ -17,6 +33,34 @@ class ConfigParser(configparser.RawConfigParser):
     safe_set = True
     inline_comments = False
 
+    def get(self, section, option, raw=False, vars=None, _recursion=0):
+        record_read('%s.%s' % (section, option))
+        return configparser.RawConfigParser.get(
+            self, section, option, raw=raw, vars=vars, _recursion=_recursion)
+
+    def set(self, section, option, value, filename=None,
+            line_number=None, comments=None):
+        configparser.RawConfigParser.set(
+            self, section, option, value, filename=filename,
+            line_number=line_number, comments=comments)
+        config_changed()
+
+    def remove_option(self, section, option):
+        try:
+            return configparser.RawConfigParser.remove_option(self, section, option)
+        finally:
+            config_changed()
+
+    def add_section(self, section, comment=None):
+        configparser.RawConfigParser.add_section(self, section, comment=comment)
+        config_changed()
+
+    def remove_section(self, section):
+        try:
+            return configparser.RawConfigParser.remove_section(self, section)
+        finally:
+            config_changed()
+
     def getdefault(self, section, option, default=None):
         try:
             return self.get(section, option)
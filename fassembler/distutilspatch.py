@@ -4,6 +4,7 @@ Patch distutils files
 
 import os
 import re
+from fassembler.util import write_file
 
 def find_distutils_file(logger):
     """
@@ -82,6 +83,4 @@ def update_distutils_file(filename, section, name, value, logger, append=False):
         else:
             logger.info('Replaced setting %s' % name)
             lines[start_item_index:item_index+1] = ['%s = %s\n' % (name, value)]
-    f = open(filename, 'w')
-    f.writelines(lines)
-    f.close()
+    write_file(filename, ''.join(lines))
@@ -0,0 +1,703 @@
+"""
+Downloads files for ``Maker.retrieve`` and ``Maker.extract_tarball``,
+through a cache shared by all the builds on a host (by default in
+``~/.fassembler/cache``).  A file that isn't in the cache yet can be
+read while it is downloaded (see `Download`), so that a tarball is
+unpacked as it arrives.
+
+The cache is laid out like this:
+
+``objects/HASH-NAME/XX/HASH``
+    The downloaded files, named after the hash of their content.
+
+``urls/KEY.json``
+    For each URL (``KEY`` is the SHA-1 of the URL): the hash of the
+    content last downloaded from it, its hashes by other algorithms,
+    and the ``ETag`` and ``Last-Modified`` headers it was sent with.
+
+``partial/KEY``, ``partial/KEY.json``
+    A download that was interrupted, and the headers it was sent with;
+    it is resumed (with a ``Range`` request) the next time.
+
+``locks/KEY.lock``
+    Locked while a URL is being downloaded, so that several
+    fassembler runs never download the same URL at once.
+
+A URL may end with a fragment like ``#md5=HEX`` or ``#sha256=HEX``
+(as setuptools and pip use them).  The download is then checked
+against that hash, and a file in the cache with that hash is used
+without asking the server.  Otherwise the cached file is revalidated
+with a conditional request (``If-None-Match``/``If-Modified-Since``),
+and used if the server can't be reached (or has an error of its own, a
+5xx response).
+"""
+
+import copy
+import errno
+import os
+import shutil
+import socket
+import sys
+import tarfile
+import urllib2
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import hashlib
+except ImportError:
+    # Python 2.4
+    hashlib = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from fassembler.util import reflink, write_file
+
+if hashlib is not None:
+    CONTENT_HASH = 'sha256'
+else:
+    CONTENT_HASH = 'sha1'
+
+def new_hash(name):
+    if hashlib is not None:
+        return hashlib.new(name)
+    if name == 'md5':
+        import md5
+        return md5.new()
+    if name == 'sha1':
+        import sha
+        return sha.new()
+    raise ValueError('Hashes of type %s are not supported by this Python' % name)
+
+
+class DownloadError(IOError):
+    """
+    A download failed, or didn't have the expected hash.
+    """
+
+
+class DownloadCache(object):
+    """
+    Downloads files into the cache directory ``dir`` (see the module
+    docstring); if ``dir`` is None, files are downloaded without
+    being cached.
+    """
+
+    # How many times a download that is cut off is resumed:
+    retries = 3
+    # Seconds to wait for the server (on Python 2.6 and later):
+    timeout = 300
+    chunk_size = 64 * 1024
+
+    def __init__(self, dir, logger):
+        self.dir = dir
+        self.logger = logger
+
+    def retrieve(self, url, filename):
+        """
+        Downloads ``url`` (or gets it from the cache), and writes it
+        to ``filename``.
+        """
+        if self.dir is None:
+            url, hash_name, expected = split_hash(url)
+            self.finish(Download(self, url, hash_name, expected, part_filename=filename))
+            return
+        self.copy(self.finish(self.open(url)), filename)
+
+    def open(self, url):
+        """
+        Opens ``url`` for reading: either the file in the cache, or a
+        `Download` that is read as it is downloaded (and saved in the
+        cache while it is read).  Pass the `Download` to ``finish()``
+        once it has been read (or to ``abort()`` if reading it
+        failed).
+
+        If ``url`` has a hash, the file is downloaded and checked
+        before it is opened, so nothing that doesn't match the hash is
+        ever read.
+        """
+        url, hash_name, expected = split_hash(url)
+        if self.dir is None:
+            if expected:
+                raise ValueError(
+                    "Can't check the hash of %s without a download cache" % url)
+            return Download(self, url)
+        key = url_key(url)
+        if expected:
+            path = self.cached(key, hash_name, expected)
+            if path is not None:
+                self.logger.info('Using %s from the download cache' % url)
+                return open(path, 'rb')
+        lock = self.lock(key)
+        try:
+            # Another run may have downloaded it while we were waiting:
+            entry = self.read_json(self.url_filename(key))
+            path = response = None
+            if entry is not None and (
+                not expected or entry['hashes'].get(hash_name) == expected):
+                path = self.object_filename(entry['hashes'][CONTENT_HASH])
+                if not os.path.exists(path):
+                    path = None
+            if path is not None and not expected:
+                path, response = self.revalidate(url, entry, path)
+            if path is not None:
+                self.logger.info('Using %s from the download cache' % url)
+            elif expected:
+                path = self.finish(Download(self, url, hash_name, expected, key=key))
+            else:
+                # The Download unlocks it when it is done
+                download = Download(self, url, key=key, lock=lock, response=response)
+                lock = None
+                return download
+        finally:
+            if lock is not None:
+                self.unlock(lock)
+        return open(path, 'rb')
+
+    def finish(self, download):
+        """
+        Reads the rest of ``download`` (from ``open()``), and returns
+        the file it was saved to (see `Download.finish`).
+        """
+        if not isinstance(download, Download):
+            download.close()
+            return download.name
+        try:
+            return download.finish()
+        except:
+            exc_info = sys.exc_info()
+            download.abort()
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def abort(self, download):
+        """
+        Stops reading ``download``; if it is a `Download` (and not a
+        file in the cache), what was downloaded is kept to resume
+        later.
+        """
+        if isinstance(download, Download):
+            download.abort()
+        else:
+            download.close()
+
+    def cached(self, key, hash_name, expected):
+        """
+        The cached file with the hash ``expected``, or None.
+        """
+        if hash_name == CONTENT_HASH:
+            path = self.object_filename(expected)
+            if os.path.exists(path):
+                return path
+            return None
+        entry = self.read_json(self.url_filename(key))
+        if entry is None:
+            return None
+        path = self.object_filename(entry['hashes'][CONTENT_HASH])
+        if not os.path.exists(path):
+            return None
+        if hash_name not in entry['hashes']:
+            # The file was downloaded without this hash
+            entry['hashes'].update(hash_file(path, [hash_name]))
+            write_file(self.url_filename(key), json.dumps(entry, indent=1, sort_keys=True))
+        if entry['hashes'][hash_name] == expected:
+            return path
+        return None
+
+    def revalidate(self, url, entry, path):
+        """
+        Asks the server whether the cached file ``path`` is still
+        current.  Returns ``(path, None)`` if it is; otherwise
+        ``(None, response)``, where ``response`` is the server's
+        (open) response with the new content, or None if there was
+        nothing to revalidate with.
+        """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        if not headers:
+            return None, None
+        try:
+            response = self.open_url(url, headers)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return path, None
+            if e.code < 500:
+                raise
+            self.logger.warn('Cannot check %s (%s); using the copy in the download cache'
+                             % (url, e))
+            return path, None
+        except (urllib2.URLError, socket.error), e:
+            self.logger.warn('Cannot check %s (%s); using the copy in the download cache'
+                             % (url, e))
+            return path, None
+        if (entry.get('etag') and response.info().getheader('ETag') == entry['etag']):
+            # Servers that ignore If-None-Match
+            response.close()
+            return path, None
+        return None, response
+
+    def open_url(self, url, headers):
+        request = urllib2.Request(url, headers=headers)
+        if sys.version_info >= (2, 6):
+            return urllib2.urlopen(request, None, self.timeout)
+        return urllib2.urlopen(request)
+
+    def copy(self, path, filename):
+        """
+        Copies the cached file ``path`` to ``filename`` (as a reflink
+        if possible; never as a hard link, so that changing
+        ``filename`` can't change the cache).
+        """
+        if os.path.lexists(filename):
+            os.unlink(filename)
+        try:
+            reflink(path, filename)
+        except (OSError, IOError):
+            shutil.copyfile(path, filename)
+
+    def lock(self, key):
+        """
+        Locks the URL with the key ``key`` against other processes;
+        returns what to pass to ``unlock()``.
+        """
+        lock_filename = os.path.join(self.dir, 'locks', key + '.lock')
+        ensure_dir(os.path.dirname(lock_filename))
+        f = open(lock_filename, 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                self.logger.notify('Waiting for another process to download the file')
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    def unlock(self, f):
+        # Closing the file releases the lock
+        f.close()
+
+    def object_filename(self, content_hash):
+        return os.path.join(self.dir, 'objects', CONTENT_HASH,
+                            content_hash[:2], content_hash)
+
+    def url_filename(self, key):
+        return os.path.join(self.dir, 'urls', key + '.json')
+
+    def read_json(self, filename):
+        """
+        The JSON in ``filename``, with strings as str; None if the file
+        doesn't exist or isn't valid.
+        """
+        if not os.path.exists(filename):
+            return None
+        f = open(filename, 'rb')
+        try:
+            try:
+                data = json.load(f)
+            except ValueError:
+                self.logger.warn('Ignoring bad file in the download cache: %s' % filename)
+                return None
+        finally:
+            f.close()
+        return str_keys(data)
+
+
+class Download(object):
+    """
+    A file that is read (with ``read()``) while it is downloaded; see
+    ``DownloadCache.open``.  If the connection is cut off, the
+    download is resumed (with a ``Range`` request) without the reader
+    noticing.
+
+    What is read is saved to ``part_filename`` (by default a file in
+    the cache's ``partial/`` directory, if ``key`` is given).  If that
+    file already has the start of the download, the rest is requested
+    from the server, and the start is read from the file.
+
+    If ``response`` is given, it is the server's response to a
+    request for the whole file (one that has been made already), and
+    the download starts with it.
+    """
+
+    def __init__(self, cache, url, hash_name=None, expected=None, key=None,
+                 lock=None, part_filename=None, response=None):
+        self.cache = cache
+        self.logger = cache.logger
+        self.url = url
+        self.hash_name = hash_name
+        self.expected = expected
+        self.key = key
+        self.lock = lock
+        if part_filename is None and key is not None:
+            part_filename = os.path.join(cache.dir, 'partial', key)
+            ensure_dir(os.path.dirname(part_filename))
+        self.part_filename = part_filename
+        hash_names = [CONTENT_HASH]
+        if hash_name and hash_name not in hash_names:
+            hash_names.append(hash_name)
+        self.hashes = [(name, new_hash(name)) for name in hash_names]
+        # The bytes read so far:
+        self.offset = 0
+        self.tries = 0
+        # The ETag and Last-Modified of the download:
+        self.info = {}
+        self.response = None
+        self.length = None
+        # The start of the download, from an earlier try:
+        self.local = None
+        self.part = None
+        self.logger.notify('Downloading %s' % url)
+        try:
+            self.start(response)
+        except:
+            self.abort()
+            raise
+
+    def start(self, response=None):
+        size = 0
+        if (response is None and self.part_filename and self.key is not None
+            and os.path.exists(self.part_filename)):
+            self.info = self.cache.read_json(self.part_filename + '.json') or {}
+            size = os.path.getsize(self.part_filename)
+        if self.connect(size, response) == size and size:
+            self.logger.info('Resuming download of %s at %s bytes' % (self.url, size))
+            self.local = open(self.part_filename, 'rb')
+            mode = 'ab'
+        else:
+            mode = 'wb'
+        if self.part_filename:
+            self.part = open(self.part_filename, mode)
+            if self.key is not None:
+                write_file(self.part_filename + '.json', json.dumps(self.info))
+
+    def connect(self, offset, response=None):
+        """
+        Requests the download, starting at ``offset`` if the server
+        can do that (or uses ``response``, the response to a request
+        for the whole file); returns where the response starts
+        (``offset`` or 0).
+        """
+        headers = {}
+        validator = self.info.get('etag') or self.info.get('last_modified')
+        if response is not None:
+            self.response = response
+        else:
+            if offset and validator:
+                headers['Range'] = 'bytes=%s-' % offset
+                headers['If-Range'] = validator
+            try:
+                self.response = self.cache.open_url(self.url, headers)
+            except urllib2.HTTPError, e:
+                if e.code != 416 or not headers:
+                    raise
+                # We asked for more than there is (the file has changed)
+                self.response = self.cache.open_url(self.url, {})
+        header = self.response.info().getheader
+        if headers and self.response.code == 206 and content_range_start(self.response) == offset:
+            start = offset
+        else:
+            start = 0
+            info = {'etag': header('ETag'), 'last_modified': header('Last-Modified')}
+            if offset and self.info and (
+                (info['etag'] or info['last_modified']) != validator):
+                if self.local is None and self.offset:
+                    raise DownloadError('%s changed while it was being downloaded' % self.url)
+            self.info = info
+        length = header('Content-Length')
+        if length:
+            self.length = start + int(length)
+        else:
+            self.length = None
+        return start
+
+    def read(self, size=None):
+        if not size or size < 0:
+            size = self.cache.chunk_size
+        if self.local is not None:
+            data = self.local.read(size)
+            if data:
+                self.got(data)
+                return data
+            self.local.close()
+            self.local = None
+        while 1:
+            try:
+                data = self.response.read(size)
+            except (socket.error, IOError), e:
+                self.logger.info('Error reading %s: %s' % (self.url, e))
+                data = None
+            if data:
+                if self.part is not None:
+                    self.part.write(data)
+                self.got(data)
+                return data
+            if data == '' and (self.length is None or self.offset >= self.length):
+                return ''
+            self.reconnect()
+
+    def got(self, data):
+        for name, hash in self.hashes:
+            hash.update(data)
+        self.offset += len(data)
+        if self.offset % (1024 * 1024) < len(data):
+            self.logger.show_progress()
+
+    def reconnect(self):
+        self.tries += 1
+        if self.tries > self.cache.retries:
+            raise DownloadError('Download of %s was cut off %s times; giving up'
+                                % (self.url, self.tries))
+        self.logger.notify('Download of %s was cut off; resuming' % self.url)
+        self.response.close()
+        start = self.connect(self.offset)
+        # If the server can't resume, skip what was read already.
+        # Without an ETag or Last-Modified to tell whether the file
+        # has changed, what is skipped has to be what was read.
+        skip = self.offset - start
+        check = None
+        if skip and not (self.info.get('etag') or self.info.get('last_modified')):
+            if self.part is None:
+                raise DownloadError(
+                    "Download of %s was cut off, and can't be resumed "
+                    "since the server doesn't tell whether the file has changed"
+                    % self.url)
+            self.part.flush()
+            check = open(self.part_filename, 'rb')
+        try:
+            while skip > 0:
+                data = self.response.read(min(skip, self.cache.chunk_size))
+                if not data:
+                    raise DownloadError('Download of %s was cut off' % self.url)
+                if check is not None and check.read(len(data)) != data:
+                    raise DownloadError('%s changed while it was being downloaded' % self.url)
+                skip -= len(data)
+        finally:
+            if check is not None:
+                check.close()
+
+    def finish(self):
+        """
+        Reads the rest of the download, and checks its hash.  If it
+        is cached, it is moved into the cache, and the file in the
+        cache is returned; otherwise ``part_filename`` is returned.
+        Raises DownloadError if the hash isn't the one expected.
+        """
+        while self.read():
+            pass
+        self.close()
+        hashes = {}
+        for name, hash in self.hashes:
+            hashes[name] = hash.hexdigest()
+        if self.expected and hashes[self.hash_name] != self.expected:
+            self.discard()
+            raise DownloadError('Download of %s has %s %s, not %s'
+                                % (self.url, self.hash_name, hashes[self.hash_name],
+                                   self.expected))
+        if self.key is None:
+            return self.part_filename
+        cache = self.cache
+        path = cache.object_filename(hashes[CONTENT_HASH])
+        ensure_dir(os.path.dirname(path))
+        os.rename(self.part_filename, path)
+        self.discard()
+        url_filename = cache.url_filename(self.key)
+        ensure_dir(os.path.dirname(url_filename))
+        write_file(url_filename, json.dumps({
+            'url': self.url,
+            'hashes': hashes,
+            'etag': self.info.get('etag'),
+            'last_modified': self.info.get('last_modified'),
+            }, indent=1, sort_keys=True))
+        self.unlock()
+        return path
+
+    def abort(self):
+        """
+        Stops the download; what was downloaded is kept, to be
+        resumed next time.
+        """
+        self.close()
+        self.unlock()
+
+    def close(self):
+        for f in self.response, self.local, self.part:
+            if f is not None:
+                f.close()
+        self.response = self.local = self.part = None
+
+    def discard(self):
+        """
+        Removes what was downloaded (and the headers saved with it).
+        """
+        filenames = []
+        if self.part_filename:
+            filenames.append(self.part_filename)
+            if self.key is not None:
+                filenames.append(self.part_filename + '.json')
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def unlock(self):
+        if self.lock is not None:
+            self.cache.unlock(self.lock)
+            self.lock = None
+
+
+def url_key(url):
+    key = new_hash('sha1')
+    key.update(url)
+    return key.hexdigest()
+
+def split_hash(url):
+    """
+    Splits ``url#md5=HEX`` into ``(url, 'md5', 'HEX')``; returns
+    ``(url, None, None)`` if there is no such fragment.
+    """
+    if '#' in url:
+        base, fragment = url.split('#', 1)
+        if '=' in fragment:
+            hash_name, value = fragment.split('=', 1)
+            if hash_name in ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512'):
+                return base, hash_name, value.lower()
+    return url, None, None
+
+def tar_compression(name):
+    """
+    The compression of the tarball ``name`` (a filename or URL), for
+    ``extract_tarball``: ``'gz'``, ``'bz2'`` or ``''``.
+    """
+    name = split_hash(name)[0]
+    if name.endswith('gz'):
+        return 'gz'
+    elif name.endswith('bz2'):
+        return 'bz2'
+    elif name.endswith('tar'):
+        return ''
+    raise ValueError("Don't know how to untar file %r" % name)
+
+def extract_tarball(fileobj, dest, compression='', logger=None):
+    """
+    Unpacks the tarball read from ``fileobj`` into the directory
+    ``dest``, as it is read (the file is never seeked).  Raises
+    ValueError for members that would be written outside of ``dest``
+    (absolute paths, ``..``, or links pointing outside of ``dest``);
+    devices and FIFOs are skipped.  Like ``tar x``, files replace
+    symlinks rather than writing through them, and the modes and
+    mtimes of directories are set at the end.
+    """
+    dest = os.path.realpath(dest)
+    tar = tarfile.open(fileobj=fileobj, mode='r|' + compression)
+    try:
+        directories = []
+        for member in tar:
+            path = check_member(member, dest)
+            if member.ischr() or member.isblk() or member.isfifo():
+                if logger is not None:
+                    logger.warn('Not unpacking the device or FIFO %s' % member.name)
+                continue
+            if os.path.islink(path) or (os.path.lexists(path) and not member.isdir()
+                                        and not os.path.isdir(path)):
+                os.unlink(path)
+            if member.isdir():
+                directories.append(member)
+                # So that the files in it can be written, whatever its
+                # mode is; it is set at the end:
+                member = copy.copy(member)
+                member.mode = 0700
+            tar.extract(member, dest)
+        directories.sort(key=lambda member: member.name, reverse=True)
+        for member in directories:
+            path = os.path.join(dest, member.name)
+            tar.chown(member, path)
+            tar.utime(member, path)
+            tar.chmod(member, path)
+    finally:
+        tar.close()
+
+def check_member(member, dest):
+    """
+    Returns the path the tarball member ``member`` is unpacked to in
+    the (real) directory ``dest``; raises ValueError if that (or the
+    target of a link) is outside of ``dest``.
+    """
+    name = member.name
+    if os.path.isabs(name) or '..' in name.replace(os.path.sep, '/').split('/'):
+        raise ValueError('The tarball member %s would be unpacked outside of %s'
+                         % (name, dest))
+    path = os.path.join(dest, name)
+    # (Following any symlinks already unpacked:)
+    parent = os.path.realpath(os.path.dirname(path))
+    if not is_inside(parent, dest):
+        raise ValueError('The tarball member %s would be unpacked outside of %s (through a symlink)'
+                         % (name, dest))
+    if member.issym():
+        target = os.path.realpath(os.path.join(parent, member.linkname))
+    elif member.islnk():
+        target = os.path.realpath(os.path.join(dest, member.linkname))
+    else:
+        target = None
+    if target is not None and not is_inside(target, dest):
+        raise ValueError('The tarball member %s links to %s, outside of %s'
+                         % (name, member.linkname, dest))
+    return path
+
+def is_inside(path, dir):
+    return path == dir or path.startswith(dir.rstrip(os.path.sep) + os.path.sep)
+
+def hash_file(filename, hash_names):
+    """
+    Returns ``{hash name: hex digest}`` of the file's content.
+    """
+    hashes = [(name, new_hash(name)) for name in hash_names]
+    f = open(filename, 'rb')
+    try:
+        while 1:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            for name, hash in hashes:
+                hash.update(chunk)
+    finally:
+        f.close()
+    result = {}
+    for name, hash in hashes:
+        result[name] = hash.hexdigest()
+    return result
+
+def content_range_start(response):
+    """
+    The first byte of a 206 response, from ``Content-Range: bytes
+    START-END/LENGTH``, or None.
+    """
+    value = response.info().getheader('Content-Range') or ''
+    try:
+        return int(value.split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+def ensure_dir(dir):
+    if not os.path.exists(dir):
+        try:
+            os.makedirs(dir)
+        except OSError, e:
+            # Another process may have made it
+            if e.errno != errno.EEXIST:
+                raise
+
+def str_keys(data):
+    """
+    Turns the unicode strings ``json.load`` returns into str.
+    """
+    if isinstance(data, dict):
+        return dict([(str(key), str_keys(value)) for key, value in data.items()])
+    if isinstance(data, list):
+        return [str_keys(value) for value in data]
+    if isinstance(data, unicode):
+        return data.encode('utf8')
+    return data
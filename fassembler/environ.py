@@ -1,11 +1,18 @@
 import os
 import socket
-from fassembler.config import ConfigParser
-from fassembler.util import asbool
+from cStringIO import StringIO
+from fassembler.config import ConfigParser, config_changed
+from fassembler.util import asbool, write_file
 from initools.configparser import CanonicalFilenameSet
 import string
 import random
+import threading
 from datetime import datetime
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; locking is skipped there
+    fcntl = None
 
 secret_chars = string.ascii_letters + string.digits + '!@#$%^&*()[]|_-+=;:.,<>'
 def random_string(length=20, chars=secret_chars):
@@ -43,9 +50,17 @@ class Environment(object):
         self.base_path = os.path.abspath(base_path)
         self.logger = logger
         self._parser = None
+        # The (section, option) of each setting read from build.ini:
+        self._read_options = set()
         # Gets set later:
         self.maker = None
         self.simulated_built_projects = []
+        # Set to true when other fassembler processes may write to
+        # build.ini at the same time as this one:
+        self.concurrent = False
+        self._lock_file = None
+        self._lock_count = 0
+        self._thread_lock = threading.RLock()
 
     @property
     def hostname(self):
@@ -101,8 +116,22 @@ class Environment(object):
                 if os.path.exists(i):
                     configfiles.append(i)
             self._parser.read(configfiles)
+            self._read_options = self._options_from(self._parser, self.config_filename)
         return self._parser
 
+    def _options_from(self, parser, filename):
+        """
+        The ``(section, option)`` of the settings in ``parser`` that
+        came from the file ``filename``.
+        """
+        filenames = CanonicalFilenameSet([filename])
+        result = set()
+        for section in parser.sections():
+            for option in parser.options(section):
+                if parser.setting_location(section, option)[0] in filenames:
+                    result.add((section, option))
+        return result
+
     @property
     def localbuild(self):
         return asbool(self.config.get('general', 'localbuild'))
@@ -120,6 +149,8 @@ class Environment(object):
                         command_line_settings.append(
                             (section, option, self._parser.get(section, option)))
         self._parser = None
+        # Values interpolated from the old configuration are stale:
+        config_changed()
         if command_line_settings:
             p = self.config
             for section, option, value in command_line_settings:
@@ -153,10 +184,87 @@ class Environment(object):
         ## FIXME: this should use ensure_file or something
         ## FIXME: somehow this is clearing the config file when no changes are made
         ## (the self._parser is None check avoids this, but only incidentally)
-        self.logger.info('Writing environment config file: %s' % self.config_filename)
-        f = open(self.config_filename, 'wb')
-        self.config.write_sources(f, CanonicalFilenameSet([self.config_filename, None, '<cmdline>']))
-        f.close()
+        self.lock()
+        try:
+            if self.concurrent:
+                self._merge_saved_config()
+            self.logger.info('Writing environment config file: %s' % self.config_filename)
+            f = StringIO()
+            self.config.write_sources(f, CanonicalFilenameSet([self.config_filename, None, '<cmdline>']))
+            write_file(self.config_filename, f.getvalue())
+        finally:
+            self.unlock()
+
+    def _merge_saved_config(self):
+        """
+        Pull in what other processes saved to build.ini since we read
+        it, so that saving doesn't throw it away.  Only the settings
+        this process changed (set, or removed from build.ini) are
+        kept as they are here; everything else is taken from the file
+        as it is now.
+        """
+        saved = ConfigParser()
+        if os.path.exists(self.config_filename):
+            saved.read([self.config_filename])
+        config = self.config
+        for section in saved.sections():
+            for option in saved.options(section):
+                if config.has_option(section, option):
+                    filename = config.setting_location(section, option)[0]
+                    if filename is None or filename == '<cmdline>':
+                        # Set by this process (see refresh_config)
+                        continue
+                elif (section, option) in self._read_options:
+                    # Removed by this process
+                    continue
+                if not config.has_section(section):
+                    config.add_section(section)
+                config.set(section, option, saved.get(section, option),
+                           filename=self.config_filename)
+        filenames = CanonicalFilenameSet([self.config_filename])
+        for section, option in self._read_options:
+            if (not saved.has_option(section, option)
+                and config.has_option(section, option)
+                and config.setting_location(section, option)[0] in filenames):
+                # Removed by another process
+                config.remove_option(section, option)
+        self._read_options = self._options_from(config, self.config_filename)
+
+    @property
+    def lock_filename(self):
+        """
+        The file used to serialize writes to build.ini and
+        projects.txt between fassembler processes.
+        """
+        return os.path.join(self.base_path, '.fassembler.lock')
+
+    def lock(self):
+        """
+        Acquire the build lock, waiting for other fassembler processes
+        to release it.  Every call must be matched by ``unlock()``;
+        calls may be nested.  This also serializes threads of this
+        process.
+        """
+        self._thread_lock.acquire()
+        self._lock_count += 1
+        if self._lock_count > 1 or fcntl is None:
+            return
+        self._lock_file = open(self.lock_filename, 'a')
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+
+    def unlock(self):
+        """
+        Release the lock acquired with ``lock()``.
+        """
+        try:
+            self._lock_count -= 1
+            if self._lock_count or self._lock_file is None:
+                return
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+        finally:
+            self._thread_lock.release()
 
     random_string = staticmethod(random_string)
 
@@ -186,24 +294,26 @@ class Environment(object):
             self.simulated_built_projects.append(name)
             return
         dest = self.maker.path('etc/projects.txt')
-        if os.path.exists(dest):
-            f = open(dest, 'r')
-            lines = f.readlines()
-            f.close()
-        else:
-            lines = []
-        new_lines = []
-        for line in lines:
-            if not line.strip() or line.strip().startswith('#'):
-                new_lines.append(line)
-                continue
-            if line.split()[0] != name:
-                new_lines.append(line)
-        new_lines.append('%s %s\n' % (name, time.strftime('%Y-%m-%d %H:%M:%S')))
-        self.logger.info('Writing build info for %s to %s' % (name, dest))
-        f = open(dest, 'w')
-        f.writelines(new_lines)
-        f.close()
+        self.lock()
+        try:
+            if os.path.exists(dest):
+                f = open(dest, 'r')
+                lines = f.readlines()
+                f.close()
+            else:
+                lines = []
+            new_lines = []
+            for line in lines:
+                if not line.strip() or line.strip().startswith('#'):
+                    new_lines.append(line)
+                    continue
+                if line.split()[0] != name:
+                    new_lines.append(line)
+            new_lines.append('%s %s\n' % (name, time.strftime('%Y-%m-%d %H:%M:%S')))
+            self.logger.info('Writing build info for %s to %s' % (name, dest))
+            write_file(dest, ''.join(new_lines))
+        finally:
+            self.unlock()
         
     def is_project_built(self, name):
         """
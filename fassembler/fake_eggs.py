@@ -28,6 +28,7 @@ LIMITATIONS:
 import os
 import re
 import sys
+from fassembler.util import list_dir, write_file
 
 EGG_INFO_CONTENT = """Metadata-Version: 1.0
 Name: %s
@@ -95,7 +96,9 @@ class FakeEggsInstaller(object):
         
     def _getInstalledLibs(self, location, prefix):
         installedLibs = []
-        for lib in os.listdir(location):
+        faked = set([libInfo.name for libInfo in getattr(self, 'libsToFake', [])])
+        dirnames, filenames, links = list_dir(location)
+        for lib in dirnames:
             if lib.startswith('.'):
                 # Skip hidden dirs, eg. '.svn'
                 continue
@@ -103,8 +106,7 @@ class FakeEggsInstaller(object):
                 name = '%s.%s' % (prefix, lib)
             else:
                 name = lib
-            if (os.path.isdir(os.path.join(location, lib)) and
-                name not in [libInfo.name for libInfo in self.libsToFake]):
+            if name not in faked:
                 # Only add the package if it's not yet in the list
                 version = self._getVersion(name)
                 installedLibs.append(FakeLibInfo(name, version))
@@ -168,9 +170,8 @@ class FakeEggsInstaller(object):
             # Might as well put version info in the egg-info filename.
             name = '%s-%s.egg-info' % (libInfo.name, libInfo.version)
             fakeLibEggInfoFile = os.path.join(fakeLibDirLocation, name)
-            fd = open(fakeLibEggInfoFile, 'w')
-            fd.write(EGG_INFO_CONTENT % (libInfo.name, libInfo.version))
-            fd.close()
+            write_file(fakeLibEggInfoFile,
+                       EGG_INFO_CONTENT % (libInfo.name, libInfo.version))
 
 
     def _getZope2Version(self):
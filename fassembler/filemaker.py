@@ -6,6 +6,8 @@ Everything happens in the Maker object.
 # (c) 2005 Ian Bicking, Ben Bangert, and contributors; written for Paste (http://pythonpaste.org)
 # Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
 # This was originally based on paste.filemaker
+import errno
+import mmap
 import os
 import re
 import shutil
@@ -14,10 +16,21 @@ import subprocess
 import sys
 import tempfile
 import tempita
+import threading
 import util
 
 from difflib import unified_diff, context_diff
-from environ import random_string
+from environ import random_string, bunch
+from fassembler.renderdeps import start_recording, stop_recording, rendered
+from fassembler.namespace import _prompt_lock
+from fassembler.profiler import profiler, record_rusage, child_usage
+from fassembler.util import ordered_map, write_file, reflink, walk
+from fassembler.manifest import Manifest
+from fassembler.logfilter import PatternFilter
+from fassembler.probes import ProbeCache
+from fassembler.pathindex import PathIndex, path_dirs
+from fassembler.download import DownloadCache, extract_tarball, tar_compression
+from fassembler.runner import CommandRunner, CommandLog, FinishedFuture
 from getpass import getpass
 
 EXE_MODE = 0111
@@ -27,12 +40,16 @@ class RunCommandError(OSError):
     Represents a failed script run (a script that returns a non-zero
     exit code, and/or has output on stderr).
     """
-    def __init__(self, message, command=None, stdout=None, stderr=None, returncode=None):
+    def __init__(self, message, command=None, stdout=None, stderr=None, returncode=None,
+                 log_filename=None):
         OSError.__init__(self, message)
         self.command = command
         self.stdout = stdout
         self.stderr = stderr
         self.returncode = returncode
+        # If stdout and stderr are only the end of the output, the
+        # file the full output is in:
+        self.log_filename = log_filename
 
     def __str__(self):
         return '%s running %s (code: %s)' % (self.args[0],
@@ -54,24 +71,81 @@ class Maker(object):
     This object is generally instantiated just once per fassembler
     run, and used by all projects and tasks.
     """
+
+    # The number of threads copy_dir renders files in:
+    copy_jobs = 4
+
+    link_modes = ('copy', 'hardlink', 'reflink')
+
+    # With log_output (see run_command), how much of the end of the
+    # stdout and stderr of a command is kept in memory:
+    output_tail_size = 64 * 1024
     
     def __init__(self, base_path, logger,
                  simulate=False, 
                  interactive=True,
                  quick=False,
-                 beep=False):
+                 beep=False,
+                 task_jobs=1,
+                 force_tasks=(),
+                 link_mode='copy',
+                 refresh_probes=False,
+                 download_cache='~/.fassembler/cache'):
         """
         Initialize the Maker.  Files go under base_path.
+
+        ``task_jobs`` is the number of tasks of a project that may be
+        run at once (see ``Task.declare``).
+
+        ``force_tasks`` is a list of patterns of task names (or
+        ``project.task name``) that are run even if they haven't
+        changed since the last build (see ``fassembler.fingerprint``).
+
+        ``link_mode`` is how ``copy_file`` and ``copy_dir`` copy files
+        that aren't templates, unless they are told otherwise: one of
+        ``'copy'``, ``'hardlink'`` or ``'reflink'`` (see
+        ``copy_file``).
+
+        If ``refresh_probes`` is true, the results of ``probe()`` saved
+        by earlier runs aren't used.
+
+        ``download_cache`` is the directory ``retrieve()`` keeps
+        downloaded files in (see ``fassembler.download``), or None to
+        not keep them.
         """
+        assert link_mode in self.link_modes, "Bad link_mode: %r" % (link_mode, )
+        # {absolute path: normalized path}
+        self._normpath_cache = {}
+        # Directories that are known to exist; see ensure_dir():
+        self._existing_dirs = set()
         self.base_path = self._normpath(base_path)
         self.logger = logger
         self.simulate = simulate
         self.interactive = interactive
         self.quick = quick
         self.beep = beep
+        self.task_jobs = task_jobs
+        self.force_tasks = list(force_tasks)
+        self.link_mode = link_mode
+        self.manifest = Manifest(self)
+        self.probes = ProbeCache(self, refresh=refresh_probes)
+        self.path_index = PathIndex()
+        if download_cache:
+            download_cache = os.path.abspath(os.path.expanduser(download_cache))
+        else:
+            download_cache = None
+        self.downloads = DownloadCache(download_cache, logger)
+        self.runner = CommandRunner()
+        self._svn_adds = []
+        self._svn_adds_set = set()
+        self._svn_lock = threading.Lock()
+        # {task name: CommandLog}
+        self._command_logs = {}
+        self._command_logs_lock = threading.Lock()
     
     def copy_file(self, src, dest=None, dest_dir=None, template_vars=None,
-                  interpolater=None, overwrite=False, svn_add=True):
+                  interpolater=None, overwrite=False, svn_add=True,
+                  link_mode=None):
         """
         Copy a file from the source location to somewhere in the
         destination.
@@ -79,6 +153,15 @@ class Maker(object):
         If the file ends with _tmpl, then that suffix will be removed
         and the file will be filled as a template.  You must provide
         template_vars in this case.
+
+        Other files are copied as they are.  With a ``link_mode``
+        (by default ``self.link_mode``) of ``'hardlink'``, a new file
+        is made a hard link to the source instead, and with
+        ``'reflink'`` a copy-on-write clone of it, where the
+        filesystem supports that.  If the file can't be linked (for
+        instance because ``dest`` is on another filesystem), or
+        ``dest`` already exists, it is copied.  Note that editing a
+        hard-linked file edits the source too.
         """
         assert not dest or not dest_dir
         assert dest or dest_dir
@@ -88,27 +171,78 @@ class Maker(object):
             dest = dest[:-5]
         dest = self.path(dest)
         src = self.path(src)
+        self._write_copy(self._read_copy(src, dest, template_vars, interpolater, link_mode),
+                         svn_add=svn_add)
+
+    def _read_copy(self, src, dest, template_vars=None, interpolater=None, link_mode=None):
+        """
+        The part of ``copy_file`` that only reads: renders the file
+        and reads what is already at ``dest``.  This is called in
+        several threads at once by ``copy_dir``.  Returns the
+        information ``_write_copy`` needs.
+        """
+        if link_mode is None:
+            link_mode = self.link_mode
+        if (link_mode != 'copy' and not src.endswith('_tmpl')
+            and (not os.path.lexists(dest)
+                 or (os.path.exists(dest) and os.path.samefile(src, dest)))):
+            # Nothing to read; _write_copy links the file
+            return bunch(src=src, dest=dest, link_mode=link_mode)
+        keys = start_recording()
+        try:
+            contents, raw_contents = self._get_contents(src, template_vars, interpolater)
+        finally:
+            stop_recording(keys)
+        copy = bunch(src=src, dest=dest, contents=contents, raw_contents=raw_contents,
+                     keys=keys, existing=None, unedited=False, same_template=False,
+                     link_mode=None)
+        if os.path.exists(dest):
+            if self.manifest.has_content(dest, contents):
+                copy.existing = contents
+            else:
+                copy.existing = self._get_raw_contents(dest)
+            if copy.existing != contents:
+                copy.unedited = self.manifest.is_unchanged(dest, copy.existing)
+                if not copy.unedited:
+                    copy.same_template = self.manifest.template_is_unchanged(dest, raw_contents)
+        return copy
+
+    def _write_copy(self, copy, svn_add=True):
+        """
+        The rest of ``copy_file``: asks about conflicts, writes the
+        file and records it in the manifest.  This is always called
+        in order, in one thread.
+        """
+        if copy.link_mode is not None:
+            if self._link_file(copy.src, copy.dest, copy.link_mode, svn_add=svn_add):
+                return
+            copy = self._read_copy(copy.src, copy.dest, link_mode='copy')
+        src, dest, contents, raw_contents = copy.src, copy.dest, copy.contents, copy.raw_contents
         self._warn_filename(dest)
-        contents, raw_contents = self._get_contents(src, template_vars, interpolater)
+        if src.endswith('_tmpl'):
+            rendered(dest, copy.keys, source=src)
         overwrite = False
-        if os.path.exists(dest):
-            existing = self._get_raw_contents(dest)
-            base_content = self._get_base_contents(dest)
+        if copy.existing is not None:
+            existing = copy.existing
             if existing == contents:
                 self.logger.info('File %s exists with same content' % self.display_path(dest))
-            elif base_content and existing == base_content:
+            elif copy.unedited:
                 # logging happens in ensure_file
                 pass
             else:
                 message = 'File %s already exists (with different content)' % self.display_path(dest)
-                if os.path.exists(self._orig_filename(dest)):
-                    existing_raw = self._get_raw_contents(self._orig_filename(dest))
-                    if existing_raw == raw_contents:
-                        message = (
-                            'File %s already exists (with different substitutions, but same original template)'
-                            % self.display_path(dest))
+                if copy.same_template:
+                    message = (
+                        'File %s already exists (with different substitutions, but same original template)'
+                        % self.display_path(dest))
                 if self.interactive:
-                    response = self.ask_difference(dest, message, contents, existing)
+                    # Templates rendered in other threads may be asking
+                    # about errors (see Namespace.execute_template):
+                    _prompt_lock.acquire()
+                    try:
+                        response = self.ask_difference(dest, message, contents, existing)
+                    finally:
+                        _prompt_lock.release()
                     if not response:
                         self.logger.notify('Aborting copy')
                         return
@@ -117,22 +251,56 @@ class Maker(object):
         self.ensure_file(dest, contents, overwrite=overwrite, 
                          executable=os.stat(src).st_mode&0111, svn_add=svn_add)
         if contents != raw_contents:
-            if not self.simulate:
-                self.ensure_file(self._orig_filename(dest), raw_contents, overwrite=True,
-                                 svn_add=svn_add, quiet=True)
-                self.ensure_file(self._base_filename(dest), contents, overwrite=True,
-                                 svn_add=svn_add, quiet=True)
+            self.manifest.record(dest, raw_contents, contents)
+
+    def _link_file(self, src, dest, link_mode, svn_add=True):
+        """
+        Makes ``dest`` a hard link to ``src`` (``link_mode`` is
+        ``'hardlink'``) or a clone of it (``'reflink'``), if it doesn't
+        exist yet.  Returns false if the file has to be copied
+        instead.
+        """
+        self._warn_filename(dest)
+        if os.path.exists(dest):
+            self.logger.info('File %s is already linked to %s'
+                             % (self.display_path(dest), src))
+            return True
+        self.ensure_dir(os.path.dirname(dest), svn_add=svn_add)
+        if not self.simulate:
+            token = profiler.begin('io')
+            try:
+                try:
+                    if link_mode == 'hardlink':
+                        os.link(src, dest)
+                    else:
+                        reflink(src, dest)
+                except (OSError, IOError), e:
+                    # Typically EXDEV (another filesystem) or
+                    # EOPNOTSUPP (no reflinks)
+                    self.logger.debug('Cannot %s %s (%s); copying it'
+                                      % (link_mode, self.display_path(dest), e))
+                    return False
+            finally:
+                profiler.end(token, '%s %s' % (link_mode, dest))
+        self.logger.info('Creating %s (%s of %s)' % (dest, link_mode, src))
+        if svn_add and self.in_svn_dir(dest):
+            self.svn_add(dest)
+        return True
 
     def _orig_filename(self, filename):
         """
-        Gives the filename used to save the template used to generate a 'real' file.
+        Gives the filename that was used to save the template used to
+        generate a 'real' file (before there was a manifest; see
+        `fassembler.manifest`).
         """
         return os.path.join(os.path.dirname(filename),
                             '.'+os.path.basename(filename)+'.orig')
 
     def _base_filename(self, filename):
         """
-        Gives the filename used to save the text of a file (not the template, the filled in text).
+        Gives the filename that was used to save the text of a file
+        (not the template, the filled in text), before there was a
+        manifest.
         """
         return os.path.join(os.path.dirname(filename),
                             '.'+os.path.basename(filename)+'.base')
@@ -168,17 +336,13 @@ class Maker(object):
         """
         Return the contents of a file.
         """
+        token = profiler.begin('io')
         f = open(filename, 'rb')
         try:
             return f.read()
         finally:
             f.close()
-
-    def _get_base_contents(self, filename):
-        new_filename = self._base_filename(filename)
-        if not os.path.exists(new_filename):
-            return None
-        return self._get_raw_contents(new_filename)
+            profiler.end(token, 'read %s' % filename)
 
     def _writefile(self, filename, contents):
         """
@@ -186,9 +350,9 @@ class Maker(object):
         """
         self.logger.debug('Writing %i bytes to %s' %
                           (len(contents), filename))
-        f = open(filename, 'wb')
-        f.write(contents)
-        f.close()
+        token = profiler.begin('io')
+        write_file(filename, contents)
+        profiler.end(token, 'write %s' % filename)
 
     def fill(self, contents, template_vars, filename=None):
         """
@@ -228,12 +392,19 @@ class Maker(object):
         """
         A more thorough normalization of a path than just what ``os.path.normpath`` does.
         """
+        try:
+            return self._normpath_cache[path]
+        except KeyError:
+            pass
         assert isinstance(path, basestring), "Bad path: %r" % (path, )
-        path = os.path.expanduser(path)
-        return os.path.normcase(os.path.abspath(path))
+        normalized = os.path.normcase(os.path.abspath(os.path.expanduser(path)))
+        if os.path.isabs(path):
+            # (What a relative path means depends on the current directory)
+            self._normpath_cache[path] = normalized
+        return normalized
     
     def copy_dir(self, src, dest, sub_filenames=True, template_vars=None, interpolater=None, include_hidden=False,
-                 add_dest_to_svn=False):
+                 add_dest_to_svn=False, link_mode=None):
         """
         Copy a directory recursively (from ``src`` to ``dest``),
         processing any files within it that need to be processed (end
@@ -252,33 +423,33 @@ class Maker(object):
         If ``add_dest_to_svn`` is true, then if ``dest`` is contained
         in an svn-controlled directory it will be added to that
         directory.
+
+        Files that aren't templates are linked instead of copied
+        according to ``link_mode`` (see ``copy_file``).
+
+        Directories are created first; then the files are rendered in
+        up to ``self.copy_jobs`` threads, and written in order.
         """
         if template_vars is None:
             sub_filenames = False
-        skips = []
+        copies = []
         dest = self.path(dest)
         self.ensure_dir(dest, svn_add=add_dest_to_svn)
-        for dirpath, dirnames, filenames in os.walk(src):
+        if not include_hidden and self.is_hidden(src):
+            return
+        for dirpath, dirnames, filenames in walk(src):
             ## FIXME: this doesn't indent or handle recursion as
             ## cleaning as a trully recursive version would.
+            if not include_hidden:
+                # (Removing them from dirnames keeps walk() out of them)
+                for dirname in [name for name in dirnames if self.is_hidden(name)]:
+                    self.logger.debug('Skipping hidden directory %s' % dirname)
+                    dirnames.remove(dirname)
             dirnames.sort()
             filenames.sort()
-            if not include_hidden and self.is_hidden(dirpath):
-                skips.append(dirpath)
-                continue
-            parent_hidden = False
-            for skip in skips:
-                if dirpath.startswith(skip):
-                    parent_hidden = True
-                    break
-            if parent_hidden:
-                continue
             assert dirpath.startswith(src)
             dirpath = dirpath[len(src):].lstrip(os.path.sep)
             for dirname in dirnames:
-                if not include_hidden and self.is_hidden(dirname):
-                    self.logger.debug('Skipping hidden directory %s' % dirname)
-                    continue
                 destdir = self.path(os.path.join(dest, dirpath, dirname))
                 if sub_filenames:
                     orig_destdir = destdir
@@ -296,7 +467,17 @@ class Maker(object):
                     destfn = self.fill_filename(destfn, template_vars)
                     if orig_destfn != destfn:
                         self.logger.debug('Filling name %s to %s' % (orig_destfn, destfn))
-                self.copy_file(os.path.join(src, dirpath, filename), destfn, template_vars=template_vars, interpolater=interpolater)
+                if destfn.endswith('_tmpl'):
+                    destfn = destfn[:-5]
+                copies.append((self.path(os.path.join(src, dirpath, filename)), destfn))
+        # The files are rendered and compared in threads; the results
+        # are written (and any questions asked) in order, here:
+        profile_task = profiler.get_task()
+        def read_copy(item):
+            srcfn, destfn = item
+            profiler.set_task(profile_task)
+            return self._read_copy(srcfn, destfn, template_vars, interpolater, link_mode)
+        ordered_map(read_copy, copies, self.copy_jobs, self._write_copy)
 
     def is_hidden(self, filename):
         return os.path.basename(filename).startswith('.')
@@ -314,16 +495,16 @@ class Maker(object):
         the first for hidden files that you want to actually copy, the
         second for putting ``+`` in a filename.
         """
-        vars = template_vars.copy()
-        vars.setdefault('dot', '.')
-        vars.setdefault('plus', '+')
+        defaults = {'dot': '.', 'plus': '+'}
         def subber(match):
             name = match.group(1)
-            if name not in vars:
+            if name in template_vars:
+                return template_vars[name]
+            if name not in defaults:
                 raise NameError(
                     "Variable +%s+ not in variables, in filename %s"
                     % (name, filename))
-            return vars[name]
+            return defaults[name]
         return self._filename_var_re.sub(subber, filename)
 
     def exists(self, path):
@@ -345,8 +526,7 @@ class Maker(object):
             __init__.py file.
         
         """
-        dir = self.path(dir)
-        dir = os.path.abspath(dir.rstrip(os.sep))
+        dir = self.path(dir).rstrip(os.sep)
         if not dir:
             # we either reached the parent-most directory, or we got
             # a relative directory
@@ -354,25 +534,49 @@ class Maker(object):
             # first?  Though presumably the current directory always
             # exists.
             return
+        if dir in self._existing_dirs:
+            return
         if not os.path.exists(dir):
             self.ensure_dir(os.path.dirname(dir), svn_add=svn_add, package=package)
             self.logger.notify('Creating %s' % self.display_path(dir))
             if not self.simulate:
-                os.mkdir(dir)
-            if (svn_add and
-                os.path.exists(os.path.join(os.path.dirname(dir), '.svn'))):
-                self.svn_command('add', dir)
+                try:
+                    os.mkdir(dir)
+                except OSError, e:
+                    # Another task running at the same time may have
+                    # just created it:
+                    if e.errno != errno.EEXIST:
+                        raise
+                self._existing_dirs.add(dir)
+            if svn_add and self.in_svn_dir(dir):
+                self.svn_add(dir)
             if package:
                 initfile = os.path.join(dir, '__init__.py')
-                f = open(initfile, 'wb')
-                f.write("#\n")
-                f.close()
+                write_file(initfile, "#\n")
                 self.logger.notify('Creating %s' % self.display_path(initfile))
-                if (svn_add and
-                    os.path.exists(os.path.join(os.path.dirname(dir), '.svn'))):
-                    self.svn_command('add', initfile)
+                if svn_add and self.in_svn_dir(initfile):
+                    self.svn_add(initfile)
         else:
             self.logger.debug("Directory already exists: %s" % self.display_path(dir))
+            self._existing_dirs.add(dir)
+
+    def forget_dirs(self, path=None):
+        """
+        Forget that ``path`` and the directories in it exist (or all
+        directories, if ``path`` is None), after deleting them.
+        ``ensure_dir`` doesn't check again that the directories it has
+        seen or created exist; this is called when Maker deletes
+        something, after running a command, and at the end of every
+        task (as the task may have deleted anything).
+        """
+        if path is None:
+            self._existing_dirs.clear()
+            return
+        path = self._normpath(path).rstrip(os.sep)
+        prefix = path + os.sep
+        for dir in list(self._existing_dirs):
+            if dir == path or dir.startswith(prefix):
+                self._existing_dirs.discard(dir)
 
     def ensure_file(self, filename, content, svn_add=True, package=False,
                     overwrite=False, executable=False, quiet=False):
@@ -387,26 +591,31 @@ class Maker(object):
             if not quiet:
                 self.logger.info('Creating %s' % filename)
             if not self.simulate:
-                f = open(filename, 'wb')
-                f.write(content)
-                f.close()
+                token = profiler.begin('io')
+                write_file(filename, content)
+                profiler.end(token, 'write %s' % filename)
+                self.manifest.update(filename, content)
             if executable:
                 self.make_executable(filename)
-            if svn_add and os.path.exists(os.path.join(os.path.dirname(filename), '.svn')):
-                self.svn_command('add', filename)
+            if svn_add and self.in_svn_dir(filename):
+                self.svn_add(filename)
             return
-        f = open(filename, 'rb')
-        old_content = f.read()
-        f.close()
-        base_content = self._get_base_contents(filename)
-        if content == old_content:
+        # The manifest knows the file's size and mtime from when it was
+        # written, so an unchanged file usually doesn't have to be read:
+        same_content = self.manifest.has_content(filename, content)
+        if not same_content:
+            same_content = self._file_has_content(filename, content)
+            if same_content and not self.simulate:
+                self.manifest.update(filename, content)
+        if same_content:
             if not quiet:
                 self.logger.info('File %s matches expected content' % filename)
             if executable and not os.stat(filename).st_mode&0111:
                 self.make_executable(filename)
             return
+        old_content = self._get_raw_contents(filename)
         show_overwrite_warning = True
-        if base_content and base_content == old_content:
+        if self.manifest.is_unchanged(filename, old_content):
             if not quiet:
                 self.logger.notify('File %s was not edited and content has changed, overwriting'
                                    % self.display_path(filename),
@@ -426,11 +635,40 @@ class Maker(object):
             if not quiet:
                 self.logger.notify('Overwriting %s with new content' % filename)
         if not self.simulate:
-            f = open(filename, 'wb')
-            f.write(content)
-            f.close()
+            token = profiler.begin('io')
+            write_file(filename, content)
+            profiler.end(token, 'write %s' % filename)
             if executable:
                 self.make_executable(filename)
+            self.manifest.update(filename, content)
+
+    # Files bigger than this are compared with mmap, a chunk at a time:
+    mmap_compare_size = 1024*1024
+
+    def _file_has_content(self, filename, content):
+        """
+        True if the file has exactly the given content.
+        """
+        size = os.path.getsize(filename)
+        if size != len(content):
+            return False
+        if size < self.mmap_compare_size:
+            return self._get_raw_contents(filename) == content
+        token = profiler.begin('io')
+        f = open(filename, 'rb')
+        try:
+            m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                chunk = 1024*1024
+                for pos in xrange(0, size, chunk):
+                    if m[pos:pos+chunk] != content[pos:pos+chunk]:
+                        return False
+                return True
+            finally:
+                m.close()
+        finally:
+            f.close()
+            profiler.end(token, 'compare %s' % filename)
 
     def make_executable(self, filename):
         """
@@ -444,6 +682,53 @@ class Maker(object):
 
     _svn_failed = False
 
+    # The most paths given to one ``svn add``:
+    svn_add_batch = 200
+
+    def in_svn_dir(self, path):
+        """
+        True if ``path`` is in an svn checkout (or in a directory that
+        is about to be added to svn), so that it should be added to
+        svn when it is created.
+        """
+        dir = os.path.dirname(path)
+        return dir in self._svn_adds_set or os.path.exists(os.path.join(dir, '.svn'))
+
+    def svn_add(self, path):
+        """
+        Adds ``path`` to svn.  This is only queued; the queued paths
+        are added all at once by ``flush_svn_adds()``, which is called
+        at the end of every task.
+        """
+        self._svn_lock.acquire()
+        try:
+            if path not in self._svn_adds_set:
+                self._svn_adds.append(path)
+                self._svn_adds_set.add(path)
+        finally:
+            self._svn_lock.release()
+
+    def flush_svn_adds(self):
+        """
+        Runs ``svn add`` for the paths queued by ``svn_add()``.  Like
+        ``svn_command``, this doesn't raise an exception if svn fails.
+        """
+        self._svn_lock.acquire()
+        try:
+            paths = [path for path in self._svn_adds if os.path.lexists(path)]
+            self._svn_adds = []
+            self._svn_adds_set = set()
+        finally:
+            self._svn_lock.release()
+        if not paths:
+            return
+        self.logger.info('Adding %s files to svn' % len(paths))
+        for i in range(0, len(paths), self.svn_add_batch):
+            # --depth empty: directories were added when they were
+            # still empty; --force: some paths may be in svn already
+            self.svn_command('add', '--parents', '--depth', 'empty', '--force',
+                             *paths[i:i+self.svn_add_batch])
+
     def svn_command(self, *args, **kw):
         """
         Run an svn command, but don't raise an exception if it fails.
@@ -472,6 +757,7 @@ class Maker(object):
             self.logger.info('Removing broken link %s' % dest)
             if not self.simulate:
                 os.unlink(dest)
+                self.forget_dirs(dest)
         if os.path.exists(dest) and overwrite:
             if os.path.islink(dest):
                 # It's a symlink, and we should overwrite it
@@ -479,6 +765,7 @@ class Maker(object):
                                    % (dest, os.path.realpath(dest)))
                 if not self.simulate:
                     os.unlink(dest)
+                    self.forget_dirs(dest)
             else:
                 self.logger.warn('Cannot remove symlink destination %s because it is not a symlink'
                                  % dest)
@@ -518,6 +805,7 @@ class Maker(object):
             else:
                 self.logger.notify('Removing dir/file at %s' % dest)
                 shutil.rmtree(dest)
+            self.forget_dirs(dest)
         else:
             assert 0
         self.logger.info('Symlinking %s to %s' % (source, dest))
@@ -534,6 +822,7 @@ class Maker(object):
         self.logger.debug('Deleting recursively: %s' % filename)
         if not self.simulate:
             shutil.rmtree(filename)
+            self.forget_dirs(filename)
 
     def run_command(self, cmd, *args, **kw):
         """
@@ -579,15 +868,40 @@ class Maker(object):
 
         ``log_filter``:
             This is a function that takes a line of output from the
-            program, and returns either a log level alone, or
-            (new_line, level).  If not provided, then the output of
-            the process will not be displayed.  You may also give an
-            integer which will be the level of all output (e.g.,
-            logger.INFO).
+            program (stdout or stderr), and returns either a log level
+            alone, or (new_line, level).  If not provided, then the
+            output of the process will not be displayed.  You may also
+            give an integer which will be the level of all output
+            (e.g., logger.INFO).
+
+        ``log_prefix``:
+            Put ``[log_prefix]`` in front of the lines ``log_filter``
+            logs, to tell apart the output of commands running at the
+            same time (see ``start_command``).
+
+        ``log_output``:
+            If true (the default if ``log_filter`` is given), the
+            full output is written to the log of the current task
+            (see ``command_log``), and only the last
+            ``output_tail_size`` bytes of stdout and of stderr are kept
+            in memory, and returned.
 
         ``shell``:
             Run the command string in a child shell. Default False.
         """
+        return self.start_command(cmd, *args, **kw).result()
+
+    def start_command(self, cmd, *args, **kw):
+        """
+        Starts running a command like ``run_command`` (with the same
+        arguments), and returns a `fassembler.runner.CommandFuture`
+        right away.  Its ``result()`` method waits for the command to
+        finish, and returns (or raises) what ``run_command`` would.
+
+        Any number of commands can be run at once like this.  Their
+        output is read (and logged through ``log_filter``) while
+        ``result()`` is waiting for any of them.
+        """
         cwd = popdefault(kw, 'cwd', self.base_path) or self.base_path
         cwd = self.path(cwd)
         if not os.path.exists(cwd):
@@ -603,6 +917,8 @@ class Maker(object):
         simulate = popdefault(kw, 'simulate', self.simulate)
         stdin = popdefault(kw, 'stdin', None)
         log_filter = popdefault(kw, 'log_filter', None)
+        log_prefix = popdefault(kw, 'log_prefix', None)
+        log_output = popdefault(kw, 'log_output', bool(log_filter))
         use_shell = popdefault(kw, 'shell', False)
         if extra_path:
             env = env.copy()
@@ -611,7 +927,7 @@ class Maker(object):
         if script_abspath:
             cmd = self._script_abspath(cmd, script_abspath)
         assert not kw, ("Arguments not expected: %s" % kw)
-        if capture_stderr or log_filter:
+        if capture_stderr:
             stderr_pipe = subprocess.STDOUT
         else:
             stderr_pipe = subprocess.PIPE
@@ -621,21 +937,34 @@ class Maker(object):
             stdin_argument = subprocess.PIPE
         else:
             stdin_argument = None
+        executable = None
+        if not use_shell:
+            if isinstance(cmd, basestring):
+                program = cmd
+            else:
+                program = cmd[0]
+            if os.path.sep not in program:
+                # Otherwise Popen tries every directory on $PATH (if
+                # this finds nothing, it still does):
+                executable = self.find_executable([program], path=env.get('PATH'), cwd=cwd)
         try:
             proc = subprocess.Popen(cmd,
+                                    executable=executable,
                                     cwd=cwd,
                                     env=env,
                                     stdin=stdin_argument,
                                     stderr=stderr_pipe,
                                     stdout=subprocess.PIPE,
-                                    shell=use_shell)
+                                    shell=use_shell,
+                                    # (See CommandRunner.add)
+                                    close_fds=True)
         except OSError, e:
             if e.errno != 2:
                 # File not found
                 raise
             raise OSError(
-                "The expected executable %s was not found (%s)"
-                % (cmd, e))
+                "The expected executable %s was not found (%s; $PATH is %s)"
+                % (cmd, e, env.get('PATH')))
         self.logger.info('Running %s (PID %s)' % (self._format_command(cmd),
                                                   proc.pid))
         if env != os.environ:
@@ -644,19 +973,26 @@ class Maker(object):
             self.logger.debug('Running in working directory %s' % self.display_path(cwd))
         if simulate:
             if return_full:
-                return (None, None, 0)
+                return FinishedFuture((None, None, 0), proc.pid)
             else:
-                return None
-        if stdin:
-            proc.stdin.write(stdin)
-        if log_filter:
-            stdout = []
-            stdout_pipe = proc.stdout
-            while 1:
-                line = stdout_pipe.readline()
-                if not line:
-                    break
-                stdout.append(line)
+                return FinishedFuture(None, proc.pid)
+        token = profiler.begin('subprocess')
+        if token is not None:
+            record_rusage(proc)
+        command_log = None
+        output_limit = None
+        if log_output:
+            command_log = self.command_log()
+            output_limit = self.output_tail_size
+            command_log.write('== Running %s (PID %s) in %s\n'
+                              % (self._format_command(cmd), proc.pid, cwd))
+        on_line = None
+        if log_filter or command_log is not None:
+            def on_line(stream, line):
+                if command_log is not None:
+                    command_log.write(line + '\n')
+                if not log_filter:
+                    return
                 line = line.rstrip()
                 if isinstance(log_filter, int):
                     level = log_filter
@@ -665,21 +1001,47 @@ class Maker(object):
                 if isinstance(level, tuple):
                     line, level = level
                 if line:
+                    if log_prefix:
+                        line = '[%s] %s' % (log_prefix, line)
                     self.logger.log(level, line)
                 if not self.logger.stdout_level_matches(level):
                     self.logger.show_progress()
-            stdout = ''.join(stdout)
-            stderr = ''
-            # Bug #2128: The return code isn't set just by reading stdout;
-            # you have to call wait() or communicate().
-            proc.wait()
-        else:
-            stdout, stderr = proc.communicate()
-        if proc.returncode and not expect_returncode:
+        def on_exit(future):
+            if command_log is not None:
+                command_log.write('== Exit code %s (PID %s)\n' % (future.returncode, proc.pid))
+            profiler.end(token, self._format_command(cmd), **child_usage(proc))
+            # The command may have deleted directories, or installed
+            # programs:
+            self.forget_dirs()
+            self.path_index.forget()
+        def on_result(future):
+            future.check_error()
+            return self._command_result(cmd, future, expect_returncode=expect_returncode,
+                                        log_error=log_error, return_full=return_full,
+                                        command_log=command_log)
+        return self.runner.add(proc, stdin=stdin, on_line=on_line, on_exit=on_exit,
+                               on_result=on_result, output_limit=output_limit)
+
+    def _command_result(self, cmd, future, expect_returncode=False, log_error=True,
+                        return_full=False, command_log=None):
+        """
+        What ``run_command`` returns for a finished command; raises
+        RunCommandError if it failed.
+        """
+        stdout, stderr = future.stdout, future.stderr
+        if future.returncode and not expect_returncode:
+            log_filename = None
+            if command_log is not None and future.truncated:
+                log_filename = command_log.filename
+                # So that the full output can be read right away:
+                command_log.close()
             if log_error:
                 self.logger.log(slice(self.logger.WARN, self.logger.FATAL),
                                 'Running %s' % self._format_command(cmd), color='bold red')
-                self.logger.warn('Error (exit code: %s)' % proc.returncode, color='bold red')
+                self.logger.warn('Error (exit code: %s)' % future.returncode, color='bold red')
+                if log_filename:
+                    self.logger.warn('Only the end of the output is shown; the full output is in %s'
+                                     % self.display_path(log_filename))
                 if stdout:
                     self.logger.warn('stdout:')
                     self.logger.indent += 2
@@ -695,18 +1057,76 @@ class Maker(object):
                     finally:
                         self.logger.indent -= 2
             raise RunCommandError("Error executing command %s (code %s)" %
-                                  (self._format_command(cmd), proc.returncode),
+                                  (self._format_command(cmd), future.returncode),
                                   command=cmd, stdout=stdout, stderr=stderr,
-                                  returncode=proc.returncode)
+                                  returncode=future.returncode,
+                                  log_filename=log_filename)
         if stderr:
             self.logger.debug('Command error output:\n%s' % stderr)
         if stdout:
             self.logger.debug('Command output:\n%s' % stdout)
         if return_full:
-            return (stdout, stderr, proc.returncode)
+            return (stdout, stderr, future.returncode)
         else:
             return stdout
 
+    def find_executable(self, names, path=None, extra_dirs=(), cwd=None):
+        """
+        The full path of the first of the programs ``names`` that is
+        found in the directories of ``path`` (by default ``$PATH``) or
+        ``extra_dirs``, or None.  Relative directories are relative to
+        ``cwd`` (by default the current directory).
+        """
+        return self.path_index.find(names, path_dirs(path, extra_dirs, cwd))
+
+    def probe(self, cmd, *args):
+        """
+        Runs a command that reports on a program itself (like
+        ``httpd -v``) and returns ``(stdout, stderr, returncode)``.
+        The result is cached, in this run and on disk, until the
+        program ``cmd`` (found on ``$PATH`` if it isn't a path) is
+        changed; see `fassembler.probes`.  Probes are run even when
+        simulating.
+        """
+        return self.probes.probe(cmd, *args)
+
+    def command_log(self, task=None):
+        """
+        The `fassembler.runner.CommandLog` that the output of commands
+        run for ``task`` (by default the current task; see
+        ``Profiler.get_task``) is written to:
+        ``logs/tasks/PROJECT.TASK.log.gz``.  It is overwritten by the
+        first command of the task in a run.
+        """
+        if task is None:
+            task = profiler.get_task() or 'commands'
+        self._command_logs_lock.acquire()
+        try:
+            log = self._command_logs.get(task)
+            if log is None:
+                name = re.sub(r'[^a-zA-Z0-9_.-]+', '-', task)
+                log = self._command_logs[task] = CommandLog(
+                    self.path('logs/tasks/%s.log.gz' % name))
+            return log
+        finally:
+            self._command_logs_lock.release()
+
+    def close_command_logs(self, task=None):
+        """
+        Closes the log of ``task`` (or all the logs); it is appended
+        to if more commands are run for the task.
+        """
+        self._command_logs_lock.acquire()
+        try:
+            if task is None:
+                logs = self._command_logs.values()
+            else:
+                logs = [log for log in [self._command_logs.get(task)] if log is not None]
+        finally:
+            self._command_logs_lock.release()
+        for log in logs:
+            log.close()
+
     def _script_abspath(self, cmd, abspath):
         """
         Rewrite the command to use the given abspath
@@ -813,12 +1233,19 @@ class Maker(object):
             self.run_command(cmd, log_filter=self._filter_svn)
             self.logger.notify('Checked out repository to %s' % dest)
 
+    # What svn checkout prints for each file (like ``A    path``):
+    _svn_file_re = re.compile(r'^[ADUCGER ]{1,4}\s+\S')
+    _svn_filter = None
+
     def _filter_svn(self, line):
         """
-        Filters svn output
+        Filters svn output: the files that are checked out are only
+        logged when debugging, the rest as info.
         """
-        if line: pass
-        # @@
+        if self._svn_filter is None:
+            self._svn_filter = PatternFilter([(self.logger.DEBUG, [self._svn_file_re])],
+                                             default=self.logger.INFO)
+        return self._svn_filter.level(line)
 
     _repo_url_re = re.compile(r'^URL:\s+(.*)$', re.MULTILINE)
 
@@ -1168,11 +1595,49 @@ Responses:
                 assert 0
 
     def retrieve(self, url, filename):
-        """Download a file and store it at filename.
-        Depends on wget because urllib isn't reliable enough with large files
-        and real networks.
         """
-        self.run_command(['wget', '--no-check-certificate', url, '-O', filename])
+        Download a file and store it at filename.  Files are kept in
+        the download cache, and interrupted downloads are resumed; if
+        ``url`` ends with ``#md5=HEX`` (or ``#sha256=HEX``, etc.), the
+        file is checked against that hash.  See
+        `fassembler.download`.
+        """
+        token = profiler.begin('io')
+        try:
+            self.downloads.retrieve(url, filename)
+        finally:
+            profiler.end(token, 'retrieve %s' % url)
+
+    def extract_tarball(self, source, dest):
+        """
+        Unpacks the tarball ``source`` into the directory ``dest``.
+        ``source`` may be a filename or a URL; a URL is unpacked while
+        it is downloaded (and put in the download cache, like with
+        ``retrieve()``), so it isn't written anywhere else.  The
+        compression is guessed from the name (``.gz``, ``.bz2`` or
+        ``.tar``).  Members that would be written outside of ``dest``
+        are refused (with ValueError).
+        """
+        compression = tar_compression(source)
+        dest = self.path(dest)
+        self.logger.info('Unpacking %s into %s' % (source, self.display_path(dest)))
+        token = profiler.begin('io')
+        try:
+            if '://' in source:
+                f = self.downloads.open(source)
+            else:
+                f = open(source, 'rb')
+            try:
+                extract_tarball(f, dest, compression, logger=self.logger)
+            except:
+                exc_info = sys.exc_info()
+                self.downloads.abort(f)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self.downloads.finish(f)
+        finally:
+            profiler.end(token, 'extract %s' % source)
+            # (Directories may have been replaced by files)
+            self.forget_dirs(dest)
 
     def backup(self, filename):
         """
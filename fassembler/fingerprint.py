@@ -0,0 +1,351 @@
+"""
+Fingerprints of tasks, so that a re-run of a project can skip the
+tasks that have not changed since they last ran successfully.
+
+Only tasks with ``incremental = True`` are ever skipped.  A task's
+fingerprint covers:
+
+* its class,
+* its resolved ``interpolated`` attributes and other simple
+  attributes,
+* the contents of any existing files those attributes refer to
+  (and whether the paths they refer to exist at all),
+* its declared inputs and outputs (see ``Task.declare``), including
+  the values of ``config:`` and ``prop:`` inputs and the contents of
+  input directories,
+* anything the task adds with ``Task.fingerprint_data()``,
+* the fingerprints of the tasks it depends on (see
+  `fassembler.scheduler.find_task_dependencies`).
+
+The last point means that when a task is run again, so is everything
+that comes after it (tasks that declare nothing depend on all the
+tasks before them).  A task that isn't incremental always runs, and
+may change anything (an ``svn up``, say), so it has no fingerprint,
+and the tasks that depend on it are never skipped.
+
+The fingerprints are kept in ``var/fassembler/fingerprints-PROJECT.txt``
+in the base directory.
+"""
+
+import fnmatch
+import os
+import re
+import threading
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+from fassembler.scheduler import resolve_resources
+from fassembler.tasks import interpolated_names
+from fassembler.util import write_file
+
+def task_keys(tasks):
+    """
+    A key for each of the (bound) tasks of a project, from its position
+    in the source.  Tasks that share a position (like the copies
+    ``ForEach`` makes) are numbered.
+    """
+    keys = []
+    counts = {}
+    for task in tasks:
+        key = '%s %s' % (task.__class__.__name__, task.position or task.name)
+        counts[key] = counts.get(key, 0) + 1
+        if counts[key] > 1:
+            key += ' #%s' % counts[key]
+        keys.append(key)
+    return keys
+
+class TaskFingerprints(object):
+    """
+    The fingerprints of the (bound) tasks of one run of a project.
+    ``dependencies`` is as returned by ``find_task_dependencies``.
+    """
+
+    # Attributes that bind the task to the run, not part of what it does:
+    unfingerprinted_attributes = [
+        'maker', 'environ', 'logger', 'config', 'project', 'config_section',
+        'position']
+
+    def __init__(self, project, tasks, dependencies):
+        self.project = project
+        self.tasks = tasks
+        self.dependencies = dependencies
+        self.maker = project.maker
+        self.logger = project.logger
+        self.indexes = {}
+        for index, task in enumerate(tasks):
+            self.indexes[id(task)] = index
+        self.keys = task_keys(tasks)
+        self.current = {}
+        self._lock = threading.Lock()
+        self.stored = self.load()
+
+    @property
+    def filename(self):
+        name = re.sub(r'[^a-zA-Z0-9_.-]+', '-', self.project.project_name)
+        return self.maker.path('var/fassembler/fingerprints-%s.txt' % name)
+
+    def key(self, task):
+        return self.keys[self.indexes[id(task)]]
+
+    def load(self):
+        stored = {}
+        if not os.path.exists(self.filename):
+            return stored
+        f = open(self.filename)
+        try:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line or line.startswith('#'):
+                    continue
+                key, fingerprint = line.rsplit('\t', 1)
+                stored[key] = fingerprint
+        finally:
+            f.close()
+        return stored
+
+    def save(self):
+        """
+        Write out the stored fingerprints; this is done after every
+        task, so that an interrupted build keeps what it has done.
+        """
+        if self.maker.simulate:
+            return
+        dir = os.path.dirname(self.filename)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        lines = ['# Fingerprints of the tasks of project %s; delete to run every task\n'
+                 % self.project.project_name]
+        keys = self.stored.keys()
+        keys.sort()
+        for key in keys:
+            lines.append('%s\t%s\n' % (key, self.stored[key]))
+        write_file(self.filename, ''.join(lines))
+
+    def is_forced(self, task):
+        """
+        True if ``--force-task`` matches the task (as ``task name``
+        or ``project.task name``).
+        """
+        names = [task.name, '%s.%s' % (self.project.name, task.name)]
+        for pattern in self.maker.force_tasks:
+            for name in names:
+                if fnmatch.fnmatchcase(name, pattern):
+                    return True
+        return False
+
+    def is_up_to_date(self, task):
+        """
+        True if the task can be skipped.  This also computes the
+        fingerprint of the task, so it must be called before the task
+        is run.
+        """
+        index = self.indexes[id(task)]
+        if not getattr(task, 'incremental', False):
+            self.current[index] = None
+            return False
+        fingerprint = self.fingerprint(task)
+        self.current[index] = fingerprint
+        if fingerprint is None:
+            return False
+        if self.is_forced(task):
+            self.logger.info('Task %s forced with --force-task' % task.name)
+            return False
+        return self.stored.get(self.keys[index]) == fingerprint
+
+    def record(self, task):
+        """
+        Remember the fingerprint of a task that has just run
+        successfully.
+        """
+        index = self.indexes[id(task)]
+        if not getattr(task, 'incremental', False):
+            # (See the module docstring)
+            self.current[index] = None
+            return
+        fingerprint = self.fingerprint(task)
+        self._lock.acquire()
+        try:
+            self.current[index] = fingerprint
+            if fingerprint is None:
+                self.stored.pop(self.keys[index], None)
+            else:
+                self.stored[self.keys[index]] = fingerprint
+            self.save()
+        finally:
+            self._lock.release()
+
+    def forget(self, task):
+        """
+        Forget the fingerprint of a task that failed, so it (and
+        everything that depends on it) is run again next time.
+        """
+        index = self.indexes[id(task)]
+        self._lock.acquire()
+        try:
+            self.current[index] = None
+            if self.stored.pop(self.keys[index], None) is not None:
+                self.save()
+        finally:
+            self._lock.release()
+
+    def fingerprint(self, task):
+        """
+        Returns the fingerprint of the task as it is right now, or
+        None if there's no reliable fingerprint (because a task it
+        depends on has none, or something couldn't be resolved).
+        """
+        index = self.indexes[id(task)]
+        hash = md5()
+        deps = list(self.dependencies[index])
+        deps.sort()
+        for dep in deps:
+            dep_fingerprint = self.current.get(dep)
+            if dep_fingerprint is None:
+                return None
+            hash.update('dep %s\n' % dep_fingerprint)
+        try:
+            for line in self.task_data(task):
+                hash.update(line + '\n')
+        except Exception, e:
+            self.logger.debug('Cannot fingerprint task %s: %s' % (task.name, e))
+            return None
+        return hash.hexdigest()
+
+    def task_data(self, task):
+        """
+        Yields the strings that make up the fingerprint of the task
+        itself.
+        """
+        yield 'class %s.%s' % (task.__class__.__module__, task.__class__.__name__)
+        values = []
+        for name in self.interpolated_names(task):
+            if not hasattr(task, '_' + name):
+                continue
+            value = getattr(task, name)
+            values.append(value)
+            yield 'attr %s=%s' % (name, self.stable_repr(value))
+        attrs = task.__dict__.keys()
+        attrs.sort()
+        for name in attrs:
+            if name.startswith('_') or name in self.unfingerprinted_attributes:
+                continue
+            value = task.__dict__[name]
+            value_repr = self.stable_repr(value)
+            if value_repr is None:
+                continue
+            values.append(value)
+            yield 'attr %s=%s' % (name, value_repr)
+        for path in self.iter_strings(values):
+            if '\n' in path or '\0' in path or len(path) > 1000 or '://' in path:
+                continue
+            yield 'path %s %s' % (path, self.path_state(self.maker.path(path)))
+        for resource in resolve_resources(task.inputs, self.maker):
+            yield 'input %s %s' % (resource, self.resource_state(resource, tree=True))
+        for resource in resolve_resources(task.outputs, self.maker):
+            yield 'output %s %s' % (resource, self.resource_state(resource))
+        for line in task.fingerprint_data(self):
+            yield 'data %s' % line
+
+    def interpolated_names(self, task):
+        return [name for name in interpolated_names(task.__class__)
+                if name not in ('inputs', 'outputs')]
+
+    def stable_repr(self, value):
+        """
+        A repr of the value that is the same from run to run, or None
+        if the value isn't simple enough to have one.
+        """
+        if value is None or isinstance(value, (basestring, int, long, float, bool)):
+            return repr(value)
+        if isinstance(value, (list, tuple)):
+            items = [self.stable_repr(item) for item in value]
+            if None in items:
+                return None
+            return '[%s]' % ', '.join(items)
+        if isinstance(value, dict):
+            items = []
+            for key, item in value.items():
+                key, item = self.stable_repr(key), self.stable_repr(item)
+                if key is None or item is None:
+                    return None
+                items.append('%s: %s' % (key, item))
+            items.sort()
+            return '{%s}' % ', '.join(items)
+        return None
+
+    def iter_strings(self, values):
+        for value in values:
+            if isinstance(value, basestring):
+                yield value
+            elif isinstance(value, (list, tuple)):
+                for item in self.iter_strings(value):
+                    yield item
+            elif isinstance(value, dict):
+                for item in self.iter_strings(value.values()):
+                    yield item
+
+    def resource_state(self, resource, tree=False):
+        if resource.startswith('config:'):
+            return self.config_state(resource[len('config:'):])
+        if resource.startswith('prop:'):
+            return repr(self.project.build_properties.get(resource[len('prop:'):]))
+        if tree and os.path.isdir(resource):
+            return self.tree_state(resource)
+        return self.path_state(resource)
+
+    def path_state(self, path):
+        if os.path.isdir(path):
+            return 'dir'
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if os.path.islink(path):
+            return 'link %s' % os.readlink(path)
+        return 'missing'
+
+    def file_hash(self, filename):
+        hash = md5()
+        f = open(filename, 'rb')
+        try:
+            while 1:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                hash.update(chunk)
+        finally:
+            f.close()
+        return hash.hexdigest()
+
+    def tree_state(self, dir):
+        hash = md5()
+        for dirpath, dirnames, filenames in os.walk(dir):
+            dirnames.sort()
+            filenames.sort()
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                hash.update('%s %s\n' % (path[len(dir):], self.path_state(path)))
+        return 'tree %s' % hash.hexdigest()
+
+    def config_state(self, spec):
+        """
+        The value(s) of ``section.option``, ``section`` or (with an
+        empty spec) the entire configuration.
+        """
+        config = self.project.config
+        if '.' in spec:
+            section, option = spec.split('.', 1)
+            return repr(config.getdefault(section, option))
+        if spec:
+            sections = [spec]
+        else:
+            sections = config.sections()
+            sections.sort()
+        hash = md5()
+        for section in sections:
+            if not config.has_section(section):
+                continue
+            options = config.options(section)
+            options.sort()
+            for option in options:
+                hash.update('[%s] %s=%r\n' % (section, option, config.get(section, option)))
+        return hash.hexdigest()
@@ -0,0 +1,64 @@
+"""
+Filters for the output of commands: the ``log_filter`` argument of
+``Maker.run_command``, which is called with every line a command
+prints, and returns the log level of the line (or ``(new_line,
+level)``).
+
+`PatternFilter` picks the level of a line with regular expressions.
+All the patterns for one level are combined into a single regular
+expression, so a line is searched once per level, not once per
+pattern.
+"""
+
+import re
+
+class PatternFilter(object):
+    """
+    A log filter that gives a line the level of the first rule one
+    of whose patterns matches the line (with ``re.search``).
+    ``rules`` is a list of ``(level, patterns)``; the patterns may be
+    strings or compiled regular expressions.  Lines that match no
+    rule get ``default``.
+
+    Call ``level(line)`` for the level alone (e.g., in another log
+    filter); the filter itself can be passed as ``log_filter``.
+    """
+
+    def __init__(self, rules, default):
+        self.rules = [(level, combine_patterns(patterns))
+                      for level, patterns in rules
+                      if patterns]
+        self.default = default
+
+    def __repr__(self):
+        return '<%s %s>' % (
+            self.__class__.__name__,
+            ' '.join(['%s=%r' % (level, regex.pattern) for level, regex in self.rules]))
+
+    def level(self, line):
+        for level, regex in self.rules:
+            if regex.search(line):
+                return level
+        return self.default
+
+    __call__ = level
+
+def combine_patterns(patterns):
+    """
+    Compiles a regular expression that matches wherever any of
+    ``patterns`` (strings or compiled regular expressions, which
+    must all have the same flags) matches.
+    """
+    sources = []
+    flags = None
+    for pattern in patterns:
+        if isinstance(pattern, basestring):
+            pattern_flags = 0
+        else:
+            pattern, pattern_flags = pattern.pattern, pattern.flags
+        if flags is not None and pattern_flags != flags:
+            raise ValueError(
+                "Patterns with different flags can't be combined: %r" % pattern)
+        flags = pattern_flags
+        sources.append('(?:%s)' % pattern)
+    return re.compile('|'.join(sources), flags or 0)
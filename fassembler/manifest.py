@@ -0,0 +1,333 @@
+"""
+The manifest of generated files.  For each file that was rendered
+from a template, it records the hash of the template and of the
+content that was written, in ``var/fassembler/manifest.txt`` in the
+base directory.  For the other files ``Maker.ensure_file`` writes it
+records just the content hash.
+
+This is how fassembler tells whether a file has been edited since it
+was written (if it hasn't, it can be overwritten when the template's
+output changes), and whether a file's template has changed.  It
+replaces the ``.NAME.orig`` (template) and ``.NAME.base`` (rendered
+content) files that used to be written next to every generated file;
+those are moved into the manifest, and removed, when they are come
+across (also when only one of them is there: a lone ``.base`` file
+gets the template hash `UNKNOWN_TEMPLATE`, a lone ``.orig`` file no
+content hash).
+
+The size and mtime of each file right after it was written are kept
+too, so that ``Maker.ensure_file`` can tell that a file already has
+the right content without reading it.
+
+The manifest is an append-only log: each line, ``path<TAB>template
+hash<TAB>content hash<TAB>size<TAB>mtime`` (``-`` for a missing
+value), replaces any earlier line for the same path.  The log is
+rewritten once it is mostly made of replaced lines.  Appending and
+rewriting both hold a lock on ``manifest.txt.lock``, since the
+workers of ``fassembler --jobs`` append to the same log.
+"""
+
+import os
+import threading
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; locking is skipped there
+    fcntl = None
+from fassembler.util import write_file
+
+# The template hash of a file that was generated from a template
+# which isn't known:
+UNKNOWN_TEMPLATE = '?'
+
+def content_hash(content):
+    return md5(content).hexdigest()
+
+
+class ManifestEntry(object):
+    """
+    What was written to a generated file: the hashes of the template
+    (None if the file wasn't generated from a template) and the
+    content, and the size and mtime of the file right after it was
+    written (None if not known).
+    """
+
+    def __init__(self, template_hash, content_hash, size=None, mtime=None):
+        self.template_hash = template_hash
+        self.content_hash = content_hash
+        self.size = size
+        self.mtime = mtime
+
+    def __repr__(self):
+        return '<%s template=%s content=%s>' % (
+            self.__class__.__name__, self.template_hash, self.content_hash)
+
+
+class Manifest(object):
+    """
+    The manifest of the files a `Maker` generated.  It is loaded
+    when it is first used.  Paths given to it must be normalized
+    with ``Maker.path``.
+    """
+
+    def __init__(self, maker):
+        self.maker = maker
+        self.filename = maker.path('var/fassembler/manifest.txt')
+        self.entries = None
+        self.lines = 0
+        self._lock = threading.RLock()
+
+    def key(self, path):
+        """
+        The key of a path in the manifest: relative to the base path
+        if it is inside it.
+        """
+        base = self.maker.base_path.rstrip(os.path.sep) + os.path.sep
+        if path.startswith(base):
+            return path[len(base):]
+        return path
+
+    def lock(self):
+        """
+        Locks the log against other fassembler processes; returns what
+        to pass to ``unlock()``.  Threads of this process are
+        serialized with ``self._lock`` instead.
+        """
+        dir = os.path.dirname(self.filename)
+        if fcntl is None or self.maker.simulate or not os.path.isdir(dir):
+            return None
+        f = open(self.filename + '.lock', 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    def unlock(self, f):
+        # Closing the file releases the lock
+        if f is not None:
+            f.close()
+
+    def load(self):
+        lock = self.lock()
+        try:
+            self.read_log()
+            if self.lines > 2 * len(self.entries) + 100:
+                # Nothing can be appended while the log is rewritten
+                self.compact()
+        finally:
+            self.unlock(lock)
+
+    def read_log(self):
+        self.entries = {}
+        self.lines = 0
+        if not os.path.exists(self.filename):
+            return
+        f = open(self.filename)
+        try:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line or line.startswith('#'):
+                    continue
+                fields = line.split('\t')
+                if len(fields) != 5:
+                    # The last line, cut short by a crash
+                    continue
+                key, template_hash, hash, size, mtime = fields
+                self.lines += 1
+                if template_hash == '-':
+                    template_hash = None
+                if hash == '-':
+                    hash = None
+                if size == '-':
+                    size = mtime = None
+                else:
+                    size, mtime = int(size), float(mtime)
+                self.entries[key] = ManifestEntry(
+                    template_hash, hash, size, mtime)
+        finally:
+            f.close()
+
+    def compact(self):
+        """
+        Rewrite the log with only the current entries.  The caller
+        holds ``lock()``.
+        """
+        if self.maker.simulate:
+            return
+        lines = ['# Files generated by fassembler: path, template hash, content hash, size, mtime\n']
+        keys = self.entries.keys()
+        keys.sort()
+        for key in keys:
+            lines.append(self.format_line(key, self.entries[key]))
+        write_file(self.filename, ''.join(lines))
+        self.lines = len(self.entries)
+
+    def format_line(self, key, entry):
+        if entry.size is None:
+            size = mtime = '-'
+        else:
+            size, mtime = entry.size, repr(entry.mtime)
+        return '%s\t%s\t%s\t%s\t%s\n' % (
+            key, entry.template_hash or '-', entry.content_hash or '-', size, mtime)
+
+    def append(self, key, entry):
+        if self.maker.simulate:
+            return
+        dir = os.path.dirname(self.filename)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        lock = self.lock()
+        try:
+            # Opened after locking, so nothing is appended to a log
+            # that another process has just replaced
+            new = not os.path.exists(self.filename)
+            f = open(self.filename, 'a')
+            try:
+                if new:
+                    f.write('# Files generated by fassembler: path, template hash, content hash, size, mtime\n')
+                f.write(self.format_line(key, entry))
+            finally:
+                f.close()
+        finally:
+            self.unlock(lock)
+        self.lines += 1
+
+    def get(self, path):
+        """
+        The entry for ``path``, or None.  Any ``.orig``/``.base``
+        files next to the path are moved into the manifest first.
+        """
+        self._lock.acquire()
+        try:
+            if self.entries is None:
+                self.load()
+            key = self.key(path)
+            if key not in self.entries:
+                self.migrate(path, key)
+            return self.entries.get(key)
+        finally:
+            self._lock.release()
+
+    def migrate(self, path, key):
+        orig_filename = self.maker._orig_filename(path)
+        base_filename = self.maker._base_filename(path)
+        if os.path.exists(orig_filename):
+            template_hash = content_hash(self.read(orig_filename))
+        elif os.path.exists(base_filename):
+            template_hash = UNKNOWN_TEMPLATE
+        else:
+            return
+        if os.path.exists(base_filename):
+            hash = content_hash(self.read(base_filename))
+        else:
+            hash = None
+        entry = ManifestEntry(template_hash, hash)
+        self.maker.logger.debug('Moving %s and %s into the manifest'
+                                % (os.path.basename(orig_filename), os.path.basename(base_filename)))
+        self.entries[key] = entry
+        self.append(key, entry)
+        if not self.maker.simulate:
+            for filename in orig_filename, base_filename:
+                if not os.path.exists(filename):
+                    continue
+                if os.path.exists(os.path.join(os.path.dirname(filename), '.svn')):
+                    self.maker.svn_command('rm', '--force', filename)
+                if os.path.exists(filename):
+                    os.unlink(filename)
+
+    def read(self, filename):
+        f = open(filename, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def is_unchanged(self, path, content=None):
+        """
+        True if the file ``path`` was generated from a template and
+        still has the content that was written to it (``content`` is
+        the file's current content, if it has been read already).  If
+        the file's size and mtime are the same as right after it was
+        written, it isn't read.
+        """
+        entry = self.get(path)
+        if entry is None or entry.template_hash is None:
+            return False
+        if content is None:
+            if self.stat_matches(path, entry):
+                return True
+            content = self.read(path)
+        return content_hash(content) == entry.content_hash
+
+    def has_content(self, path, content):
+        """
+        True if the file ``path`` is known to contain ``content``
+        without reading it: it has the size and mtime it had right
+        after ``content`` was written to it.
+        """
+        entry = self.get(path)
+        return (entry is not None and self.stat_matches(path, entry)
+                and entry.content_hash == content_hash(content))
+
+    def stat_matches(self, path, entry):
+        if entry.size is None:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime) == (entry.size, entry.mtime)
+
+    def template_is_unchanged(self, path, raw_content):
+        """
+        True if ``path`` was generated from the same template
+        content.
+        """
+        entry = self.get(path)
+        return entry is not None and entry.template_hash == content_hash(raw_content)
+
+    def record(self, path, raw_content, content):
+        """
+        Record that ``content`` was just written to ``path``, from the
+        template ``raw_content``.
+        """
+        self.set(path, content_hash(raw_content), content)
+
+    def update(self, path, content):
+        """
+        Record that ``path`` has just been written with (or found to
+        have) ``content``, keeping the template hash if the file was
+        generated from a template.
+        """
+        entry = self.get(path)
+        if entry is not None:
+            self.set(path, entry.template_hash, content)
+        else:
+            self.set(path, None, content)
+
+    def set(self, path, template_hash, content):
+        if self.maker.simulate:
+            return
+        self._lock.acquire()
+        try:
+            if self.entries is None:
+                self.load()
+            key = self.key(path)
+            entry = ManifestEntry(template_hash, content_hash(content))
+            try:
+                st = os.stat(path)
+            except OSError:
+                pass
+            else:
+                entry.size, entry.mtime = st.st_size, st.st_mtime
+            old = self.entries.get(key)
+            if old is not None and (
+                (old.template_hash, old.content_hash, old.size, old.mtime)
+                == (entry.template_hash, entry.content_hash, entry.size, entry.mtime)):
+                return
+            self.entries[key] = entry
+            self.append(key, entry)
+        finally:
+            self._lock.release()
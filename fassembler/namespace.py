@@ -5,20 +5,217 @@ Represents a substitution namespace for templates.
 from UserDict import DictMixin
 from tempita import Template
 from cmdutils import CommandError
+import copy
 import sys
+import threading
 from fassembler.util import asbool
+from fassembler.config import config_generation
+from fassembler.renderdeps import start_recording, stop_recording, record_read
+from fassembler.profiler import profiler
 from fassembler.text import indent, underline, dedent
 
 _in_broken_ns = False
+_prompt_lock = threading.RLock()
+
+class TemplateCache(object):
+    """
+    A cache of parsed templates, keyed on the template source and
+    name.  At most ``size`` templates are kept; the least recently
+    used ones are discarded first.
+
+    ``hits`` and ``misses`` count the lookups.
+    """
+
+    def __init__(self, size=2000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # {(content, name): [template, last_used]}
+        self._templates = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def get(self, content, name=None, stacklevel=None):
+        """
+        Returns a ``Template`` for ``content``.  Like ``Template``, if
+        no ``name`` is given it is taken from the file and line
+        ``stacklevel`` frames back.
+        """
+        if name is None and stacklevel is not None:
+            name = caller_position(stacklevel+1)
+        key = (content, name)
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            entry = self._templates.get(key)
+            if entry is not None:
+                self.hits += 1
+                entry[1] = self._clock
+                return entry[0]
+            self.misses += 1
+        finally:
+            self._lock.release()
+        tmpl = Template(content, name=name)
+        self._lock.acquire()
+        try:
+            self._templates[key] = [tmpl, self._clock]
+            if len(self._templates) > self.size:
+                self._evict()
+        finally:
+            self._lock.release()
+        return tmpl
+
+    def precompile(self, value, name=None):
+        """
+        Parse and cache the templates in ``value`` (a string, or a
+        list or dict of strings, as interpolated by
+        ``Project.interpolate_ns``).  Errors are ignored here; they
+        are reported when the value is actually interpolated.
+        """
+        if isinstance(value, basestring):
+            try:
+                self.get(value, name=name)
+            except Exception:
+                pass
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                self.precompile(item, name=name)
+        elif isinstance(value, dict):
+            for key, item in value.items():
+                self.precompile(key, name=name)
+                self.precompile(item, name=name)
+
+    def _evict(self):
+        # Drop a quarter at a time, so this sort doesn't happen on
+        # every miss once the cache is full:
+        entries = [(last_used, key)
+                   for key, (tmpl, last_used) in self._templates.items()]
+        entries.sort()
+        for last_used, key in entries[:len(entries) - int(self.size * 0.75)]:
+            del self._templates[key]
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._templates.clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def __repr__(self):
+        return '<%s %s templates, %s hits, %s misses>' % (
+            self.__class__.__name__, len(self), self.hits, self.misses)
+
+# All the templates of interpolated strings and settings are shared
+# through this cache:
+template_cache = TemplateCache()
+
+def caller_position(stacklevel):
+    """
+    The ``filename:lineno`` of the frame ``stacklevel`` frames back,
+    as Tempita uses to name templates.
+    """
+    try:
+        caller = sys._getframe(stacklevel)
+    except ValueError:
+        return None
+    globals = caller.f_globals
+    if '__file__' in globals:
+        name = globals['__file__']
+        if name.endswith('.pyc') or name.endswith('.pyo'):
+            name = name[:-1]
+    elif '__name__' in globals:
+        name = globals['__name__']
+    else:
+        name = '<string>'
+    if caller.f_lineno:
+        name += ':%s' % caller.f_lineno
+    return name
+
+class OverlayDict(dict):
+    """
+    A dictionary of what is set in it, which looks up anything else
+    in ``parent`` (a dictionary, or another OverlayDict).  Nothing is
+    copied, and later changes to ``parent`` show through; deleting a
+    key only removes what was set in the overlay.
+
+    Templates can be executed in it: ``eval`` and ``exec`` look names
+    up with ``__getitem__`` in a dict subclass, so ``__missing__``
+    is used.
+    """
+
+    def __init__(self, parent):
+        dict.__init__(self)
+        self.parent = parent
+
+    def __missing__(self, key):
+        return self.parent[key]
+
+    if sys.version_info < (2, 5):
+        # dict doesn't call __missing__ before Python 2.5
+        def __getitem__(self, key):
+            try:
+                return dict.__getitem__(self, key)
+            except KeyError:
+                return self.parent[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.parent
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def keys(self):
+        keys = dict.keys(self)
+        for key in self.parent.keys():
+            if not dict.__contains__(self, key):
+                keys.append(key)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def copy(self):
+        new = self.__class__(self.parent)
+        dict.update(new, self)
+        return new
 
 class Namespace(DictMixin):
     """
     Represents a namespace that templates are executed in.
 
     ``self.dict`` contains the concrete dictionary object to use for
-    interpretation.  ``exec`` (and ``eval`` etc) can only work with
-    actual dictionaries.  This object acts *like* a dictionary as
-    well, but more lazily.
+    interpretation (a dict, or an `OverlayDict` in an overlay).  This
+    object acts *like* a dictionary as well, but more lazily.
 
     This can handle config files and config sections with recursive
     interpolation.
@@ -55,6 +252,17 @@ class Namespace(DictMixin):
     def __delitem__(self, key):
         del self.dict[key]
 
+    def overlay(self):
+        """
+        Returns a new namespace that starts out with everything in
+        this namespace.  Changes to the new namespace do not affect
+        this one.  Nothing is copied: names are looked up in the new
+        namespace, then in this one.
+        """
+        ns = copy.copy(self)
+        ns.dict = OverlayDict(self.dict)
+        return ns
+
     def add_section(self, config, section, variable=None):
         """
         Add a section from the given ConfigParser-like object ``config``.
@@ -100,18 +308,13 @@ class Namespace(DictMixin):
                     pass
                 else:
                     name = caller.f_globals.get('__name__') or name
-        tmpl = Template(string, name=name)
-        try:
-            old_self = None
-            if self is not None:
-                old_self = self_.dict.get('self')
-                self_.dict['self'] = self
-            return tmpl.substitute(self_.dict)
-        finally:
-            if old_self is not None:
-                self_.dict['self'] = old_self
-            elif 'self' in self_.dict:
-                del self_.dict['self']
+        tmpl = template_cache.get(string, name=name)
+        # Substitute in an overlay, as templates can assign variables,
+        # and this namespace may be shared (see Project.base_namespace):
+        ns = OverlayDict(self_.dict)
+        if self is not None:
+            ns['self'] = self
+        return tmpl.substitute(ns)
 
     def string_repr(self, detail=0):
         """
@@ -164,62 +367,72 @@ class Namespace(DictMixin):
         """
         global _in_broken_ns
         try:
-            return tmpl.substitute(self.dict)
+            token = profiler.begin('template')
+            try:
+                return tmpl.substitute(self.dict)
+            finally:
+                profiler.end(token, tmpl.name or 'template')
         except KeyboardInterrupt:
             raise
         except:
             if not self['maker'].interactive:
                 # If nobody's at the keyboard, errors must be fatal.
                 raise
-            if _in_broken_ns:
-                # Hitting this recursively while already handling another error
-                raise
-            _in_broken_ns = True
+            # Templates may be executed in several threads at once
+            # (like in Maker.copy_dir); only one asks at a time:
+            _prompt_lock.acquire()
             try:
-                import traceback
+                if _in_broken_ns:
+                    # Hitting this recursively while already handling another error
+                    raise
+                _in_broken_ns = True
                 try:
-                    # Enable nicer raw_input:
-                    import readline
-                except ImportError:
-                    pass
-                exc_info = sys.exc_info()
-                print "Error: %s" % exc_info[1]
-                template_content = tmpl.content
-                if len(template_content) < 80 and len(template_content.strip().splitlines()) == 1:
-                    print 'Template: %s' % template_content
-                while 1:
-                    ## FIXME: should beep here
-                    response = raw_input('What to do? [(c)ancel/(q)uit/(r)etry/(s)how source/(n)amespace/(t)raceback/(p)db/(e)xecute/(r)etry/] ')
-                    if not response.strip():
-                        continue
-                    char = response.strip().lower()[0]
-                    if char == 'c':
-                        break
-                    elif char == 'q':
-                        raise CommandError('Aborted', show_usage=False)
-                    elif char == 's':
-                        print 'Template:'
-                        print template_content
-                    elif char == 'n':
-                        print 'Namespace:'
-                        try:
-                            print self
-                        except KeyboardInterrupt:
-                            raise
-                        except:
-                            # This shouldn't really happen
-                            print 'Error printing self:', sys.exc_info()[1]
-                            traceback.print_exc()
-                    elif char == 't':
-                        traceback.print_exception(*exc_info)
-                    elif char == 'p':
-                        import pdb
-                        pdb.set_trace()
-                    else:
-                        print 'Invalid input: %r' % char
-                raise
+                    import traceback
+                    try:
+                        # Enable nicer raw_input:
+                        import readline
+                    except ImportError:
+                        pass
+                    exc_info = sys.exc_info()
+                    print "Error: %s" % exc_info[1]
+                    template_content = tmpl.content
+                    if len(template_content) < 80 and len(template_content.strip().splitlines()) == 1:
+                        print 'Template: %s' % template_content
+                    while 1:
+                        ## FIXME: should beep here
+                        response = raw_input('What to do? [(c)ancel/(q)uit/(r)etry/(s)how source/(n)amespace/(t)raceback/(p)db/(e)xecute/(r)etry/] ')
+                        if not response.strip():
+                            continue
+                        char = response.strip().lower()[0]
+                        if char == 'c':
+                            break
+                        elif char == 'q':
+                            raise CommandError('Aborted', show_usage=False)
+                        elif char == 's':
+                            print 'Template:'
+                            print template_content
+                        elif char == 'n':
+                            print 'Namespace:'
+                            try:
+                                print self
+                            except KeyboardInterrupt:
+                                raise
+                            except:
+                                # This shouldn't really happen
+                                print 'Error printing self:', sys.exc_info()[1]
+                                traceback.print_exc()
+                        elif char == 't':
+                            traceback.print_exception(*exc_info)
+                        elif char == 'p':
+                            import pdb
+                            pdb.set_trace()
+                        else:
+                            print 'Invalid input: %r' % char
+                    raise
+                finally:
+                    _in_broken_ns = False
             finally:
-                _in_broken_ns = False
+                _prompt_lock.release()
 
 class SectionNamespace(DictMixin):
     """
@@ -230,6 +443,9 @@ class SectionNamespace(DictMixin):
     given.  Attributes are interpolated.  Thus if you get
     ``section.foo`` the value of ``foo`` is interpolated.  If you get
     ``section['foo']`` it is not interpolated.
+
+    Interpolated values are remembered until the configuration
+    changes (see ``fassembler.config.config_generation``).
     """
 
     def __init__(self, ns, config, section, name=None):
@@ -237,11 +453,14 @@ class SectionNamespace(DictMixin):
         self.config = config
         self.section = section
         self.name = name
+        self._resolved = {}
+        self._generation = None
 
     def __getitem__(self, key):
         if self.config.has_option(self.section, key):
             return self.config.get(self.section, key)
         elif key in self.config.defaults():
+            record_read('DEFAULT.%s' % key)
             return self.config.defaults()[key]
         else:
             raise KeyError(key)
@@ -268,9 +487,30 @@ class SectionNamespace(DictMixin):
     def __getattr__(self, key):
         if key not in self:
             raise AttributeError(key)
-        value = self[key]
-        if isinstance(value, basestring):
-            value = self.ns.interpolate(value, name=self.name, self=self)
+        generation = config_generation()
+        if generation != self._generation:
+            self._resolved = {}
+            self._generation = generation
+        try:
+            value, keys = self._resolved[key]
+        except KeyError:
+            pass
+        else:
+            # The settings this value was interpolated from are still
+            # being read, as far as fassembler.renderdeps is concerned:
+            for read_key in keys:
+                record_read(read_key)
+            return value
+        keys = start_recording()
+        try:
+            value = self[key]
+            if isinstance(value, basestring):
+                value = self.ns.interpolate(value, name=self.name, self=self)
+        finally:
+            stop_recording(keys)
+        if config_generation() == generation:
+            # Only if the config didn't change while interpolating:
+            self._resolved[key] = (value, keys)
         return value
 
     def string_repr(self, detail=0):
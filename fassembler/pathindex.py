@@ -0,0 +1,111 @@
+"""
+Finds programs on ``$PATH`` (see ``Maker.find_executable``).
+
+Instead of looking for every name in every directory of ``$PATH`` each
+time, each directory is listed once, and its names are kept.  A
+command may install programs, so ``Maker`` calls ``forget()`` after
+every command it runs; after that each directory is checked again
+(with one ``stat``) when it is next searched, and only listed again if
+its mtime has changed.  Like ``execvp``, a search stops at the first
+directory the program is found in, so the directories after it aren't
+checked.
+"""
+
+import os
+import threading
+import time
+
+class PathIndex(object):
+    """
+    The programs in the directories that have been searched.
+    """
+
+    def __init__(self):
+        # {dir: (mtime, set of names)}; the mtime is None if the
+        # directory has to be listed again anyway (see listing()):
+        self._listings = {}
+        # The directories whose listings are known to be current:
+        self._checked = set()
+        self._lock = threading.Lock()
+
+    def find(self, names, dirs):
+        """
+        The path of the first of ``names`` that is found in any of
+        ``dirs`` (the earlier directory wins), or None.  Only
+        executable files count.
+        """
+        self._lock.acquire()
+        try:
+            for name in names:
+                if os.path.sep in name:
+                    if is_executable(name):
+                        return os.path.abspath(name)
+                    continue
+                for dir in dirs:
+                    if name in self.listing(dir):
+                        path = os.path.join(dir, name)
+                        if is_executable(path):
+                            return path
+            return None
+        finally:
+            self._lock.release()
+
+    def listing(self, dir):
+        """
+        The names in ``dir``; it is only listed again if its mtime
+        has changed since it was last listed.
+        """
+        if dir in self._checked:
+            return self._listings[dir][1]
+        try:
+            mtime = os.stat(dir).st_mtime
+        except OSError:
+            mtime = None
+        old = self._listings.get(dir)
+        if old is not None and mtime is not None and old[0] == mtime:
+            names = old[1]
+        else:
+            try:
+                names = set(os.listdir(dir))
+            except OSError:
+                names = set()
+            if mtime is not None and mtime >= time.time() - 2:
+                # Changed so recently that another change may not
+                # change the mtime (on file systems with coarse mtimes):
+                mtime = None
+            self._listings[dir] = (mtime, names)
+        self._checked.add(dir)
+        return names
+
+    def forget(self):
+        """
+        Check the directories again when they are next searched (they
+        are only listed again if they have changed).
+        """
+        self._lock.acquire()
+        try:
+            self._checked.clear()
+        finally:
+            self._lock.release()
+
+def path_dirs(path=None, extra_dirs=(), cwd=None):
+    """
+    The directories of ``path`` (by default ``$PATH``), and then any
+    of ``extra_dirs`` that aren't in it.  Relative directories (and
+    empty ones, which mean the current directory) are relative to
+    ``cwd`` (by default the current directory), as they are for a
+    program run in ``cwd``.
+    """
+    if path is None:
+        path = os.environ.get('PATH', os.defpath)
+    if cwd is None:
+        cwd = os.getcwd()
+    dirs = []
+    for dir in path.split(os.path.pathsep) + list(extra_dirs):
+        dir = os.path.normpath(os.path.join(cwd, dir))
+        if dir not in dirs:
+            dirs.append(dir)
+    return dirs
+
+def is_executable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
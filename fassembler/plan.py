@@ -0,0 +1,209 @@
+"""
+Frozen build plans.
+
+``fassembler --plan-out plan.json PROJECT...`` binds the tasks of the
+projects (expanding ``ForEach`` and ``ConditionalTask``) and writes
+them out with all their interpolated attributes resolved (see
+``Task.freeze``), along with the configuration.  ``fassembler
+--plan-in plan.json`` then builds those projects from the plan,
+without interpolating the tasks' attributes or expanding the tasks
+again; this is meant for replaying a build on identical hosts (with
+the same base path).
+
+Each task in the plan is matched up with the task instance in
+``Project.actions`` it came from (by its class and the file and line
+it was created on); tasks that don't appear in the actions (like the
+ones ``VirtualEnv`` adds) are recreated from their class.  Things a
+task only works out in its ``run()`` method are still worked out
+when the plan is run.
+"""
+
+import copy
+import os
+import sys
+from datetime import datetime
+from cmdutils import CommandError
+from initools.configparser import NoSectionError
+from fassembler.util import write_file
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+PLAN_VERSION = 1
+
+def iter_templates(tasks):
+    """
+    Yields the tasks and all the tasks they contain (the subtasks of
+    ``ForEach`` and ``ConditionalTask``), without binding or
+    expanding anything.
+    """
+    for task in tasks:
+        yield task
+        children = []
+        if isinstance(getattr(task, 'tasks', None), (list, tuple)):
+            children.extend(task.tasks)
+        for cond, subtask in getattr(task, 'conditions', None) or ():
+            children.append(subtask)
+        for child in iter_templates(children):
+            yield child
+
+def template_keys(project):
+    """
+    Returns ``{key: task}`` for the task instances in
+    ``project.actions``.  The keys don't depend on where fassembler
+    is installed.
+    """
+    keys = {}
+    counts = {}
+    for task in iter_templates(project.actions):
+        key = '%s %s' % (task.__class__.__name__,
+                         os.path.basename(task.position or task.name))
+        counts[key] = counts.get(key, 0) + 1
+        if counts[key] > 1:
+            key += ' #%s' % counts[key]
+        keys[key] = task
+    return keys
+
+def freeze_project(project):
+    """
+    Returns the plan for one project.
+    """
+    project.setup_config()
+    for key, task in template_keys(project).items():
+        # Copies (like the ones ForEach makes) keep this:
+        task._plan_template = key
+    tasks = []
+    for task in project.bind_tasks():
+        tasks.append({
+            'class': '%s.%s' % (task.__class__.__module__, task.__class__.__name__),
+            'template': getattr(task, '_plan_template', None),
+            'state': task.freeze(),
+            })
+    return {'name': project.project_name, 'tasks': tasks}
+
+def config_snapshot(config):
+    """
+    All the settings in ``config``, as ``{section: {option: value}}``.
+    """
+    sections = {}
+    defaults = {}
+    for section in ['DEFAULT'] + config.sections():
+        sections[section] = {}
+        try:
+            options = config.options(section)
+        except NoSectionError:
+            continue
+        for option in options:
+            value = config.get(section, option, raw=True)
+            if section != 'DEFAULT' and defaults.get(option) == value:
+                # Inherited from [DEFAULT]
+                continue
+            sections[section][option] = value
+        if section == 'DEFAULT':
+            defaults = sections[section]
+    return sections
+
+def write_plan(filename, projects, config, maker, logger):
+    """
+    Writes the plan for ``projects`` to ``filename``.
+    """
+    plan = {
+        'fassembler_plan': PLAN_VERSION,
+        'created': datetime.now().strftime('%c'),
+        'base_path': maker.base_path,
+        'config': config_snapshot(config),
+        'projects': [],
+        }
+    for project in projects:
+        logger.notify('Planning project %s' % project.project_name)
+        logger.indent += 2
+        try:
+            plan['projects'].append(freeze_project(project))
+            logger.info('%s tasks' % len(plan['projects'][-1]['tasks']))
+        finally:
+            logger.indent -= 2
+    write_file(filename, json.dumps(plan, indent=1, sort_keys=True))
+    logger.notify('Wrote the plan for %s to %s'
+                  % (', '.join([p['name'] for p in plan['projects']]), filename))
+
+def _str(value):
+    """
+    The JSON module gives unicode strings; tasks expect str.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    if isinstance(value, list):
+        return [_str(item) for item in value]
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            result[_str(key)] = _str(item)
+        return result
+    return value
+
+def read_plan(filename, base_path):
+    """
+    Reads a plan written by ``write_plan``.
+    """
+    try:
+        f = open(filename)
+        try:
+            plan = _str(json.load(f))
+        finally:
+            f.close()
+    except (IOError, ValueError), e:
+        raise CommandError('Cannot read plan %s: %s' % (filename, e), show_usage=False)
+    if plan.get('fassembler_plan') != PLAN_VERSION:
+        raise CommandError('%s is not a fassembler plan (or is from another version of fassembler)'
+                           % filename, show_usage=False)
+    if os.path.abspath(plan['base_path']) != os.path.abspath(base_path):
+        raise CommandError('The plan %s was made for the base path %s, not %s'
+                           % (filename, plan['base_path'], base_path),
+                           show_usage=False)
+    return plan
+
+def load_plan_config(plan, config, filename):
+    """
+    Adds the configuration saved in the plan to ``config``.
+    """
+    for section, options in plan['config'].items():
+        if section != 'DEFAULT' and not config.has_section(section):
+            config.add_section(section)
+        for option, value in options.items():
+            config.set(section, option, value, filename='<plan %s>' % filename)
+
+def find_class(name):
+    module_name, class_name = name.rsplit('.', 1)
+    __import__(module_name)
+    return getattr(sys.modules[module_name], class_name)
+
+def thaw_project(project, project_plan):
+    """
+    Sets ``project.planned_tasks`` to the (bound) tasks of the plan.
+    """
+    templates = template_keys(project)
+    tasks = []
+    for entry in project_plan['tasks']:
+        template = templates.get(entry['template'])
+        if template is not None:
+            if '%s.%s' % (template.__class__.__module__, template.__class__.__name__) != entry['class']:
+                raise CommandError(
+                    'The plan does not match project %s: task %s is not a %s'
+                    % (project.project_name, entry['template'], entry['class']),
+                    show_usage=False)
+            task = copy.copy(template)
+        else:
+            try:
+                TaskClass = find_class(entry['class'])
+            except (ImportError, AttributeError), e:
+                raise CommandError('Cannot find task class %s: %s' % (entry['class'], e),
+                                   show_usage=False)
+            task = TaskClass.__new__(TaskClass)
+        task.thaw(entry['state'])
+        task.bind(maker=project.maker, environ=project.environ,
+                  logger=project.logger, config=project.config,
+                  project=project)
+        task.setup_build_properties()
+        tasks.append(task)
+    project.planned_tasks = tasks
@@ -0,0 +1,111 @@
+"""
+A cache of what programs report about themselves: ``httpd -v``,
+``python -V``, ``php -m`` and the like (see ``Maker.probe``).
+
+The output of each such command is kept in
+``var/fassembler/probes.json`` in the base directory, along with the
+mtime and inode of the program, and reused (in this run and later
+runs) as long as the program hasn't been replaced.  With
+``--refresh-probes`` every command is run again once in the run.
+"""
+
+import errno
+import os
+import subprocess
+import threading
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from fassembler.util import write_file
+
+class ProbeCache(object):
+    """
+    The probes of a `Maker`.  It is loaded when it is first used.
+    If ``refresh`` is true, the results saved by earlier runs are
+    not used (but are replaced).
+    """
+
+    def __init__(self, maker, refresh=False):
+        self.maker = maker
+        self.filename = maker.path('var/fassembler/probes.json')
+        self.refresh = refresh
+        # {key: entry}, where an entry is a dict with the keys stat,
+        # stdout, stderr and returncode:
+        self.entries = None
+        # The keys that were probed in this run:
+        self.fresh = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        self.entries = {}
+        if not os.path.exists(self.filename):
+            return
+        f = open(self.filename, 'rb')
+        try:
+            try:
+                data = json.load(f)
+            except ValueError, e:
+                self.maker.logger.warn('Ignoring bad probe cache %s: %s'
+                                       % (self.maker.display_path(self.filename), e))
+                return
+        finally:
+            f.close()
+        for key, entry in data.items():
+            self.entries[key.encode('latin-1')] = {
+                'stat': entry['stat'],
+                'stdout': entry['stdout'].encode('latin-1'),
+                'stderr': entry['stderr'].encode('latin-1'),
+                'returncode': entry['returncode'],
+                }
+
+    def save(self):
+        if self.maker.simulate:
+            return
+        data = {}
+        for key, entry in self.entries.items():
+            data[key.decode('latin-1')] = {
+                'stat': entry['stat'],
+                'stdout': entry['stdout'].decode('latin-1'),
+                'stderr': entry['stderr'].decode('latin-1'),
+                'returncode': entry['returncode'],
+                }
+        dir = os.path.dirname(self.filename)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        write_file(self.filename, json.dumps(data, indent=1, sort_keys=True))
+
+    def probe(self, cmd, *args):
+        """
+        Runs ``cmd`` (a program name or path) with ``args``, unless it
+        was run before, and returns ``(stdout, stderr, returncode)``.
+        """
+        exe = self.maker.find_executable([cmd])
+        if exe is None:
+            raise OSError(errno.ENOENT, 'Cannot find the program %s' % cmd)
+        st = os.stat(exe)
+        stat = [st.st_mtime, st.st_ino]
+        key = '\0'.join([exe] + list(args))
+        self._lock.acquire()
+        try:
+            if self.entries is None:
+                self.load()
+            entry = self.entries.get(key)
+        finally:
+            self._lock.release()
+        if (entry is not None and entry['stat'] == stat
+            and (not self.refresh or key in self.fresh)):
+            return entry['stdout'], entry['stderr'], entry['returncode']
+        self.maker.logger.debug('Probing %s' % self.maker._format_command([exe] + list(args)))
+        proc = subprocess.Popen([exe] + list(args), stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        self._lock.acquire()
+        try:
+            self.entries[key] = {'stat': stat, 'stdout': stdout, 'stderr': stderr,
+                                 'returncode': proc.returncode}
+            self.fresh.add(key)
+            self.save()
+        finally:
+            self._lock.release()
+        return stdout, stderr, proc.returncode
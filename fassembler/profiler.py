@@ -0,0 +1,232 @@
+"""
+Records where the time of a build goes, for ``--profile FILE``.
+
+The profiler records the wall time of every project and task, and
+within each task the time spent in subprocesses (``Maker.run_command``,
+with the CPU time and maximum RSS of each child), interpolating
+templates (``Namespace.execute_template``) and reading and writing
+files.  ``FILE`` is written in the Chrome trace event format (open it
+in ``chrome://tracing`` or Perfetto), and a summary of the slowest
+tasks is logged at the end of the run.
+
+When projects are built in worker processes (``--jobs``), each worker
+writes its part of the trace to ``FILE.PID.part``; the parts are
+merged into ``FILE`` at the end.
+"""
+
+import errno
+import glob
+import os
+import thread
+import threading
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from fassembler.util import write_file
+
+_local = threading.local()
+
+class Profiler(object):
+    """
+    Collects the timings; there is one instance, ``profiler``, which
+    does nothing until ``start()`` is called.
+    """
+
+    # The time in these is summed up per task:
+    categories = ['subprocess', 'template', 'io']
+
+    def __init__(self):
+        self.enabled = False
+        self.filename = None
+        self.events = []
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def start(self, filename):
+        self.enabled = True
+        self.filename = filename
+        self.pid = os.getpid()
+        self.start_time = time.time()
+        self.events = []
+        self.totals = {}
+
+    def set_task(self, name):
+        """
+        Time recorded in this thread is counted for the task ``name``
+        (``project.task``), or for nothing in particular if None.
+        """
+        _local.task = name
+
+    def get_task(self):
+        """
+        The task time is counted for in this thread (for passing on
+        to other threads).
+        """
+        return getattr(_local, 'task', None)
+
+    def begin(self, category):
+        """
+        Call before doing something that should be timed; pass what
+        this returns to ``end()``.  Returns None if the profiler isn't
+        running.
+        """
+        if not self.enabled:
+            return None
+        depth = getattr(_local, 'depth', None)
+        if depth is None:
+            depth = _local.depth = {}
+        depth[category] = depth.get(category, 0) + 1
+        # (end() may be called in another thread; see Maker.start_command)
+        return (category, time.time(), depth, getattr(_local, 'task', None),
+                thread.get_ident())
+
+    def end(self, token, name, **args):
+        """
+        Record the time since ``begin()`` returned ``token``.  The
+        keyword arguments are added to the trace event.
+        """
+        if token is None:
+            return
+        category, start, depth, task, tid = token
+        now = time.time()
+        duration = now - start
+        depth[category] -= 1
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int((start - self.start_time) * 1000000),
+            'dur': int(duration * 1000000),
+            'pid': os.getpid(),
+            'tid': tid,
+            }
+        if args:
+            event['args'] = args
+        self._lock.acquire()
+        try:
+            self.events.append(event)
+            if category == 'task':
+                self.add_total(name, 'wall', duration)
+            elif category in self.categories and not depth[category]:
+                # Nested spans (like templates interpolated while
+                # interpolating a template) are only counted once:
+                task = task or '(outside of tasks)'
+                self.add_total(task, category, duration)
+                if category == 'subprocess':
+                    for key in 'cpu', 'maxrss':
+                        if key in args:
+                            self.add_total(task, key, args[key], max_value=(key == 'maxrss'))
+        finally:
+            self._lock.release()
+
+    def add_total(self, task, key, value, max_value=False):
+        totals = self.totals.setdefault(task, {})
+        if max_value:
+            totals[key] = max(totals.get(key, 0), value)
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+    def save_part(self):
+        """
+        Called in a worker process to save what it recorded, for the
+        parent to merge.
+        """
+        if not self.enabled:
+            return
+        self.write_json('%s.%s.part' % (self.filename, os.getpid()),
+                        {'traceEvents': self.events, 'totals': self.totals})
+
+    def finish(self, logger):
+        """
+        Write the trace file and log the summary.
+        """
+        if not self.enabled or os.getpid() != self.pid:
+            return
+        self.enabled = False
+        for part_filename in glob.glob(self.filename + '.*.part'):
+            f = open(part_filename)
+            try:
+                part = json.load(f)
+            finally:
+                f.close()
+            self.events.extend(part['traceEvents'])
+            for task, totals in part['totals'].items():
+                for key, value in totals.items():
+                    self.add_total(str(task), str(key), value, max_value=(key == 'maxrss'))
+            os.unlink(part_filename)
+        self.events.sort(key=lambda event: event['ts'])
+        self.write_json(self.filename, {'traceEvents': self.events,
+                                        'displayTimeUnit': 'ms'})
+        logger.notify('Profile written to %s' % self.filename)
+        logger.notify(self.summary())
+
+    def write_json(self, filename, data):
+        write_file(filename, json.dumps(data))
+
+    def summary(self, limit=30):
+        """
+        A text summary of the tasks that took the most time.
+        """
+        tasks = self.totals.items()
+        tasks.sort(key=lambda item: -item[1].get('wall', 0))
+        lines = ['Slowest tasks (wall / subprocesses / templates / file I/O):']
+        grand = {}
+        for task, totals in tasks:
+            for key, value in totals.items():
+                if key == 'maxrss':
+                    grand[key] = max(grand.get(key, 0), value)
+                else:
+                    grand[key] = grand.get(key, 0) + value
+        for task, totals in tasks[:limit]:
+            lines.append(self.format_totals(task, totals))
+        if len(tasks) > limit:
+            lines.append('  (%s more)' % (len(tasks) - limit))
+        lines.append(self.format_totals('Total', grand))
+        return '\n'.join(lines)
+
+    def format_totals(self, name, totals):
+        line = '  %8.2fs %8.2fs %8.2fs %8.2fs  %s' % (
+            totals.get('wall', 0), totals.get('subprocess', 0),
+            totals.get('template', 0), totals.get('io', 0), name)
+        if totals.get('cpu'):
+            line += ' (subprocess CPU %.2fs, max RSS %.1fMB)' % (
+                totals['cpu'], totals.get('maxrss', 0) / 1024.0)
+        return line
+
+profiler = Profiler()
+
+def record_rusage(proc):
+    """
+    Makes ``proc.wait()`` (which ``proc.communicate()`` also uses)
+    keep the resource usage of the child process in ``proc.rusage``.
+    """
+    if not hasattr(os, 'wait4'):
+        return
+    def wait():
+        if proc.returncode is None:
+            while 1:
+                try:
+                    pid, status, rusage = os.wait4(proc.pid, 0)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                break
+            proc.rusage = rusage
+            proc._handle_exitstatus(status)
+        return proc.returncode
+    proc.wait = wait
+
+def child_usage(proc):
+    """
+    The PID, exit code, CPU time and maximum RSS (in KB) of a finished
+    subprocess, as far as they are known, for ``Profiler.end()``.
+    """
+    usage = {'pid': proc.pid, 'returncode': proc.returncode}
+    rusage = getattr(proc, 'rusage', None)
+    if rusage is not None:
+        usage['cpu'] = rusage.ru_utime + rusage.ru_stime
+        usage['maxrss'] = rusage.ru_maxrss
+    return usage
@@ -7,7 +7,13 @@ import os
 import sys
 import re
 from cStringIO import StringIO
-from fassembler.namespace import Namespace
+from fassembler.namespace import Namespace, template_cache
+from fassembler.config import config_generation, config_changed
+from fassembler.scheduler import TaskScheduler, find_task_dependencies
+from fassembler.fingerprint import TaskFingerprints, task_keys
+from fassembler.renderdeps import RenderedFiles, set_render_target
+from fassembler.profiler import profiler
+from fassembler.util import sync_files
 from fassembler.text import indent, underline, dedent
 from cmdutils import CommandError
 from tempita import Template
@@ -48,6 +54,14 @@ class Project(object):
     # Override spec_filename if you want to use another project's spec file to find req_settings.    
     spec_filename = None 
 
+    # Set while the project runs; see fassembler.fingerprint and
+    # fassembler.renderdeps:
+    fingerprints = None
+    rendered_files = None
+    # The tasks of a build plan (see fassembler.plan), run instead of
+    # the actions:
+    planned_tasks = None
+
 
     def __init__(self, project_name, maker, environ, logger, config):
         self.project_name = project_name
@@ -58,7 +72,7 @@ class Project(object):
         if self.name is None:
             raise NotImplementedError(
                 "No name has been assigned to %r" % self)
-        self.build_properties = {}
+        self.build_properties = BuildProperties()
 
     @property
     def config_section(self):
@@ -100,33 +114,163 @@ class Project(object):
             raise NotImplementedError(
                 "The actions attribute has not been overridden in %r"
                 % self)
+        token = profiler.begin('project')
+        try:
+            self.setup_config()
+            if self.planned_tasks is not None:
+                tasks = self.planned_tasks
+            else:
+                tasks = self.bind_tasks()
+            dependencies = find_task_dependencies(tasks, self.maker)
+            self.fingerprints = TaskFingerprints(self, tasks, dependencies)
+            self.rendered_files = RenderedFiles(self.maker, self.project_name,
+                                                self.fingerprints.key)
+            if self.maker.task_jobs > 1:
+                TaskScheduler(self, tasks, self.maker.task_jobs, dependencies).run()
+            else:
+                for task in tasks:
+                    self.run_task(task)
+            self.environ.add_built_project(self.project_name)
+        finally:
+            profiler.end(token, self.project_name)
+
+    def run_task(self, task):
+        """
+        Run a single task, handling (and offering to retry) errors.
+        """
+        self.logger.set_section(self.name+'.'+task.name)
+        self.logger.notify('== %s ==' % task.name, color='bold green')
+        if self.task_is_up_to_date(task):
+            return
+        self.logger.indent += 2
+        while 1:
+            try:
+                try:
+                    self.logger.debug('Task Plan:')
+                    self.logger.debug(indent(str(task), '  '))
+                    self.execute_task(task)
+                finally:
+                    self.logger.indent -= 2
+            except (KeyboardInterrupt, CommandError):
+                raise
+            except:
+                should_continue = self.handle_task_error(task, sys.exc_info())
+                if should_continue == 'retry':
+                    self.logger.indent += 2
+                    continue
+            else:
+                self.task_finished(task)
+            break
+
+    def execute_task(self, task):
+        """
+        Calls ``task.run()``, recording the files it renders.
+        """
+        if self.rendered_files is not None:
+            self.rendered_files.forget_task(task)
+        set_render_target(self.rendered_files, task)
+        name = '%s.%s' % (self.project_name, task.name)
+        profiler.set_task(name)
+        token = profiler.begin('task')
+        try:
+            task.run()
+        finally:
+            profiler.end(token, name)
+            profiler.set_task(None)
+            set_render_target(None, None)
+            # Files are added to svn and synced to disk once per task,
+            # not once per file:
+            self.maker.flush_svn_adds()
+            sync_files()
+            self.maker.forget_dirs()
+            self.maker.close_command_logs(name)
+
+    def task_is_up_to_date(self, task):
+        """
+        True (after logging that it is skipped) if the task hasn't
+        changed since it last ran successfully.
+        """
+        if self.fingerprints is None or not self.fingerprints.is_up_to_date(task):
+            return False
+        self.logger.notify('  Unchanged since the last build; skipping (use --force-task=%r to run it)'
+                           % task.name)
+        return True
+
+    def task_finished(self, task):
+        """
+        Called after a task has run successfully.
+        """
+        if self.fingerprints is not None:
+            self.fingerprints.record(task)
+        if self.rendered_files is not None:
+            self.rendered_files.save()
+
+    def rerender(self, settings):
+        """
+        Re-render only the files that were rendered (in an earlier
+        build) from any of the given settings (like ``base_port`` or
+        ``general.base_port``).  Tasks that render a single file are
+        run again; files that a task copied from templates are copied
+        again by themselves.  Returns the files re-rendered.
+        """
         self.setup_config()
         tasks = self.bind_tasks()
-        for task in tasks:
-            self.logger.set_section(self.name+'.'+task.name)
-            self.logger.notify('== %s ==' % task.name, color='bold green')
+        keys_by_task = {}
+        tasks_by_key = {}
+        for task, key in zip(tasks, task_keys(tasks)):
+            keys_by_task[id(task)] = key
+            tasks_by_key[key] = task
+        def task_key(task):
+            return keys_by_task[id(task)]
+        self.rendered_files = RenderedFiles(self.maker, self.project_name, task_key)
+        affected = self.rendered_files.affected_by(settings)
+        if not affected:
+            self.logger.info('No files in project %s use %s'
+                             % (self.project_name, ', '.join(settings)))
+            return []
+        done = []
+        run_tasks = []
+        for rendered in affected:
+            task = tasks_by_key.get(rendered.task_key)
+            if task is None:
+                self.logger.warn(
+                    'The task that rendered %s no longer exists; rebuild project %s to update it'
+                    % (self.maker.display_path(rendered.dest), self.project_name))
+                continue
+            if rendered.source is None and task in run_tasks:
+                continue
+            self.logger.notify('Re-rendering %s (%s)' % (self.maker.display_path(rendered.dest), task.name))
             self.logger.indent += 2
-            while 1:
-                try:
-                    try:
-                        self.logger.debug('Task Plan:')
-                        self.logger.debug(indent(str(task), '  '))
-                        task.run()
-                    finally:
-                        self.logger.indent -= 2
-                except (KeyboardInterrupt, CommandError):
-                    raise
-                except:
-                    should_continue = self.maker.handle_exception(sys.exc_info(), can_continue=True,
-                                                                  can_retry=True)
-                    if should_continue == 'retry':
-                        self.logger.notify('Retrying task %s' % task.name)
-                        continue
-                    if not should_continue:
-                        self.logger.fatal('Project %s aborted.' % self.title, color='red')
-                        raise CommandError('Aborted', show_usage=False)
-                break
-        self.environ.add_built_project(self.project_name)
+            set_render_target(self.rendered_files, task)
+            try:
+                if rendered.source is None:
+                    run_tasks.append(task)
+                    task.run()
+                else:
+                    task.copy_file(rendered.source, rendered.dest)
+            finally:
+                set_render_target(None, None)
+                self.logger.indent -= 2
+            done.append(rendered.dest)
+        self.rendered_files.save()
+        return done
+
+    def handle_task_error(self, task, exc_info):
+        """
+        Called when a task fails; returns 'retry' if the task should be
+        run again, true if the project should continue, and raises
+        CommandError if the project should be aborted.
+        """
+        if self.fingerprints is not None:
+            self.fingerprints.forget(task)
+        should_continue = self.maker.handle_exception(exc_info, can_continue=True,
+                                                      can_retry=True)
+        if should_continue == 'retry':
+            self.logger.notify('Retrying task %s' % task.name)
+        elif not should_continue:
+            self.logger.fatal('Project %s aborted.' % self.title, color='red')
+            raise CommandError('Aborted', show_usage=False)
+        return should_continue
 
     def bind_tasks(self):
         """
@@ -222,7 +366,7 @@ class Project(object):
             if not isinstance(string, basestring):
                 # Not a template at all, don't substitute
                 return string
-            tmpl = Template(string, name=name, stacklevel=stacklevel+1)
+            tmpl = template_cache.get(string, name=name, stacklevel=stacklevel+1)
         else:
             tmpl = string
         return ns.execute_template(tmpl)
@@ -234,6 +378,29 @@ class Project(object):
         Each call returns a new namespace.  This namespace can be
         further augmented (as it is by tasks).
         """
+        return self.base_namespace().overlay()
+
+    _base_namespace = None
+    _base_generation = None
+    _base_sections = None
+
+    def base_namespace(self):
+        """
+        The namespace shared by everything in this project, which
+        ``create_namespace`` copies.  Config values are interpolated
+        in this namespace.  It is rebuilt when sections are added to
+        or removed from the configuration.
+        """
+        generation = config_generation()
+        if self._base_namespace is None or generation != self._base_generation:
+            sections = self.config.sections()
+            if self._base_namespace is None or sections != self._base_sections:
+                self._base_namespace = self.make_base_namespace()
+                self._base_sections = sections
+            self._base_generation = generation
+        return self._base_namespace
+
+    def make_base_namespace(self):
         ns = Namespace(self.config_section)
         ns['env'] = self.environ
         ns['maker'] = self.maker
@@ -269,13 +436,10 @@ class Project(object):
 
         Call from confirm_settings
         """
-        paths = os.environ['PATH'].split(os.path.pathsep)
-        for executable in executables:
-            for path in paths:
-                full = os.path.join(path, executable)
-                if os.path.exists(full):
-                    self.logger.debug('Found %s in %s' % (executable, full))
-                    return
+        full = self.maker.find_executable(executables)
+        if full is not None:
+            self.logger.debug('Found %s' % full)
+            return
         raise OSError(
             "Could not find any of executable(s) %s in PATH %s.\n"
             "Please ensure that you have the relevant packages installed,\n"
@@ -322,6 +486,46 @@ class Project(object):
         f.close()
         return settings        
 
+class BuildProperties(dict):
+    """
+    The ``build_properties`` of a project.  Settings may be
+    interpolated from them (like ``{{project.build_properties[...]}}``
+    in a default), so changing them counts as a change of the
+    configuration (see ``fassembler.config.config_generation``), and
+    the values interpolated before are thrown away.
+    """
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        config_changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        config_changed()
+
+    def update(self, *args, **kw):
+        dict.update(self, *args, **kw)
+        config_changed()
+
+    def setdefault(self, key, default=None):
+        value = dict.setdefault(self, key, default)
+        config_changed()
+        return value
+
+    def pop(self, key, *default):
+        value = dict.pop(self, key, *default)
+        config_changed()
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        config_changed()
+        return item
+
+    def clear(self):
+        dict.clear(self)
+        config_changed()
+
 class Setting(object):
     """
     Instances of Setting describe one setting a project takes.
@@ -0,0 +1,213 @@
+"""
+Keeps track of which settings each generated file was rendered from,
+so that ``fassembler rerender KEY...`` can re-render just the files
+that use those settings.
+
+While a template is rendered, every configuration value that is read
+(through ``ConfigParser.get``, which is also what ``SectionNamespace``
+and the ``Environment`` properties use) is recorded as
+``section.option``.  The files each project's tasks rendered are kept
+in ``var/fassembler/rendered-PROJECT.txt`` in the base directory.
+"""
+
+import os
+import re
+import threading
+from fassembler.util import write_file
+
+_local = threading.local()
+
+def start_recording():
+    """
+    Start recording the settings that are read (in this thread).
+    Returns the set the keys are added to; pass it to
+    ``stop_recording``.  Recordings nest: the keys are added to every
+    recording in progress.
+    """
+    keys = set()
+    stack = getattr(_local, 'recordings', None)
+    if stack is None:
+        stack = _local.recordings = []
+    stack.append(keys)
+    return keys
+
+def stop_recording(keys):
+    stack = _local.recordings
+    assert stack and stack[-1] is keys, (
+        "stop_recording() called out of order")
+    stack.pop()
+    return keys
+
+def record_read(key):
+    """
+    Record that the setting ``key`` (``section.option``) was read.
+    """
+    stack = getattr(_local, 'recordings', None)
+    if stack:
+        for keys in stack:
+            keys.add(key)
+
+def set_render_target(rendered_files, task):
+    """
+    Files rendered in this thread are recorded in ``rendered_files``
+    (a `RenderedFiles` instance) as belonging to ``task``.  Use
+    ``set_render_target(None, None)`` to stop.
+    """
+    _local.target = (rendered_files, task)
+
+def rendered(dest, keys, source=None):
+    """
+    Record that the file ``dest`` was rendered, reading the settings
+    in ``keys``.  ``source`` is the template file, if the file was
+    rendered with ``copy_file``.
+    """
+    rendered_files, task = getattr(_local, 'target', (None, None))
+    if rendered_files is not None:
+        rendered_files.add(task, dest, keys, source)
+
+def key_matches(key, patterns):
+    """
+    True if the recorded ``key`` (``section.option``) matches any of
+    the given keys.  A key without a section (or with the section
+    ``DEFAULT``) matches that option in any section.
+    """
+    section, option = key.split('.', 1)
+    for pattern in patterns:
+        if '.' in pattern:
+            pattern_section, pattern_option = pattern.split('.', 1)
+            if pattern_section == 'DEFAULT':
+                pattern_section = None
+        else:
+            pattern_section, pattern_option = None, pattern
+        if pattern_option.lower() != option.lower():
+            continue
+        if pattern_section is None or pattern_section == section:
+            return True
+    return False
+
+
+class RenderedFile(object):
+    """
+    A file that was rendered by the task with the key ``task_key``
+    (see `fassembler.fingerprint.task_keys`), from the settings in
+    ``keys``.
+    """
+
+    def __init__(self, dest, task_key, keys, source=None):
+        self.dest = dest
+        self.task_key = task_key
+        self.keys = keys
+        self.source = source
+
+    def __repr__(self):
+        return '<%s %s from %s (%s)>' % (
+            self.__class__.__name__, self.dest, self.task_key,
+            ', '.join(sorted(self.keys)))
+
+
+class RenderedFiles(object):
+    """
+    The files rendered by the tasks of one project, as recorded in
+    ``var/fassembler/rendered-PROJECT.txt``.  ``task_key`` is a
+    function that returns the key of a (bound) task.
+    """
+
+    def __init__(self, maker, project_name, task_key=None):
+        self.maker = maker
+        self.project_name = project_name
+        self.task_key = task_key
+        self.files = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def filename(cls, maker, project_name):
+        name = re.sub(r'[^a-zA-Z0-9_.-]+', '-', project_name)
+        return maker.path('var/fassembler/rendered-%s.txt' % name)
+    filename = classmethod(filename)
+
+    def all_project_names(cls, maker):
+        """
+        The names of all the projects that have recorded rendered
+        files.
+        """
+        dir = maker.path('var/fassembler')
+        names = []
+        if not os.path.isdir(dir):
+            return names
+        for filename in sorted(os.listdir(dir)):
+            if not (filename.startswith('rendered-') and filename.endswith('.txt')):
+                continue
+            f = open(os.path.join(dir, filename))
+            try:
+                header = f.readline()
+            finally:
+                f.close()
+            if header.startswith('# project: '):
+                names.append(header[len('# project: '):].strip())
+        return names
+    all_project_names = classmethod(all_project_names)
+
+    def load(self):
+        filename = self.filename(self.maker, self.project_name)
+        if not os.path.exists(filename):
+            return
+        f = open(filename)
+        try:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line or line.startswith('#'):
+                    continue
+                dest, task_key, source, keys = line.split('\t')
+                if source == '-':
+                    source = None
+                keys = set([key for key in keys.split(' ') if key])
+                self.files[dest] = RenderedFile(dest, task_key, keys, source)
+        finally:
+            f.close()
+
+    def save(self):
+        if self.maker.simulate:
+            return
+        filename = self.filename(self.maker, self.project_name)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self._lock.acquire()
+        try:
+            lines = ['# project: %s\n' % self.project_name,
+                     '# file\ttask\ttemplate\tsettings\n']
+            for dest in sorted(self.files):
+                rendered = self.files[dest]
+                lines.append('%s\t%s\t%s\t%s\n' % (
+                    dest, rendered.task_key, rendered.source or '-',
+                    ' '.join(sorted(rendered.keys))))
+            write_file(filename, ''.join(lines))
+        finally:
+            self._lock.release()
+
+    def add(self, task, dest, keys, source=None):
+        dest = self.maker.path(dest)
+        self._lock.acquire()
+        try:
+            self.files[dest] = RenderedFile(dest, self.task_key(task), set(keys), source)
+        finally:
+            self._lock.release()
+
+    def forget_task(self, task):
+        """
+        Forget the files a task rendered (before it is run again).
+        """
+        key = self.task_key(task)
+        self._lock.acquire()
+        try:
+            for dest, rendered in self.files.items():
+                if rendered.task_key == key:
+                    del self.files[dest]
+        finally:
+            self._lock.release()
+
+    def affected_by(self, keys):
+        """
+        The rendered files that read any of the given settings.
+        """
+        return [rendered for dest, rendered in sorted(self.files.items())
+                if [key for key in rendered.keys if key_matches(key, keys)]]
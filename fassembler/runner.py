@@ -0,0 +1,453 @@
+"""
+Runs any number of subprocesses at once, streaming their output.
+
+``CommandRunner.add()`` takes a started ``subprocess.Popen`` (with
+its stdout, and stderr unless it is merged into stdout, piped) and
+returns a `CommandFuture`.  The output of all the children is read
+with ``select.poll()`` (or ``select.select()`` where there is no
+poll), and each line is passed to the child's ``on_line`` callback as
+soon as it is read, separately for stdout and stderr; the text for
+stdin is written the same way, so that a child is never blocked
+writing its output while we are blocked writing its input.
+
+There is no thread of its own: output is read by whichever thread is
+waiting for a future (``CommandFuture.result()``), and while waiting
+for one, the output of all the other children is read too.  This is
+how ``Maker.run_command`` and ``Maker.start_command`` run commands.
+"""
+
+import errno
+import fcntl
+import gzip
+import os
+import select
+import sys
+import threading
+from collections import deque
+
+class CommandFuture(object):
+    """
+    A command that is running (or has finished).  ``returncode`` is
+    set once it has exited; ``result()`` waits for that.
+
+    ``on_line(stream, line)`` is called with each line of output
+    (without the newline); ``stream`` is ``'stdout'`` or
+    ``'stderr'``.  If it raises an exception, the output is still read
+    (but not passed on) and the exception is raised by
+    ``check_error()``.
+
+    ``on_exit(future)`` is called as soon as the command has exited
+    (in whichever thread is reading the output).
+
+    ``on_result(future)``, if given, is called by ``result()`` (once
+    the command has exited) to make its return value; it should call
+    ``future.check_error()``.  Otherwise ``result()`` returns
+    ``(stdout, stderr, returncode)``.
+
+    If ``output_limit`` is given, only the last ``output_limit`` bytes
+    of stdout and of stderr are kept (see `OutputTail`).
+    """
+
+    def __init__(self, runner, proc, on_line=None, on_exit=None, on_result=None,
+                 output_limit=None):
+        self.runner = runner
+        self.proc = proc
+        self.pid = proc.pid
+        self.on_line = on_line
+        self.on_exit = on_exit
+        self.on_result = on_result
+        self.output = {'stdout': OutputTail(output_limit),
+                       'stderr': OutputTail(output_limit)}
+        self.returncode = None
+        self.exc_info = None
+        self._event = threading.Event()
+        self._open_streams = 0
+
+    def __repr__(self):
+        return '<%s pid=%s returncode=%s>' % (
+            self.__class__.__name__, self.pid, self.returncode)
+
+    def _get_stdout(self):
+        return self.output['stdout'].getvalue()
+    stdout = property(_get_stdout)
+
+    def _get_stderr(self):
+        return self.output['stderr'].getvalue()
+    stderr = property(_get_stderr)
+
+    def _get_truncated(self):
+        return bool(self.output['stdout'].dropped or self.output['stderr'].dropped)
+    truncated = property(_get_truncated, doc="""
+        True if ``stdout`` or ``stderr`` is only the end of the output.
+        """)
+
+    def done(self):
+        return self._event.isSet()
+
+    def wait(self):
+        """
+        Waits for the command to exit; returns the exit code.
+        """
+        if not self.done():
+            self.runner.wait(self)
+        return self.returncode
+
+    def result(self):
+        """
+        Waits for the command to exit, and returns the result (see
+        the class docstring).
+        """
+        self.wait()
+        if self.on_result is not None:
+            return self.on_result(self)
+        self.check_error()
+        return self.stdout, self.stderr, self.returncode
+
+    def check_error(self):
+        """
+        Raises the exception ``on_line`` raised, if it did.
+        """
+        if self.exc_info is not None:
+            exc_info = self.exc_info
+            self.exc_info = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _line(self, stream, line):
+        if self.on_line is None or self.exc_info is not None:
+            return
+        try:
+            self.on_line(stream, line)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def _exited(self, returncode):
+        self.returncode = returncode
+        if self.on_exit is not None:
+            try:
+                self.on_exit(self)
+            except:
+                if self.exc_info is None:
+                    self.exc_info = sys.exc_info()
+        self._event.set()
+
+
+class OutputTail(object):
+    """
+    Keeps the last ``size`` bytes written to it (or everything, if
+    ``size`` is None); ``dropped`` is the number of bytes that were
+    thrown away.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self.chunks = deque()
+        self.length = 0
+        self.dropped = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        if self.size is None:
+            return
+        while self.length - len(self.chunks[0]) >= self.size:
+            chunk = self.chunks.popleft()
+            self.length -= len(chunk)
+            self.dropped += len(chunk)
+
+    def getvalue(self):
+        value = ''.join(self.chunks)
+        if self.size is not None and len(value) > self.size:
+            cut = len(value) - self.size
+            value = value[cut:]
+            self.chunks = deque([value])
+            self.length = len(value)
+            self.dropped += cut
+        return value
+
+
+class CommandLog(object):
+    """
+    A gzip-compressed log file that the full output of commands is
+    written to (see ``Maker.command_log``), while only its tail is
+    kept in memory.  It is opened when it is first written to: the
+    first time it is truncated, after that (once it is closed)
+    appended to, as another gzip member.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.opened = False
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        self._lock.acquire()
+        try:
+            if self.file is None:
+                if self.opened:
+                    mode = 'ab'
+                else:
+                    mode = 'wb'
+                    dir = os.path.dirname(self.filename)
+                    if not os.path.exists(dir):
+                        os.makedirs(dir)
+                self.file = gzip.GzipFile(self.filename, mode)
+                self.opened = True
+            self.file.write(data)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        finally:
+            self._lock.release()
+
+
+class FinishedFuture(object):
+    """
+    Looks like a `CommandFuture` whose ``result()`` is ``result``;
+    for commands that aren't waited for (when simulating).
+    """
+
+    def __init__(self, result, pid=None, returncode=0):
+        self._result = result
+        self.pid = pid
+        self.returncode = returncode
+
+    def done(self):
+        return True
+
+    def wait(self):
+        return self.returncode
+
+    def result(self):
+        return self._result
+
+    def check_error(self):
+        pass
+
+
+class _Pipe(object):
+    """
+    One pipe to or from a child.
+    """
+
+    def __init__(self, future, name, file, data=None):
+        self.future = future
+        self.name = name
+        self.file = file
+        self.fd = file.fileno()
+        # For reading: the incomplete last line
+        self.partial = ''
+        # For writing: what is left to write
+        self.data = data
+
+
+class CommandRunner(object):
+    """
+    Keeps track of the running children; see the module docstring.
+    """
+
+    # How long a thread waiting for a future waits for another thread
+    # (that is reading output) before checking again:
+    wait_interval = 0.05
+
+    def __init__(self):
+        self._setup()
+
+    def _setup(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        # Held by the thread that is reading the output:
+        self._reading = threading.Lock()
+        self._pipes = {}
+        # Written to when a child is added, to wake up the thread
+        # that is waiting in poll():
+        self._wake_read, self._wake_write = os.pipe()
+        for fd in self._wake_read, self._wake_write:
+            set_nonblocking(fd)
+            set_cloexec(fd)
+
+    def _check_fork(self):
+        # The children (and the wake-up pipe, and the threads) of the
+        # parent process aren't this process's business:
+        if os.getpid() != self._pid:
+            for fd in self._wake_read, self._wake_write:
+                os.close(fd)
+            self._setup()
+
+    def add(self, proc, stdin=None, on_line=None, on_exit=None, on_result=None,
+            output_limit=None):
+        """
+        Starts handling the output of ``proc``, and writing
+        ``stdin`` to it; returns a `CommandFuture`.
+
+        ``proc`` should have been started with ``close_fds=True``:
+        otherwise a child started in another thread at the same time
+        may inherit its pipes, and its output doesn't end (and
+        ``result()`` doesn't return) until that child exits too.
+        """
+        self._check_fork()
+        future = CommandFuture(self, proc, on_line=on_line, on_exit=on_exit,
+                               on_result=on_result, output_limit=output_limit)
+        pipes = []
+        if proc.stdin is not None:
+            if stdin:
+                set_nonblocking(proc.stdin.fileno())
+                pipes.append(_Pipe(future, 'stdin', proc.stdin, stdin))
+            else:
+                proc.stdin.close()
+        for name in 'stdout', 'stderr':
+            file = getattr(proc, name)
+            if file is not None:
+                pipes.append(_Pipe(future, name, file))
+        if not pipes:
+            self._finish(future)
+            return future
+        for pipe in pipes:
+            # (Children started from now on, even without close_fds,
+            # don't inherit these; that doesn't help with those
+            # started while proc was being started)
+            set_cloexec(pipe.fd)
+        self._lock.acquire()
+        try:
+            for pipe in pipes:
+                self._pipes[pipe.fd] = pipe
+            future._open_streams = len(pipes)
+        finally:
+            self._lock.release()
+        try:
+            os.write(self._wake_write, 'x')
+        except OSError:
+            # The pipe is full, so it will wake up anyway
+            pass
+        return future
+
+    def wait(self, future):
+        """
+        Reads output (of all the children) until ``future`` is done.
+        """
+        self._check_fork()
+        while not future.done():
+            if self._reading.acquire(False):
+                try:
+                    while not future.done():
+                        self.poll()
+                finally:
+                    self._reading.release()
+            else:
+                # Another thread is reading the output
+                future._event.wait(self.wait_interval)
+
+    def poll(self):
+        """
+        Waits until there is output from any child (or room to write
+        to the stdin of one), and handles it.
+        """
+        self._lock.acquire()
+        try:
+            readers = [pipe.fd for pipe in self._pipes.values() if pipe.name != 'stdin']
+            writers = [pipe.fd for pipe in self._pipes.values() if pipe.name == 'stdin']
+        finally:
+            self._lock.release()
+        readers.append(self._wake_read)
+        try:
+            ready = wait_for_fds(readers, writers)
+        except (select.error, OSError), e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in ready:
+            if fd == self._wake_read:
+                try:
+                    os.read(self._wake_read, 4096)
+                except OSError:
+                    pass
+                continue
+            pipe = self._pipes.get(fd)
+            if pipe is None:
+                continue
+            if pipe.name == 'stdin':
+                self._write(pipe)
+            else:
+                self._read(pipe)
+
+    def _read(self, pipe):
+        try:
+            data = os.read(pipe.fd, 65536)
+        except OSError, e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            raise
+        future = pipe.future
+        if not data:
+            if pipe.partial:
+                future._line(pipe.name, pipe.partial)
+                pipe.partial = ''
+            self._close(pipe)
+            return
+        future.output[pipe.name].write(data)
+        if future.on_line is not None:
+            lines = (pipe.partial + data).split('\n')
+            pipe.partial = lines.pop()
+            for line in lines:
+                future._line(pipe.name, line)
+
+    def _write(self, pipe):
+        try:
+            written = os.write(pipe.fd, pipe.data[:65536])
+        except OSError, e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            if e.errno != errno.EPIPE:
+                raise
+            # The child doesn't read its stdin (any more)
+            written = len(pipe.data)
+        pipe.data = pipe.data[written:]
+        if not pipe.data:
+            self._close(pipe)
+
+    def _close(self, pipe):
+        self._lock.acquire()
+        try:
+            del self._pipes[pipe.fd]
+            pipe.future._open_streams -= 1
+            finished = not pipe.future._open_streams
+        finally:
+            self._lock.release()
+        pipe.file.close()
+        if finished:
+            self._finish(pipe.future)
+
+    def _finish(self, future):
+        future._exited(future.proc.wait())
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def wait_for_fds(readers, writers):
+    """
+    Waits until any of the file descriptors ``readers`` can be read
+    or ``writers`` can be written to, and returns those that can.
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fd in readers:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        for fd in writers:
+            poller.register(fd, select.POLLOUT)
+        # (POLLHUP and POLLERR are reported too; reading or writing
+        # then gives EOF or an error)
+        return [fd for fd, event in poller.poll()]
+    readable, writable, errors = select.select(readers, writers, [])
+    return readable + writable
@@ -0,0 +1,431 @@
+"""
+Runs several projects at once, in separate worker processes, and
+several tasks of a project at once, in threads.
+
+The order projects are built in comes from
+``Project.depends_on_projects``: a project is only started once every
+project it depends on (that is also being built in this run) has
+finished successfully.
+
+The order tasks are run in comes from what the tasks declare they
+read and write (see ``Task.declare``).  Tasks that declare nothing
+are run strictly in sequence with all other tasks.
+"""
+
+import os
+import re
+import signal
+import sys
+import threading
+import traceback
+import Queue
+from cmdutils import CommandError
+from fassembler.profiler import profiler
+from fassembler.text import indent
+from fassembler.util import sync_files
+
+class ProjectScheduler(object):
+    """
+    Builds a set of projects concurrently, using up to ``jobs`` forked
+    worker processes.
+
+    ``resolve`` is a function that takes a project name (as found in
+    ``depends_on_projects``) and returns the project class, or None
+    if it cannot be found (typically
+    ``fassembler.command.find_project_class``).
+
+    Each worker logs to its own file in ``logs/``; the parent process
+    only reports when projects start, finish or fail.  Workers never
+    ask questions interactively.
+    """
+
+    def __init__(self, projects, jobs, maker, environ, logger, resolve):
+        self.projects = projects
+        self.jobs = jobs
+        self.maker = maker
+        self.environ = environ
+        self.logger = logger
+        self.resolve = resolve
+        self.dependencies = self.find_dependencies()
+
+    def find_dependencies(self):
+        """
+        Returns ``{project: [projects it waits for]}``, only counting
+        dependencies that are themselves part of this run.
+        """
+        deps = {}
+        for project in self.projects:
+            deps[project] = []
+            for dep_name in project.depends_on_projects:
+                dep_class = self.resolve(dep_name)
+                if dep_class is None:
+                    continue
+                for other in self.projects:
+                    if other is not project and other.__class__ is dep_class:
+                        deps[project].append(other)
+        self.check_cycles(deps)
+        return deps
+
+    def check_cycles(self, deps):
+        """
+        Raises CommandError if the dependencies contain a cycle.
+        """
+        done = set()
+        def visit(project, stack):
+            if project in stack:
+                names = [p.project_name for p in stack[stack.index(project):]]
+                names.append(project.project_name)
+                raise CommandError(
+                    'Circular project dependencies: %s' % ' -> '.join(names),
+                    show_usage=False)
+            if project in done:
+                return
+            for dep in deps[project]:
+                visit(dep, stack + [project])
+            done.add(project)
+        for project in self.projects:
+            visit(project, [])
+
+    def log_filename(self, project):
+        """
+        The file that the worker building ``project`` logs to.
+        """
+        name = re.sub(r'[^a-zA-Z0-9_.-]+', '-', project.project_name)
+        return self.maker.path('logs/build-%s.log' % name)
+
+    def run(self):
+        """
+        Build all the projects.  Returns true if every project was
+        built successfully.
+        """
+        self.environ.concurrent = True
+        pending = list(self.projects)
+        running = {}
+        finished = set()
+        failed = set()
+        try:
+            while pending or running:
+                for project in list(pending):
+                    if len(running) >= self.jobs:
+                        break
+                    waiting_for = [dep for dep in self.dependencies[project]
+                                   if dep not in finished]
+                    if [dep for dep in waiting_for if dep in failed]:
+                        pending.remove(project)
+                        failed.add(project)
+                        self.logger.error(
+                            'Skipping project %s because a project it depends on failed'
+                            % project.project_name, color='bold red')
+                        continue
+                    if waiting_for:
+                        continue
+                    pending.remove(project)
+                    running[self.start(project)] = project
+                if not running:
+                    continue
+                pid, status = os.waitpid(-1, 0)
+                if pid not in running:
+                    continue
+                project = running.pop(pid)
+                if os.WIFEXITED(status) and not os.WEXITSTATUS(status):
+                    finished.add(project)
+                    self.logger.notify('Done with project %s' % project.project_name,
+                                       color='black green_bg')
+                else:
+                    failed.add(project)
+                    self.report_failure(project, status)
+                # The worker may have changed build.ini, and projects
+                # started later should see that:
+                self.environ.refresh_config()
+        except KeyboardInterrupt:
+            for pid in running:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            raise CommandError('^C', show_usage=False)
+        return not failed
+
+    def start(self, project):
+        """
+        Fork a worker process that builds ``project``; returns its PID.
+        """
+        log_filename = self.log_filename(project)
+        if not os.path.exists(os.path.dirname(log_filename)):
+            os.makedirs(os.path.dirname(log_filename))
+        # Anything buffered now would otherwise be written twice:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for level, consumer in self.logger.consumers:
+            if hasattr(consumer, 'flush'):
+                consumer.flush()
+        pid = os.fork()
+        if pid:
+            self.logger.notify('Started project %s (PID %s; logging to %s)'
+                               % (project.project_name, pid,
+                                  self.maker.display_path(log_filename)))
+            return pid
+        code = 1
+        try:
+            try:
+                self.setup_worker(log_filename)
+                code = self.run_project(project)
+            except:
+                traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def setup_worker(self, log_filename):
+        """
+        Called in the worker process to send all output to the log file.
+        """
+        log_file = open(log_filename, 'a')
+        null = open(os.devnull)
+        os.dup2(null.fileno(), 0)
+        os.dup2(log_file.fileno(), 1)
+        os.dup2(log_file.fileno(), 2)
+        self.logger.consumers[:] = [(self.logger.DEBUG, sys.stdout)]
+        self.logger.indent = 0
+        self.maker.interactive = False
+
+    def run_project(self, project):
+        """
+        Called in the worker process to actually build the project.
+        Returns the exit code for the worker.
+        """
+        self.logger.notify('Starting project %s' % project.project_name)
+        try:
+            try:
+                project.run()
+            finally:
+                self.maker.close_command_logs()
+                profiler.save_part()
+        except KeyboardInterrupt:
+            return 1
+        except CommandError, e:
+            self.logger.fatal('Error: %s' % e)
+            return 1
+        except Exception, e:
+            self.logger.fatal('Error in project %s: %s' % (project.project_name, e))
+            traceback.print_exc(file=sys.stdout)
+            return 1
+        self.logger.notify('Done with project %s' % project.project_name)
+        self.environ.save()
+        self.maker.flush_svn_adds()
+        sync_files()
+        return 0
+
+    def report_failure(self, project, status, tail_lines=20):
+        """
+        Log that the project failed, with the tail of its log.
+        """
+        if os.WIFSIGNALED(status):
+            reason = 'killed by signal %s' % os.WTERMSIG(status)
+        else:
+            reason = 'exit code %s' % os.WEXITSTATUS(status)
+        log_filename = self.log_filename(project)
+        self.logger.fatal('Project %s failed (%s)' % (project.project_name, reason),
+                          color='bold red')
+        if os.path.exists(log_filename):
+            f = open(log_filename, 'rb')
+            lines = f.readlines()
+            f.close()
+            self.logger.fatal('Last lines of %s:' % log_filename)
+            self.logger.indent += 2
+            try:
+                self.logger.fatal(''.join(lines[-tail_lines:]).rstrip())
+            finally:
+                self.logger.indent -= 2
+
+
+class TaskScheduler(object):
+    """
+    Runs the (bound) tasks of a project using up to ``jobs`` threads.
+
+    A task waits for every earlier task that doesn't declare its
+    inputs and outputs, for every earlier task whose outputs overlap
+    its inputs or outputs (or whose inputs overlap its outputs), and
+    for the tasks named in its ``after``.  Tasks that declare nothing
+    wait for all earlier tasks, and all later tasks wait for them.
+
+    Errors are handled once the tasks that are already running have
+    finished, one failed task after the other, using
+    ``Project.handle_task_error``.
+    """
+
+    def __init__(self, project, tasks, jobs, dependencies=None):
+        self.project = project
+        self.tasks = tasks
+        self.jobs = jobs
+        self.logger = project.logger
+        self.maker = project.maker
+        if dependencies is None:
+            dependencies = find_task_dependencies(tasks, self.maker)
+        self.dependencies = dependencies
+
+    def run(self):
+        """
+        Run all the tasks.
+        """
+        waiting = range(len(self.tasks))
+        done = set()
+        running = {}
+        results = Queue.Queue()
+        errors = []
+        while waiting or running:
+            if not errors:
+                for index in list(waiting):
+                    if len(running) >= self.jobs:
+                        break
+                    if self.dependencies[index] - done:
+                        continue
+                    waiting.remove(index)
+                    running[index] = self.start(index, results)
+                if not running:
+                    raise RuntimeError(
+                        "Tasks %s wait for tasks that will never finish"
+                        % ', '.join([self.tasks[index].name for index in waiting]))
+            if running:
+                index, exc_info = self.wait(results)
+                running.pop(index).join()
+                if exc_info is None:
+                    done.add(index)
+                else:
+                    errors.append((index, exc_info))
+            if errors and not running:
+                # Each error is handled in turn (in task order) before
+                # the tasks that wait for the failed ones can start
+                errors.sort()
+                pending = errors
+                errors = []
+                for index, exc_info in pending:
+                    self.handle_error(index, exc_info)
+                    done.add(index)
+
+    def wait(self, results):
+        """
+        Wait for a task to finish.  This polls, because a blocking
+        ``Queue.get()`` can't be interrupted with ^C.
+        """
+        while 1:
+            try:
+                return results.get(True, 0.5)
+            except Queue.Empty:
+                pass
+
+    def start(self, index, results):
+        """
+        Start running ``self.tasks[index]`` in a new thread.
+        """
+        task = self.tasks[index]
+        self.logger.notify('== %s ==' % task.name, color='bold green')
+        thread = threading.Thread(target=self.run_task, args=(index, results))
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def run_task(self, index, results):
+        """
+        Runs in the worker thread.
+        """
+        task = self.tasks[index]
+        try:
+            if not self.project.task_is_up_to_date(task):
+                self.logger.debug('Task Plan (%s):' % task.name)
+                self.logger.debug(indent(str(task), '  '))
+                self.project.execute_task(task)
+                self.project.task_finished(task)
+        except:
+            results.put((index, sys.exc_info()))
+        else:
+            results.put((index, None))
+
+    def handle_error(self, index, exc_info):
+        """
+        Handle a failed task, once nothing else is running.
+        """
+        task = self.tasks[index]
+        if issubclass(exc_info[0], (KeyboardInterrupt, CommandError)):
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if self.project.handle_task_error(task, exc_info) == 'retry':
+            self.project.run_task(task)
+
+
+def find_task_dependencies(tasks, maker):
+    """
+    Returns a list of sets; ``deps[i]`` is the set of indexes of the
+    (bound) tasks that ``tasks[i]`` waits for.  See `TaskScheduler`.
+    """
+    deps = []
+    resources = []
+    barrier = None
+    since_barrier = []
+    for index, task in enumerate(tasks):
+        if not task.declares_dependencies():
+            deps.append(set(since_barrier))
+            if barrier is not None:
+                deps[index].add(barrier)
+            resources.append(None)
+            barrier = index
+            since_barrier = []
+            continue
+        inputs = resolve_resources(task.inputs, maker)
+        outputs = resolve_resources(task.outputs, maker)
+        after = task.after or []
+        if isinstance(after, basestring) or not isinstance(after, (list, tuple)):
+            after = [after]
+        task_deps = set()
+        if barrier is not None:
+            task_deps.add(barrier)
+        for other in since_barrier:
+            other_inputs, other_outputs = resources[other]
+            other_task = tasks[other]
+            if (overlaps(outputs, other_inputs + other_outputs)
+                or overlaps(inputs, other_outputs)
+                or other_task in after or other_task.name in after):
+                task_deps.add(other)
+        deps.append(task_deps)
+        resources.append((inputs, outputs))
+        since_barrier.append(index)
+    return deps
+
+def resolve_resources(resources, maker):
+    """
+    Normalizes declared inputs or outputs.  Items like
+    ``config:section.option`` or ``prop:name`` are kept as-is;
+    anything else is a path (relative to the base path).
+    """
+    if not resources:
+        return []
+    if isinstance(resources, basestring):
+        resources = [resources]
+    result = []
+    for resource in resources:
+        if not resource:
+            continue
+        if resource.startswith('config:') or resource.startswith('prop:'):
+            result.append(resource)
+        else:
+            result.append(maker.path(resource))
+    return result
+
+def overlaps(resources, other_resources):
+    """
+    True if any of the resources are the same as, or contain, or
+    are contained in any of the other resources.
+    """
+    for resource in resources:
+        if resource.startswith('config:') or resource.startswith('prop:'):
+            sep = '.'
+        else:
+            sep = os.path.sep
+        for other in other_resources:
+            if (resource == other
+                or other.startswith(resource.rstrip(sep) + sep)
+                or resource.startswith(other.rstrip(sep) + sep)
+                or resource.endswith(':') and other.startswith(resource)
+                or other.endswith(':') and resource.startswith(other)):
+                return True
+    return False
@@ -11,7 +11,10 @@ import sys
 import urlparse
 
 from fassembler.distutilspatch import find_distutils_file, update_distutils_file
-from fassembler.util import asbool
+from fassembler.logfilter import PatternFilter
+from fassembler.namespace import template_cache
+from fassembler.renderdeps import start_recording, stop_recording, rendered
+from fassembler.util import asbool, write_file
 from glob import glob
 from tempita import Template
 from types import StringTypes
@@ -34,16 +37,57 @@ class interpolated(object):
         except AttributeError:
             raise AttributeError(
                 "No value set for %s" % self.name)
-        return obj.interpolate(raw_value, name=obj.position + (' attribute %s' % self.name))
+        if self.name in obj._frozen:
+            # Already interpolated (see Task.thaw)
+            return raw_value
+        return obj.interpolate(raw_value, name=self.template_name(obj))
+    def template_name(self, obj):
+        return obj.position + (' attribute %s' % self.name)
     def __set__(self, obj, value):
-        ## FIXME: nice to compile the template here too
         setattr(obj, '_' + self.name, value)
+        if self.name in obj._frozen:
+            obj._frozen.discard(self.name)
+        if getattr(obj, 'position', None) is not None:
+            template_cache.precompile(value, name=self.template_name(obj))
     def __delete__(self, obj, value):
         delattr(obj, '_' + self.name)
     def __repr__(self):
         return '<%s for attribute %s>' % (
             self.__class__.__name__, self.name)
 
+def interpolated_names(cls):
+    """
+    The (sorted) names of the ``interpolated`` attributes of a task
+    class.
+    """
+    names = set()
+    for base in cls.__mro__:
+        for name, value in base.__dict__.items():
+            if isinstance(value, interpolated):
+                names.add(name)
+    names = list(names)
+    names.sort()
+    return names
+
+def is_plain(value):
+    """
+    True if the value can be written to a build plan (it's made of
+    strings, numbers, lists and dicts).
+    """
+    if value is None or isinstance(value, (basestring, int, long, float, bool)):
+        return True
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            if not is_plain(item):
+                return False
+        return True
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not isinstance(key, basestring) or not is_plain(item):
+                return False
+        return True
+    return False
+
 
 class Task(object):
     """
@@ -53,10 +97,77 @@ class Task(object):
     maker = None
     description = None
     name = interpolated('name')
+    # See declare():
+    inputs = interpolated('inputs')
+    outputs = interpolated('outputs')
+    _inputs = None
+    _outputs = None
+    after = None
+    # If true, the task is skipped when its fingerprint hasn't changed
+    # since it last ran (see fassembler.fingerprint):
+    incremental = False
+    # Interpolated attributes that freeze() leaves as templates,
+    # because their value depends on what run() does:
+    unfrozen_attributes = ()
+    # Attributes that bind the task to the run (see bind()):
+    bound_attributes = ('maker', 'environ', 'logger', 'config', 'project',
+                        'config_section')
+    # The names of the interpolated attributes that are already
+    # interpolated (see thaw()):
+    _frozen = frozenset()
 
     def __init__(self, name, stacklevel=1):
-        self.name = name
         self.position = self._stacklevel_position(stacklevel+1)
+        self.name = name
+        if self.position is not None:
+            self.precompile()
+
+    def precompile(self):
+        """
+        Parse the templates of all the interpolated attributes (the
+        ones set later are parsed as they are set).
+        """
+        for cls in self.__class__.__mro__:
+            for attr, descriptor in cls.__dict__.items():
+                if isinstance(descriptor, interpolated):
+                    value = getattr(self, '_' + attr, None)
+                    if value is not None:
+                        template_cache.precompile(
+                            value, name=descriptor.template_name(self))
+
+    def declare(self, inputs=None, outputs=None, after=None):
+        """
+        Declare what this task reads (``inputs``) and writes
+        (``outputs``), and which tasks must be run before it
+        (``after``, a list of task names or instances).
+
+        Inputs and outputs are lists of paths (relative to the base
+        path), ``config:section.option`` settings or ``prop:name``
+        build properties; they are interpolated.  A directory
+        overlaps everything inside it, and ``config:section`` the
+        options in that section.
+
+        With ``--task-jobs``, tasks that have declared anything may
+        run at the same time as other declared tasks they don't
+        overlap with.  Tasks that declare nothing always run in
+        order.  Returns the task, so you can use it inline in
+        ``Project.actions``.
+        """
+        if inputs is not None:
+            self.inputs = inputs
+        if outputs is not None:
+            self.outputs = outputs
+        if after is not None:
+            self.after = after
+        return self
+
+    def declares_dependencies(self):
+        """
+        True if this task has declared its inputs, outputs, or the
+        tasks it must run after.
+        """
+        return (self._inputs is not None or self._outputs is not None
+                or self.after is not None)
 
     @property
     def title(self):
@@ -113,6 +224,20 @@ class Task(object):
         ns['task'] = self
         return ns
 
+    def render_content(self, dest, get_content):
+        """
+        Returns ``get_content()``, recording the settings it reads as
+        the ones the file ``dest`` is rendered from (for ``fassembler
+        rerender``).
+        """
+        keys = start_recording()
+        try:
+            content = get_content()
+        finally:
+            stop_recording(keys)
+        rendered(dest, keys)
+        return content
+
     def copy_dir(self, *args, **kw):
         """
         Run maker.copy_dir, with interpolated arguments.
@@ -184,6 +309,61 @@ class Task(object):
     def iter_subtasks(self):
         return []
 
+    def fingerprint_data(self, fingerprints):
+        """
+        Returns a list of strings that should be part of this task's
+        fingerprint, besides its attributes and the files they refer
+        to.  ``fingerprints`` is the `TaskFingerprints` instance;
+        ``fingerprints.path_state(path)`` and
+        ``fingerprints.tree_state(dir)`` hash files and directories.
+        """
+        return []
+
+    def freeze(self):
+        """
+        Returns the state of this (bound) task for a build plan (see
+        `fassembler.plan`): a dict with the interpolated attributes
+        (``'interpolated'``), the ones left as templates
+        (``'templates'``) and the other simple attributes
+        (``'attributes'``).
+        """
+        state = {'interpolated': {}, 'templates': {}, 'attributes': {}}
+        for name in interpolated_names(self.__class__):
+            if not hasattr(self, '_' + name):
+                continue
+            raw_value = getattr(self, '_' + name)
+            if name not in self.unfrozen_attributes:
+                try:
+                    value = getattr(self, name)
+                except Exception, e:
+                    self.logger.debug('Cannot interpolate %s of task %s now: %s'
+                                      % (name, self.name, e))
+                else:
+                    if is_plain(value):
+                        state['interpolated'][name] = value
+                        continue
+            if is_plain(raw_value):
+                state['templates'][name] = raw_value
+        for name, value in self.__dict__.items():
+            if (name.startswith('_') or name in self.bound_attributes
+                or not is_plain(value)):
+                continue
+            state['attributes'][name] = value
+        return state
+
+    def thaw(self, state):
+        """
+        Restores the state ``freeze()`` returned.  The interpolated
+        attributes are not interpolated again.
+        """
+        for name, value in state['attributes'].items():
+            setattr(self, name, value)
+        for name, value in state['templates'].items():
+            setattr(self, '_' + name, value)
+        for name, value in state['interpolated'].items():
+            setattr(self, '_' + name, value)
+        self._frozen = set(state['interpolated'])
+
 class Script(Task):
     """
     Run a process/script
@@ -223,6 +403,9 @@ class Script(Task):
         if self.use_virtualenv:
             kw['script_abspath'] = self.venv_property('bin_path')
         kw['stdin'] = self.stdin
+        # The output isn't used, so there's no need to keep all of it
+        # in memory (make can print a lot):
+        kw.setdefault('log_output', True)
         self.maker.run_command(script, cwd=self.cwd, **kw)
 
 
@@ -237,17 +420,24 @@ class CopyDir(Task):
 
     source = interpolated('source')
     dest = interpolated('dest')
+    incremental = True
 
-    def __init__(self, name, source, dest, stacklevel=1, add_dest_to_svn=False):
+    def __init__(self, name, source, dest, stacklevel=1, add_dest_to_svn=False,
+                 link_mode=None):
         super(CopyDir, self).__init__(name, stacklevel=stacklevel+1)
         self.source = source
         self.dest = dest
         self.add_dest_to_svn = add_dest_to_svn
+        self.link_mode = link_mode
 
     def run(self):
         self.logger.info(
             'Copying %s to %s' % (self.source, self.dest))
-        self.copy_dir(self.source, self.dest, add_dest_to_svn=self.add_dest_to_svn)
+        self.copy_dir(self.source, self.dest, add_dest_to_svn=self.add_dest_to_svn,
+                      link_mode=self.link_mode)
+
+    def fingerprint_data(self, fingerprints):
+        return [fingerprints.tree_state(self.source)]
 
 class EnsureFile(Task):
     """
@@ -273,6 +463,7 @@ class EnsureFile(Task):
     dest = interpolated('dest')
     content = interpolated('content')
     content_path = interpolated('content_path')
+    incremental = True
 
     def __init__(self, name, dest, content=None, content_path=None, overwrite=True,
                  svn_add=False, executable=False, stacklevel=1,
@@ -294,8 +485,13 @@ class EnsureFile(Task):
         The content from self.content or self.content_path
         """
         if self.content_path:
-            tmpl = Template.from_filename(self.maker.path(self.content_path))
-            return self.interpolate(tmpl)
+            filename = self.maker.path(self.content_path)
+            f = open(filename, 'rb')
+            try:
+                content = f.read()
+            finally:
+                f.close()
+            return self.interpolate(template_cache.get(content, name=filename))
         else:
             return self.content
 
@@ -303,9 +499,22 @@ class EnsureFile(Task):
         if not self.overwrite and self.maker.exists(self.dest):
             self.logger.notify('File %s already exists; not overwriting' % self.dest)
             return
-        self.maker.ensure_file(self.dest, self.resolved_content, svn_add=self.svn_add,
+        content = self.render_content(self.dest, lambda: self.resolved_content)
+        self.maker.ensure_file(self.dest, content, svn_add=self.svn_add,
                                overwrite=self.force_overwrite, executable=self.executable)
 
+    def fingerprint_data(self, fingerprints):
+        return [self.resolved_content]
+
+    def freeze(self):
+        state = super(EnsureFile, self).freeze()
+        if self.content_path and 'content' not in self.unfrozen_attributes:
+            # The template file doesn't have to be there when the plan
+            # is run:
+            state['interpolated']['content'] = self.resolved_content
+            state['interpolated']['content_path'] = None
+        return state
+
 
 class EnsureSymlink(Task):
     """
@@ -321,6 +530,7 @@ class EnsureSymlink(Task):
 
     dest = interpolated('dest')
     source = interpolated('source')
+    incremental = True
 
     def __init__(self, name, source, dest, overwrite=True, stacklevel=1,
                  force_overwrite=False):
@@ -352,6 +562,8 @@ class EnsureDir(Task):
     """
 
     dest = interpolated('dest')
+    _outputs = ['{{task.dest}}']
+    incremental = True
 
     def __init__(self, name, dest, svn_add=True, stacklevel=1):
         super(EnsureDir, self).__init__(name, stacklevel=stacklevel+1)
@@ -386,6 +598,7 @@ class SvnCheckout(Task):
     dest = interpolated('dest')
     base_repository = interpolated('base_repository')
     on_create_set_props = interpolated('on_create_set_props')
+    _outputs = ['{{task.dest}}']
 
     def __init__(self, name, repository, dest, base_repository=None,
                  create_if_necessary=False, on_create_set_props=None, stacklevel=1):
@@ -593,9 +806,9 @@ never_create_virtualenv=False):
         if not self.different_python:
             props['virtualenv_lib_python'] = os.path.join(path, 'lib', 'python%s' % sys.version[:3])
         else:
-            proc = subprocess.Popen([self.different_python, '-V'],
-                                    stderr=subprocess.PIPE)
-            ver = proc.communicate()[1].strip()
+            stdout, stderr, returncode = self.maker.probe(self.different_python, '-V')
+            # (Python 3 prints its version on stdout)
+            ver = (stderr or stdout).strip()
             ver = ver.split()[1][:3]
             props['virtualenv_lib_python'] = os.path.join(path, 'lib', 'python%s' % ver[:3])
 
@@ -640,6 +853,8 @@ class SourceInstall(SvnCheckout):
     """
 
     checkout_name = interpolated('checkout_name')
+    # setup.py develop writes to the virtualenv, so this has to run in order:
+    _outputs = None
 
     def __init__(self, name, repository, checkout_name, stacklevel=1):
         self.checkout_name = checkout_name
@@ -659,6 +874,10 @@ class InstallPasteConfig(Task):
 
     template = interpolated('template')
     path = interpolated('path')
+    # The template can use any setting:
+    _inputs = ['config:', '{{task.path}}']
+    _outputs = ['etc/{{project.name}}/{{task.ininame or project.name}}.ini']
+    incremental = True
 
     description = """
     Install a Paste configuration file in
@@ -681,7 +900,7 @@ class InstallPasteConfig(Task):
         if self.template:
             self.maker.ensure_file(
                 dest,
-                self.template)
+                self.render_content(dest, lambda: self.template))
         else:
             self.copy_file(self.path, dest)
         self.logger.notify('Configuration written to %s' % dest)
@@ -693,6 +912,9 @@ class InstallPasteStartup(Task):
     """
 
     exe_dir = interpolated('exe_dir')
+    _inputs = ['config:']
+    _outputs = ['bin/start-{{project.name}}']
+    incremental = True
 
     def __init__(self, name='Install Paste startup script', exe_dir='{{env.base_path}}/{{project.name}}/src/{{project.name}}', stacklevel=1):
         super(InstallPasteStartup, self).__init__(name, stacklevel=stacklevel+1)
@@ -702,7 +924,7 @@ class InstallPasteStartup(Task):
         path = os.path.join('bin', 'start-'+self.project.name)
         self.maker.ensure_file(
             path,
-            self.content,
+            self.render_content(path, lambda: self.content),
             executable=True)
         self.logger.notify('Startup script written to %s' % path)
 
@@ -723,6 +945,9 @@ class InstallSupervisorConfig(Task):
     """
 
     script_name = interpolated('script_name')
+    _inputs = ['config:']
+    _outputs = ['{{task.conf_path}}', '{{env.var}}/logs/{{project.name}}']
+    incremental = True
 
     def __init__(self, name='Install supervisor startup script',
                  script_name='{{project.name}}', stacklevel=1):
@@ -736,7 +961,7 @@ class InstallSupervisorConfig(Task):
     def run(self):
         self.maker.ensure_file(
             self.conf_path,
-            self.content,
+            self.render_content(self.conf_path, lambda: self.content),
             executable=True)
         ## FIXME: is this really the proper place to be making a log directory?
         ## I don't really think so.
@@ -1025,6 +1250,7 @@ class SaveSetting(Task):
 class SaveURI(SaveSetting):
 
     project_name = interpolated('project_name')
+    _outputs = ['config:applications']
 
     def __init__(self, name='Save URI setting',
                  project_name='{{project.name}}',
@@ -1069,6 +1295,7 @@ class Patch(Task):
     files = interpolated('files')
     dest = interpolated('dest')
     strip = interpolated('strip')
+    incremental = True
 
     description = """
     Patch the files {{', '.join(task.files)}}
@@ -1165,17 +1392,21 @@ class InstallSpec(Task):
     """
 
     spec_filename = interpolated('spec_filename')
+    incremental = True
 
     def __init__(self, name, spec_filename, stacklevel=1):
         super(InstallSpec, self).__init__(name, stacklevel=stacklevel+1)
         self.spec_filename = spec_filename
 
-    def run(self):
+    @property
+    def use_pip(self):
         if self.config.has_option(self.project.name, 'use_pip'):
-            use_pip = asbool(self.config.get(self.project.name, 'use_pip'))
+            return asbool(self.config.get(self.project.name, 'use_pip'))
         else:
-            use_pip = asbool(self.config.getdefault('general', 'use_pip'))
-        if use_pip:
+            return asbool(self.config.getdefault('general', 'use_pip'))
+
+    def run(self):
+        if self.use_pip:
             self.run_pip()
             return
         context, commands = self.read_commands()
@@ -1188,6 +1419,15 @@ class InstallSpec(Task):
         for command, arg in extra_commands:
             command(context, arg)
 
+    def fingerprint_data(self, fingerprints):
+        # A recreated virtualenv needs everything installed again:
+        site_packages = os.path.join(self.venv_property('lib_python'), 'site-packages')
+        if os.path.isdir(site_packages):
+            installed = sorted(os.listdir(site_packages))
+        else:
+            installed = []
+        return ['use_pip=%s' % self.use_pip, 'site-packages=%s' % ' '.join(installed)]
+
     def run_pip(self):
         env = os.environ.copy()
         env['PIP_LOG_EXPLICIT_LEVELS'] = '1'
@@ -1392,11 +1632,14 @@ class InstallSpec(Task):
     def make_log_filter(self):
         context = []
         hanging_processing = []
+        # The info patterns win over the debug patterns:
+        levels = PatternFilter([(self.logger.INFO, self.log_filter_info_regexes),
+                                (self.logger.DEBUG, self.log_filter_debug_regexes)],
+                               default=self.logger.NOTIFY)
         def log_filter(line):
             """
             Filter the output of setup.py develop and easy_install
             """
-            level = self.logger.NOTIFY
             adjust = 0
             prefix = 'Processing dependencies for '
             if line.startswith(prefix):
@@ -1431,14 +1674,11 @@ class InstallSpec(Task):
                     context.pop()
                 context.append('searching')
                 adjust = -2
-            if not line.strip():
+            stripped = line.strip()
+            if stripped:
+                level = levels.level(stripped)
+            else:
                 level = self.logger.DEBUG
-            for regex in self.log_filter_debug_regexes:
-                if regex.search(line.strip()):
-                    level = self.logger.DEBUG
-            for regex in self.log_filter_info_regexes:
-                if regex.search(line.strip()):
-                    level = self.logger.INFO
             indent = len(context) * 2 + adjust
             line = ' '*indent + line
             if hanging_processing:
@@ -1556,6 +1796,7 @@ class SetDistutilsValue(Task):
     section = interpolated('section')
     key = interpolated('key')
     value = interpolated('value')
+    incremental = True
 
     def __init__(self, name, section, key, value, append=False, use_virtualenv=True, stacklevel=1):
         super(SetDistutilsValue, self).__init__(name, stacklevel=stacklevel+1)
@@ -1572,6 +1813,9 @@ class SetDistutilsValue(Task):
         if not self.maker.simulate:
             update_distutils_file(filename, self.section, self.key, self.value, self.logger, append=self.append)
 
+    def fingerprint_data(self, fingerprints):
+        return [fingerprints.path_state(self.distutils_cfg)]
+
     @property
     def distutils_cfg(self):
         if self._distutils_filename is None:
@@ -1661,14 +1905,14 @@ class SaveCabochonSubscriber(Task):
         else:
             f.close()
         
-        f = open(cfg_filename, "w")
+        lines = []
         for event_type in subscribers:
             for subscriber, critical in subscribers[event_type]:
                 if critical is None:
-                    f.write("%s %s\n" % (event_type, subscriber))
+                    lines.append("%s %s\n" % (event_type, subscriber))
                 else:
-                    f.write("%s %s %s\n" % (event_type, subscriber, str(critical)))
-        f.close()
+                    lines.append("%s %s %s\n" % (event_type, subscriber, str(critical)))
+        write_file(cfg_filename, ''.join(lines))
 
 
 class InstallTarball(Task):
@@ -1676,6 +1920,7 @@ class InstallTarball(Task):
     dest_path = interpolated('dest_path')
     _tarball_url = ''
     _src_name = ''
+    incremental = True
 
     description = """
     Install {{task._src_name}} into {{task.dest_path}}.
@@ -1703,31 +1948,19 @@ class InstallTarball(Task):
             return
         url = self._tarball_url
         tmp_fn = os.path.abspath(os.path.basename(url))
-        delete_tmp_fn = False
-        try:
-            if os.path.exists(tmp_fn):
-                self.logger.notify('Source file %s already exists' % tmp_fn)
-            else:
-                self.logger.notify('Downloading %s to %s' % (url, tmp_fn))
-                if not self.maker.simulate:
-                    self.maker.retrieve(url, tmp_fn)
-            self.maker.ensure_dir(os.path.dirname(self.dest_path))
-            if tmp_fn.endswith('gz'):
-                tarflags = 'zfx'
-            elif tmp_fn.endswith('bz2'):
-                tarflags = 'jfx'
-            elif tmp_fn.endswith('tar'):
-                tarflags = 'fx'
-            else:
-                raise Exception("Don't know how to untar file %r" % tmp_fn)
-            self.maker.run_command(
-                'tar', tarflags, tmp_fn,
-                cwd=os.path.dirname(self.dest_path))
-            self.post_unpack_hook()
-            delete_tmp_fn = True
-        finally:
-            if delete_tmp_fn and os.path.exists(tmp_fn):
-                os.unlink(tmp_fn)
+        if os.path.exists(tmp_fn):
+            self.logger.notify('Source file %s already exists' % tmp_fn)
+            source = tmp_fn
+        else:
+            # Unpacked while it is downloaded:
+            self.logger.notify('Downloading %s' % url)
+            source = url
+        self.maker.ensure_dir(os.path.dirname(self.dest_path))
+        if not self.maker.simulate:
+            self.maker.extract_tarball(source, os.path.dirname(self.dest_path))
+        self.post_unpack_hook()
+        if source == tmp_fn:
+            os.unlink(tmp_fn)
 
 
 class Log(Task):
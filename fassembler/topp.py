@@ -92,6 +92,8 @@ class EnvironRefresh(tasks.Task):
 class EnsureAdminFile(tasks.EnsureFile):
 
     password = ''
+    # The content depends on the password run() finds:
+    unfrozen_attributes = ['content']
     
     def __init__(self, name):
         super(EnsureAdminFile, self).__init__(
@@ -13,6 +13,8 @@ import string
 class EnsureHtpasswdFile(tasks.EnsureFile):
 
     crypted_password = ''
+    # The content depends on the password run() finds:
+    unfrozen_attributes = ['content']
     def __init__(self, name):
         super(EnsureHtpasswdFile, self).__init__(
             name, '{{env.config.get("general", "var")}}/erroreater/developers.htpasswd',
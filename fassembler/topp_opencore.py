@@ -184,24 +184,12 @@ class GetBundleTarball(tasks.Task):
         else:
             self.logger.info('No tarball-id.txt file in %s' % tarball_id_fn)
         url = self.interpolate('{{config.opencore_bundle_tar_dir}}/openplans-bundle-{{config.opencore_bundle_name}}-%s.tar.bz2' % latest_id)
-        tmp_fn = os.path.abspath(os.path.basename(url))
-        self.logger.notify('Downloading tarball from %s to %s' % (url, tmp_fn))
-        delete_tmp_fn = False
-        try:
-            if not self.maker.simulate:
-                self.maker.retrieve(url, tmp_fn)
-            self.maker.ensure_dir(self.dest)
-            self.logger.notify('Unpacking into %s' % self.dest)
-            ## FIXME: is it really okay just to unpack right over whatever might already be there?
-            ## Should we warn or something?
-            self.maker.run_command(
-                'tar', 'jfx', tmp_fn,
-                cwd=self.dest)
-            delete_tmp_fn = True
-        finally:
-            if delete_tmp_fn and os.path.exists(tmp_fn):
-                self.logger.info('Deleting %s' % tmp_fn)
-                os.unlink(tmp_fn) 
+        self.maker.ensure_dir(self.dest)
+        self.logger.notify('Downloading tarball from %s and unpacking it into %s' % (url, self.dest))
+        ## FIXME: is it really okay just to unpack right over whatever might already be there?
+        ## Should we warn or something?
+        if not self.maker.simulate:
+            self.maker.extract_tarball(url, self.dest)
 
 
 class SymlinkProducts(tasks.Task):
@@ -312,7 +300,7 @@ class PlaceZopeConfig(ZopeConfigTask):
                 node.firstChild.data = unicode(opencore_site_title)
             elif name == u'email_from_address':
                 node.firstChild.data = unicode(email_from_address)
-        doc.writexml(open(properties_path, 'w'))
+        util.write_file(properties_path, doc.toxml('utf-8'))
 
         
         propertiestool_path = '%s/propertiestool.xml' % self.build_profile_path
@@ -325,7 +313,7 @@ class PlaceZopeConfig(ZopeConfigTask):
             if name == u'mailing_list_fqdn':
                 node.firstChild.data = unicode(mailing_list_fqdn)
             
-        doc.writexml(open(propertiestool_path, 'w'))
+        util.write_file(propertiestool_path, doc.toxml('utf-8'))
 
 
 class SymlinkZopeConfig(ZopeConfigTask):
@@ -576,9 +564,7 @@ class PatchTwill(tasks.Task):
 
         lines = [ line for line in lines if "print 'AT LINE:'" not in line ]
 
-        parse = file(filename, 'w')
-        print >> parse, ''.join(lines)
-        parse.close()
+        util.write_file(filename, ''.join(lines) + '\n')
 
 
 class PatchFive(tasks.Patch):
@@ -6,7 +6,6 @@ import MySQLdb
 import os
 from fassembler.project import Project, Setting
 from fassembler import tasks
-from subprocess import Popen, PIPE
 from fassembler.apache import ApacheMixin, CheckApache
 
 class CheckPHP(tasks.Task):
@@ -20,7 +19,7 @@ class CheckPHP(tasks.Task):
         self.php_cgi_exec = php_cgi_exec
 
     def run(self):
-        compiled_in_modules = set(Popen([self.php_cgi_exec, '-m'], stdout=PIPE).communicate()[0].split('\n')[1:])
+        compiled_in_modules = set(self.maker.probe(self.php_cgi_exec, '-m')[0].split('\n')[1:])
         missing_required = []
         for m in self.required_modules:
             if m not in compiled_in_modules:
@@ -1,4 +1,20 @@
+import errno
+import os
+import shutil
+import stat
 import subprocess
+import sys
+import thread
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    # The backport of os.scandir, if it is installed
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 def asbool(obj):
     if isinstance(obj, (str, unicode)):
@@ -22,3 +38,249 @@ def popen(args, raise_on_returncode=True, **kw):
         raise OSError("Running %r failed.\nOutput:\n%s" %
                       (' '.join(args), stderr or stdout))
     return proc.returncode, stdout, stderr
+
+# How often (in seconds) ordered_map's calling thread wakes up while
+# waiting; an untimed wait would keep it from seeing ^C:
+ordered_map_interval = 0.1
+
+def ordered_map(func, items, jobs, consume):
+    """
+    Calls ``func(item)`` for all the items, in up to ``jobs``
+    threads, and ``consume(result)`` in the calling thread, in the
+    order of ``items``.  Only a few results are computed ahead of
+    ``consume``.  If ``func`` raises an exception, it is raised
+    (in the calling thread) in place of calling ``consume`` for that
+    item, and no more items are started.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            consume(func(item))
+        return
+    window = jobs * 2
+    state = {'next': 0, 'consumed': 0, 'stop': False}
+    results = {}
+    condition = threading.Condition()
+    def worker():
+        while 1:
+            condition.acquire()
+            try:
+                while (not state['stop'] and state['next'] < len(items)
+                       and state['next'] >= state['consumed'] + window):
+                    condition.wait()
+                if state['stop'] or state['next'] >= len(items):
+                    return
+                index = state['next']
+                state['next'] += 1
+            finally:
+                condition.release()
+            try:
+                result = (True, func(items[index]))
+            except:
+                result = (False, sys.exc_info())
+            condition.acquire()
+            try:
+                results[index] = result
+                condition.notifyAll()
+            finally:
+                condition.release()
+    threads = []
+    for i in range(min(jobs, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    interrupted = False
+    try:
+        try:
+            for index in range(len(items)):
+                condition.acquire()
+                try:
+                    while index not in results:
+                        condition.wait(ordered_map_interval)
+                    ok, result = results.pop(index)
+                    state['consumed'] = index + 1
+                    condition.notifyAll()
+                finally:
+                    condition.release()
+                if not ok:
+                    raise result[0], result[1], result[2]
+                consume(result)
+        except KeyboardInterrupt:
+            interrupted = True
+            raise
+    finally:
+        condition.acquire()
+        try:
+            state['stop'] = True
+            condition.notifyAll()
+        finally:
+            condition.release()
+        if not interrupted:
+            for thread in threads:
+                # (Each finishes the item it is on)
+                while thread.isAlive():
+                    thread.join(ordered_map_interval)
+
+# Files written with write_file() that haven't been synced to disk yet:
+_unsynced = set()
+_unsynced_lock = threading.Lock()
+
+def write_file(filename, content):
+    """
+    Writes ``content`` to ``filename`` atomically: it is written to a
+    temporary file next to ``filename``, which is then renamed over
+    it, so an interrupted build never leaves a truncated file behind.
+    The permissions of an existing file are kept, and if
+    ``filename`` is a symlink the file it points to is replaced.
+
+    The file isn't synced to disk right away; ``sync_files()`` does
+    that for all the files written since it was last called.
+    """
+    filename = os.path.realpath(filename)
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        mode = None
+    tmp_filename = '%s.%s-%s.tmp' % (filename, os.getpid(), thread.get_ident())
+    f = open(tmp_filename, 'wb')
+    try:
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        if mode is not None:
+            os.chmod(tmp_filename, mode)
+        os.rename(tmp_filename, filename)
+    except:
+        exc_info = sys.exc_info()
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    _unsynced_lock.acquire()
+    try:
+        _unsynced.add(filename)
+    finally:
+        _unsynced_lock.release()
+
+def sync_files():
+    """
+    Syncs the files written with ``write_file()``, and the
+    directories they are in, to disk.  This is called at the end of
+    every task (and when a build finishes), not after every file,
+    because syncing is slow.
+    """
+    _unsynced_lock.acquire()
+    try:
+        filenames = list(_unsynced)
+        _unsynced.clear()
+    finally:
+        _unsynced_lock.release()
+    dirs = set()
+    for filename in filenames:
+        _fsync(filename)
+        dirs.add(os.path.dirname(filename))
+    for dir in dirs:
+        _fsync(dir)
+
+def _fsync(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Removed since it was written
+        return
+    try:
+        try:
+            os.fsync(fd)
+        except OSError:
+            # Some filesystems can't sync directories
+            pass
+    finally:
+        os.close(fd)
+
+# The ioctl that clones a file's data (from linux/fs.h):
+FICLONE = 0x40049409
+
+def reflink(src, dest):
+    """
+    Makes ``dest`` a copy-on-write clone of ``src``, which shares the
+    data of ``src`` on disk until one of them is changed.  Only some
+    filesystems on Linux (like Btrfs and XFS) support this; if it
+    isn't possible, OSError or IOError is raised and ``dest`` is not
+    created.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+    src_f = open(src, 'rb')
+    try:
+        fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0666)
+        try:
+            try:
+                fcntl.ioctl(fd, FICLONE, src_f.fileno())
+            finally:
+                os.close(fd)
+            shutil.copymode(src, dest)
+        except:
+            exc_info = sys.exc_info()
+            os.unlink(dest)
+            raise exc_info[0], exc_info[1], exc_info[2]
+    finally:
+        src_f.close()
+
+def list_dir(path):
+    """
+    Returns ``(dirnames, filenames, links)`` for the directory
+    ``path``: the names of the directories (including symlinks to
+    directories) and of everything else in it, in directory order, and
+    the set of dirnames that are symlinks.  With the ``scandir``
+    package the types come from the directory listing itself;
+    otherwise each entry is ``lstat``'ed once (and only symlinks are
+    ``stat``'ed as well).
+    """
+    dirnames = []
+    filenames = []
+    links = set()
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                dirnames.append(entry.name)
+                if entry.is_symlink():
+                    links.add(entry.name)
+            else:
+                filenames.append(entry.name)
+        return dirnames, filenames, links
+    for name in os.listdir(path):
+        try:
+            mode = os.lstat(os.path.join(path, name)).st_mode
+        except OSError:
+            # Removed in the meantime
+            filenames.append(name)
+            continue
+        if stat.S_ISDIR(mode):
+            dirnames.append(name)
+        elif stat.S_ISLNK(mode) and os.path.isdir(os.path.join(path, name)):
+            dirnames.append(name)
+            links.add(name)
+        else:
+            filenames.append(name)
+    return dirnames, filenames, links
+
+def walk(top):
+    """
+    Like ``os.walk(top)`` (top-down, not descending into symlinks to
+    directories), but using `list_dir`, which takes about half the
+    system calls.  Like with ``os.walk``, removing names from
+    ``dirnames`` (in place) keeps it from descending into those
+    directories.  Directories that can't be listed are skipped.
+    """
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            dirnames, filenames, links = list_dir(dirpath)
+        except OSError:
+            continue
+        yield dirpath, dirnames, filenames
+        for name in reversed(dirnames):
+            if name not in links:
+                stack.append(os.path.join(dirpath, name))
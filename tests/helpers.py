@@ -0,0 +1,150 @@
+"""
+What the tests share: `BuildTestCase` sets up a base directory with a
+`Maker`, an `Environment` and a configuration, like ``fassembler``
+does, and removes it afterwards; `StandInServer` serves files over
+HTTP.
+"""
+
+import BaseHTTPServer
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from cmdutils.log import Logger
+from fassembler.config import ConfigParser
+from fassembler.environ import Environment
+from fassembler.filemaker import Maker
+from fassembler.manifest import content_hash
+
+class BuildTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp(prefix='fassembler-test-')
+        os.makedirs(os.path.join(self.base, 'etc'))
+        self.write('etc/build.ini', '[general]\nbase_port = 9000\nvar = %s/var\n' % self.base)
+        self.logger = Logger([])
+        self.maker = self.make_maker()
+        self.environ = Environment(self.base, logger=self.logger)
+        self.environ.maker = self.maker
+        self.config = ConfigParser()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def make_maker(self, **kw):
+        kw.setdefault('interactive', False)
+        kw.setdefault('download_cache', os.path.join(self.base, 'cache'))
+        return Maker(self.base, self.logger, **kw)
+
+    def path(self, path):
+        return os.path.join(self.base, path)
+
+    def write(self, path, content):
+        path = self.path(path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        return path
+
+    def read(self, path):
+        f = open(self.path(path), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+class StandInServer(object):
+    """
+    A local HTTP server that serves ``files`` (``{path: content}``),
+    with ETags, conditional requests and ``Range`` requests, for
+    testing downloads.  The requests it gets are kept in
+    ``requests``, as dicts of the path and the headers that matter.
+
+    ``cut`` responses (after that, no more) are cut off halfway
+    through, and then the files in ``after_cut`` replace the served
+    ones; if ``status`` is set, every request gets that status.  If
+    ``validators`` is false, responses have no ETag (so they can't be
+    resumed).
+    """
+
+    def __init__(self, files=None):
+        self.files = files or {}
+        self.requests = []
+        self.cut = 0
+        self.after_cut = {}
+        self.status = None
+        self.validators = True
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.0'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self)
+
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def etag(self, path):
+        return '"%s"' % content_hash(self.files[path])
+
+    def handle(self, request):
+        headers = request.headers
+        self.requests.append({
+            'path': request.path,
+            'range': headers.get('Range'),
+            'if-none-match': headers.get('If-None-Match'),
+            })
+        if self.status is not None:
+            request.send_response(self.status)
+            request.end_headers()
+            return
+        if request.path not in self.files:
+            request.send_response(404)
+            request.end_headers()
+            return
+        content = self.files[request.path]
+        etag = None
+        if self.validators:
+            etag = self.etag(request.path)
+        if etag and headers.get('If-None-Match') == etag:
+            request.send_response(304)
+            request.end_headers()
+            return
+        start = 0
+        if etag and headers.get('Range') and headers.get('If-Range') == etag:
+            start = int(headers['Range'].split('=')[1].rstrip('-'))
+            request.send_response(206)
+            request.send_header('Content-Range', 'bytes %s-%s/%s'
+                                % (start, len(content) - 1, len(content)))
+        else:
+            request.send_response(200)
+        if etag:
+            request.send_header('ETag', etag)
+        request.send_header('Content-Length', str(len(content) - start))
+        request.end_headers()
+        body = content[start:]
+        if self.cut:
+            self.cut -= 1
+            request.wfile.write(body[:len(body) // 2])
+            request.wfile.flush()
+            request.connection.shutdown(2)
+            self.files.update(self.after_cut)
+            return
+        request.wfile.write(body)
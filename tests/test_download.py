@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+from fassembler.download import DownloadError, url_key
+from fassembler.manifest import content_hash
+from tests.helpers import BuildTestCase, StandInServer
+
+class TestDownloadCache(BuildTestCase):
+
+    content = ''.join([chr(i % 251) for i in range(300 * 1024)])
+
+    def setUp(self):
+        BuildTestCase.setUp(self)
+        self.server = StandInServer({'/file.tgz': self.content})
+        self.url = self.server.url + '/file.tgz'
+        self.cache = self.path('cache')
+
+    def tearDown(self):
+        self.server.stop()
+        BuildTestCase.tearDown(self)
+
+    def retrieve(self, url=None, name='out.tgz', maker=None):
+        # Each retrieve is like a new run of fassembler:
+        maker = maker or self.make_maker(download_cache=self.cache)
+        maker.retrieve(url or self.url, self.path(name))
+        return self.read(name)
+
+    def cache_files(self, subdir):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.cache, subdir)):
+            found.extend(filenames)
+        return found
+
+    def test_download(self):
+        self.assertEqual(self.retrieve(), self.content)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(self.cache_files('objects')), 1)
+        self.assertEqual(self.cache_files('partial'), [])
+
+    def test_cache_hit_revalidates(self):
+        self.retrieve()
+        self.assertEqual(self.retrieve(name='again.tgz'), self.content)
+        self.assertEqual(len(self.server.requests), 2)
+        # A conditional request, answered with 304:
+        self.assertEqual(self.server.requests[1]['if-none-match'],
+                         self.server.etag('/file.tgz'))
+
+    def test_changed_file_is_downloaded_once(self):
+        self.retrieve()
+        self.server.files['/file.tgz'] = 'new content'
+        self.assertEqual(self.retrieve(), 'new content')
+        # The reply to the conditional request was used:
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_hash_hit_without_request(self):
+        self.retrieve()
+        md5_url = '%s#md5=%s' % (self.url, content_hash(self.content))
+        self.assertEqual(self.retrieve(md5_url), self.content)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_md5_mismatch(self):
+        bad_url = '%s#md5=%s' % (self.url, '0' * 32)
+        self.assertRaises(DownloadError, self.retrieve, bad_url)
+        self.assert_(not os.path.exists(self.path('out.tgz')))
+        self.assertEqual(self.cache_files('objects'), [])
+        self.assertEqual(self.cache_files('partial'), [])
+
+    def test_resume_after_cut_off(self):
+        self.server.cut = 1
+        self.assertEqual(self.retrieve(), self.content)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[0]['range'], None)
+        self.assertEqual(self.server.requests[1]['range'],
+                         'bytes=%s-' % (len(self.content) // 2))
+
+    def test_resume_without_validators(self):
+        self.server.validators = False
+        self.server.cut = 1
+        self.assertEqual(self.retrieve(), self.content)
+        # The whole file was requested again, and its start compared:
+        self.assertEqual(self.server.requests[1]['range'], None)
+
+    def test_changed_without_validators(self):
+        self.server.validators = False
+        self.server.cut = 1
+        self.server.after_cut = {'/file.tgz': 'x' + self.content[1:]}
+        self.assertRaises(DownloadError, self.retrieve)
+        self.assert_(not os.path.exists(self.path('out.tgz')))
+        self.assertEqual(self.cache_files('objects'), [])
+
+    def test_resume_in_a_later_run(self):
+        maker = self.make_maker(download_cache=self.cache)
+        self.server.cut = maker.downloads.retries + 1
+        self.assertRaises(DownloadError, self.retrieve, maker=maker)
+        self.assertEqual(len(self.cache_files('partial')), 2)
+        del self.server.requests[:]
+        self.assertEqual(self.retrieve(), self.content)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assert_(self.server.requests[0]['range'])
+        self.assertEqual(self.cache_files('partial'), [])
+
+    def test_server_errors_use_the_cache(self):
+        self.retrieve()
+        self.server.status = 503
+        self.assertEqual(self.retrieve(name='again.tgz'), self.content)
+
+    def test_missing_file(self):
+        self.assertRaises(IOError, self.retrieve, self.server.url + '/nothing.tgz')
+
+    def test_offline_uses_the_cache(self):
+        self.retrieve()
+        self.server.stop()
+        try:
+            self.assertEqual(self.retrieve(name='again.tgz'), self.content)
+        finally:
+            self.server = StandInServer()
+
+    def test_lock(self):
+        maker = self.make_maker(download_cache=self.cache)
+        # As if another process was downloading the file:
+        lock = maker.downloads.lock(url_key(self.url))
+        thread = threading.Thread(target=self.retrieve)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            time.sleep(0.3)
+            self.assert_(thread.isAlive())
+            self.assertEqual(self.server.requests, [])
+        finally:
+            maker.downloads.unlock(lock)
+        thread.join(10)
+        self.assert_(not thread.isAlive())
+        self.assertEqual(self.read('out.tgz'), self.content)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_no_cache(self):
+        maker = self.make_maker(download_cache=None)
+        self.assertEqual(self.retrieve(maker=maker), self.content)
+        self.assertEqual(self.retrieve(maker=maker, name='again.tgz'), self.content)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assert_(not os.path.exists(self.cache))
+
+    def test_no_cache_md5_mismatch(self):
+        maker = self.make_maker(download_cache=None)
+        bad_url = '%s#md5=%s' % (self.url, '0' * 32)
+        self.assertRaises(DownloadError, self.retrieve, bad_url, maker=maker)
+        self.assert_(not os.path.exists(self.path('out.tgz')))
@@ -0,0 +1,44 @@
+from fassembler.config import ConfigParser
+from fassembler.environ import Environment
+from tests.helpers import BuildTestCase
+
+class TestConcurrentSave(BuildTestCase):
+
+    def worker_environ(self):
+        # Like a --jobs worker: it read build.ini when it started
+        environ = Environment(self.base, logger=self.logger)
+        environ.concurrent = True
+        environ.config
+        return environ
+
+    def saved(self):
+        config = ConfigParser()
+        config.read([self.environ.config_filename])
+        return dict([(option, config.get('general', option))
+                     for option in config.options('general')])
+
+    def test_keeps_what_others_saved(self):
+        self.write('etc/build.ini', '[general]\nbase_port = 9000\nold = 1\nstale = 1\n')
+        first = self.worker_environ()
+        second = self.worker_environ()
+        second.config.set('general', 'stale', '2')
+        second.config.set('general', 'new', 'second')
+        second.config.remove_option('general', 'old')
+        second.save()
+        first.config.set('general', 'mine', 'first')
+        first.save()
+        self.assertEqual(self.saved(), {'base_port': '9000', 'stale': '2',
+                                        'new': 'second', 'mine': 'first'})
+        # The first worker now has what the second one saved:
+        self.assertEqual(first.config.get('general', 'stale'), '2')
+
+    def test_own_changes_win(self):
+        self.write('etc/build.ini', '[general]\nbase_port = 9000\nport = 1\nold = 1\n')
+        first = self.worker_environ()
+        second = self.worker_environ()
+        second.config.set('general', 'port', '2')
+        second.save()
+        first.config.set('general', 'port', '3')
+        first.config.remove_option('general', 'old')
+        first.save()
+        self.assertEqual(self.saved(), {'base_port': '9000', 'port': '3'})
@@ -0,0 +1,89 @@
+from fassembler import tasks
+from fassembler.project import Project
+from tests.helpers import BuildTestCase
+
+class Count(tasks.Task):
+    """
+    Counts its runs in ``runs`` (which isn't part of its fingerprint;
+    ``value`` is).
+    """
+
+    value = tasks.interpolated('value')
+
+    def __init__(self, name, runs, value='', incremental=True):
+        super(Count, self).__init__(name)
+        self._runs = runs
+        self.value = value
+        self.incremental = incremental
+
+    def run(self):
+        self._runs.append(self.name)
+
+class TestFingerprints(BuildTestCase):
+
+    def run_project(self, *actions):
+        class P(Project):
+            name = 'p'
+        P.actions = list(actions)
+        if not self.config.has_section('p'):
+            self.config.add_section('p')
+        P('p', self.maker, self.environ, self.logger, self.config).run()
+
+    def test_unchanged_tasks_are_skipped(self):
+        runs = []
+        self.config.add_section('p')
+        self.config.set('p', 'port', '1')
+        actions = [Count('a', runs, '{{config.port}}'), Count('b', runs)]
+        self.run_project(*actions)
+        self.run_project(*actions)
+        self.assertEqual(runs, ['a', 'b'])
+
+    def test_change_runs_the_task_and_the_tasks_after_it(self):
+        runs = []
+        self.config.add_section('p')
+        self.config.set('p', 'port', '1')
+        actions = [Count('first', runs), Count('a', runs, '{{config.port}}'), Count('b', runs)]
+        self.run_project(*actions)
+        del runs[:]
+        self.config.set('p', 'port', '2')
+        self.run_project(*actions)
+        self.assertEqual(runs, ['a', 'b'])
+
+    def test_file_contents_count(self):
+        runs = []
+        self.write('src.txt', 'one')
+        actions = [Count('a', runs, self.path('src.txt'))]
+        self.run_project(*actions)
+        self.write('src.txt', 'two')
+        self.run_project(*actions)
+        self.assertEqual(runs, ['a', 'a'])
+
+    def test_tasks_after_a_task_that_always_runs_are_not_skipped(self):
+        # Like an incremental task after SvnCheckout, which may
+        # change the tree without changing its own attributes:
+        runs = []
+        actions = [Count('checkout', runs, incremental=False), Count('build', runs)]
+        self.run_project(*actions)
+        self.run_project(*actions)
+        self.assertEqual(runs, ['checkout', 'build', 'checkout', 'build'])
+
+    def test_script_is_not_incremental(self):
+        self.assert_(not tasks.Script.incremental)
+
+    def test_force_task(self):
+        runs = []
+        actions = [Count('a', runs), Count('b', runs)]
+        self.run_project(*actions)
+        self.maker.force_tasks = ['p.b']
+        self.run_project(*actions)
+        self.assertEqual(runs, ['a', 'b', 'b'])
+
+    def test_failed_task_runs_again(self):
+        runs = []
+        class Fail(Count):
+            def run(self):
+                Count.run(self)
+                raise ValueError('failed')
+        self.assertRaises(ValueError, self.run_project, Count('a', runs), Fail('b', runs))
+        self.run_project(Count('a', runs), Count('b', runs))
+        self.assertEqual(runs, ['a', 'b', 'b'])
@@ -0,0 +1,116 @@
+import os
+from fassembler.manifest import Manifest, UNKNOWN_TEMPLATE, content_hash
+from tests.helpers import BuildTestCase
+
+class TestManifestMigration(BuildTestCase):
+
+    template = 'port={{port}}\n'
+
+    def generated(self, name, content, orig=None, base=None):
+        """
+        A generated file as older versions of fassembler left it,
+        with ``.orig`` and ``.base`` files next to it.
+        """
+        path = self.write(name, content)
+        if orig is not None:
+            self.write(os.path.basename(self.maker._orig_filename(path)), orig)
+        if base is not None:
+            self.write(os.path.basename(self.maker._base_filename(path)), base)
+        return path
+
+    def sidecars(self, path):
+        return [filename for filename in (self.maker._orig_filename(path),
+                                          self.maker._base_filename(path))
+                if os.path.exists(filename)]
+
+    def test_both(self):
+        path = self.generated('f.conf', 'port=1\n', orig=self.template, base='port=1\n')
+        manifest = self.maker.manifest
+        entry = manifest.get(path)
+        self.assertEqual(entry.template_hash, content_hash(self.template))
+        self.assertEqual(entry.content_hash, content_hash('port=1\n'))
+        self.assert_(manifest.is_unchanged(path))
+        self.assert_(manifest.template_is_unchanged(path, self.template))
+        self.assertEqual(self.sidecars(path), [])
+
+    def test_edited(self):
+        path = self.generated('f.conf', 'port=2\n', orig=self.template, base='port=1\n')
+        self.assert_(not self.maker.manifest.is_unchanged(path))
+
+    def test_orig_only(self):
+        path = self.generated('f.conf', 'port=1\n', orig=self.template)
+        manifest = self.maker.manifest
+        self.assert_(manifest.template_is_unchanged(path, self.template))
+        # Without a .base it isn't known what was written:
+        self.assert_(not manifest.is_unchanged(path))
+        self.assertEqual(self.sidecars(path), [])
+
+    def test_base_only(self):
+        path = self.generated('f.conf', 'port=1\n', base='port=1\n')
+        manifest = self.maker.manifest
+        self.assertEqual(manifest.get(path).template_hash, UNKNOWN_TEMPLATE)
+        self.assert_(manifest.is_unchanged(path))
+        self.assert_(not manifest.template_is_unchanged(path, self.template))
+        self.assertEqual(self.sidecars(path), [])
+
+    def test_nothing_to_migrate(self):
+        path = self.write('f.conf', 'port=1\n')
+        self.assertEqual(self.maker.manifest.get(path), None)
+
+    def test_saved(self):
+        paths = [self.generated('a.conf', 'port=1\n', orig=self.template, base='port=1\n'),
+                 self.generated('b.conf', 'port=1\n', orig=self.template),
+                 self.generated('c.conf', 'port=1\n', base='port=1\n')]
+        manifest = self.maker.manifest
+        before = [manifest.get(path) for path in paths]
+        # A new run reads the manifest file:
+        reloaded = Manifest(self.maker)
+        for path, entry in zip(paths, before):
+            self.assertEqual(
+                (reloaded.get(path).template_hash, reloaded.get(path).content_hash),
+                (entry.template_hash, entry.content_hash))
+
+    def test_simulate(self):
+        maker = self.make_maker(simulate=True)
+        path = self.generated('f.conf', 'port=1\n', orig=self.template, base='port=1\n')
+        self.assert_(maker.manifest.is_unchanged(path))
+        self.assertEqual(len(self.sidecars(path)), 2)
+        self.assert_(not os.path.exists(maker.manifest.filename))
+
+class TestManifestCopy(BuildTestCase):
+
+    def test_copy_file_records_template(self):
+        src = self.write('src/f.conf_tmpl', 'port={{port}}\n')
+        self.maker.copy_file(src, self.path('dest/f.conf'), template_vars={'port': 1})
+        dest = self.path('dest/f.conf')
+        self.assertEqual(self.read('dest/f.conf'), 'port=1\n')
+        manifest = Manifest(self.maker)
+        self.assert_(manifest.is_unchanged(dest))
+        self.assert_(manifest.template_is_unchanged(dest, 'port={{port}}\n'))
+        self.assertEqual(os.listdir(self.path('dest')), ['f.conf'])
+
+class TestManifestProcesses(BuildTestCase):
+
+    def test_append_while_compacting(self):
+        manifest = Manifest(self.maker)
+        manifest.set(self.path('start'), None, '')
+        pid = os.fork()
+        if not pid:
+            # Like a --jobs worker: records files in the same log
+            status = 1
+            try:
+                worker = Manifest(self.maker)
+                for i in range(1000):
+                    # Replaced lines, so that the log is rewritten often
+                    for content in 'abc':
+                        worker.set(self.path('pad'), None, content)
+                    worker.set(self.path('k%s' % i), None, '')
+                status = 0
+            finally:
+                os._exit(status)
+        while not os.waitpid(pid, os.WNOHANG)[0]:
+            Manifest(self.maker).load()
+        manifest = Manifest(self.maker)
+        manifest.load()
+        missing = [i for i in range(1000) if 'k%s' % i not in manifest.entries]
+        self.assertEqual(missing, [])
@@ -0,0 +1,39 @@
+import unittest
+from fassembler.namespace import Namespace, OverlayDict
+
+class TestOverlay(unittest.TestCase):
+
+    def test_overlay_dict(self):
+        parent = {'a': 1, 'b': 2}
+        overlay = OverlayDict(parent)
+        overlay['b'] = 3
+        overlay['c'] = 4
+        self.assertEqual((overlay['a'], overlay['b'], overlay['c']), (1, 3, 4))
+        self.assertEqual(sorted(overlay.items()), [('a', 1), ('b', 3), ('c', 4)])
+        self.assert_('a' in overlay and 'd' not in overlay)
+        self.assertEqual(overlay.get('d', 5), 5)
+        self.assertRaises(KeyError, lambda: overlay['d'])
+        self.assertEqual(parent, {'a': 1, 'b': 2})
+        # Changes to the parent show through:
+        parent['d'] = 6
+        self.assertEqual(overlay['d'], 6)
+        copy = overlay.copy()
+        copy['a'] = 7
+        self.assertEqual(overlay['a'], 1)
+        del overlay['b']
+        self.assertEqual(overlay['b'], 2)
+
+    def test_templates_dont_change_the_namespace(self):
+        ns = Namespace('test')
+        ns['name'] = 'x'
+        task_ns = ns.overlay()
+        task_ns['task'] = 'T'
+        result = task_ns.interpolate(
+            '{{py:z = name * 2}}{{for i in range(2)}}{{i}}{{endfor}}{{z}}{{task}}{{self}}',
+            self='S')
+        self.assertEqual(result, '01xxTS')
+        for key in 'z', 'i', 'self':
+            self.assert_(key not in task_ns)
+            self.assert_(key not in ns)
+        self.assert_('task' not in ns)
+        self.assertEqual(task_ns['name'], 'x')
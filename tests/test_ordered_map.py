@@ -0,0 +1,76 @@
+import thread
+import threading
+import time
+import unittest
+from fassembler.util import ordered_map
+
+class TestOrderedMap(unittest.TestCase):
+
+    def test_results_in_order(self):
+        def func(item):
+            # The later items finish first
+            time.sleep((10 - item) * 0.005)
+            return item * 2
+        results = []
+        ordered_map(func, range(10), 4, results.append)
+        self.assertEqual(results, [item * 2 for item in range(10)])
+
+    def test_one_job(self):
+        calls = []
+        def func(item):
+            calls.append((item, threading.currentThread()))
+            return item
+        results = []
+        ordered_map(func, range(3), 1, results.append)
+        self.assertEqual(results, [0, 1, 2])
+        self.assertEqual([t for i, t in calls], [threading.currentThread()] * 3)
+
+    def test_runs_in_threads(self):
+        threads = set()
+        lock = threading.Lock()
+        def func(item):
+            lock.acquire()
+            try:
+                threads.add(threading.currentThread())
+            finally:
+                lock.release()
+            time.sleep(0.02)
+            return item
+        ordered_map(func, range(8), 4, lambda result: None)
+        self.assert_(len(threads) > 1)
+        self.assert_(threading.currentThread() not in threads)
+
+    def test_error_stops_the_items(self):
+        started = []
+        def func(item):
+            started.append(item)
+            if item == 2:
+                raise ValueError(item)
+            return item
+        results = []
+        self.assertRaises(ValueError, ordered_map, func, range(100), 2, results.append)
+        self.assertEqual(results, [0, 1])
+        # Only a few items were computed ahead:
+        self.assert_(len(started) < 20)
+
+    def test_error_in_consume(self):
+        def consume(result):
+            if result == 3:
+                raise KeyError(result)
+        self.assertRaises(KeyError, ordered_map, lambda item: item, range(20), 3, consume)
+
+    def test_interrupt(self):
+        # ^C in the calling thread isn't held up by the items being
+        # computed:
+        def func(item):
+            time.sleep(2)
+            return item
+        timer = threading.Timer(0.1, thread.interrupt_main)
+        timer.start()
+        start = time.time()
+        try:
+            self.assertRaises(KeyboardInterrupt, ordered_map, func, range(4), 2,
+                              lambda result: None)
+        finally:
+            timer.cancel()
+        self.assert_(time.time() - start < 1)
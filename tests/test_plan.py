@@ -0,0 +1,69 @@
+import os
+from cmdutils import CommandError
+from fassembler import plan, tasks
+from fassembler.config import ConfigParser
+from fassembler.project import Project
+from tests.helpers import BuildTestCase
+
+class PlannedProject(Project):
+    name = 'p'
+    actions = [
+        tasks.EnsureFile('write', 'out/f.txt', content='port={{config.port}}\n'),
+        tasks.ForEach('each', 'variable', '{{config.names}}',
+                      [tasks.EnsureDir('dir {{task.variable}}', 'dirs/{{task.variable}}')]),
+        tasks.ConditionalTask('cond',
+                              ('{{config.flag}}', tasks.EnsureDir('yes', 'flag-on')),
+                              ('1', tasks.EnsureDir('no', 'flag-off'))),
+        ]
+
+class TestPlan(BuildTestCase):
+
+    def setUp(self):
+        BuildTestCase.setUp(self)
+        self.config.add_section('p')
+        self.config.set('p', 'port', '{{env.base_port+1}}')
+        self.config.set('p', 'names', 'a\nb')
+        self.config.set('p', 'flag', '0')
+        self.plan_filename = self.path('plan.json')
+
+    def project(self, config):
+        return PlannedProject('p', self.maker, self.environ, self.logger, config)
+
+    def write_plan(self):
+        plan.write_plan(self.plan_filename, [self.project(self.config)],
+                        self.config, self.maker, self.logger)
+
+    def test_round_trip(self):
+        self.write_plan()
+        # Changes after the plan was made don't count:
+        self.config.set('p', 'names', 'c')
+        data = plan.read_plan(self.plan_filename, self.base)
+        config = ConfigParser()
+        plan.load_plan_config(data, config, 'plan.json')
+        project = self.project(config)
+        plan.thaw_project(project, data['projects'][0])
+        self.assertEqual([task.name for task in project.planned_tasks],
+                         ['write', 'each', 'dir a', 'dir b', 'cond', 'no'])
+        project.run()
+        self.assertEqual(self.read('out/f.txt'), 'port=9001\n')
+        self.assertEqual(sorted(os.listdir(self.path('dirs'))), ['a', 'b'])
+        self.assert_(os.path.isdir(self.path('flag-off')))
+        self.assert_(not os.path.exists(self.path('flag-on')))
+
+    def test_other_base_path(self):
+        self.write_plan()
+        self.assertRaises(CommandError, plan.read_plan, self.plan_filename,
+                          self.path('elsewhere'))
+
+    def test_not_a_plan(self):
+        self.write('plan.json', '{"something": "else"}')
+        self.assertRaises(CommandError, plan.read_plan, self.plan_filename, self.base)
+        self.write('plan.json', 'not json')
+        self.assertRaises(CommandError, plan.read_plan, self.plan_filename, self.base)
+
+    def test_mismatched_task_class(self):
+        self.write_plan()
+        data = plan.read_plan(self.plan_filename, self.base)
+        data['projects'][0]['tasks'][0]['class'] = 'fassembler.tasks.EnsureDir'
+        self.assertRaises(CommandError, plan.thaw_project,
+                          self.project(self.config), data['projects'][0])
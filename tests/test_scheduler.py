@@ -0,0 +1,103 @@
+import time
+from fassembler import tasks
+from fassembler.project import Project
+from fassembler.scheduler import TaskScheduler, find_task_dependencies
+from tests.helpers import BuildTestCase
+
+class Record(tasks.Task):
+    """
+    Notes when it starts and finishes in ``events``.
+    """
+
+    def __init__(self, name, events, delay=0):
+        super(Record, self).__init__(name)
+        self.events = events
+        self.delay = delay
+
+    def run(self):
+        self.events.append(('start', self.name))
+        time.sleep(self.delay)
+        self.events.append(('end', self.name))
+
+class Fail(Record):
+
+    def run(self):
+        Record.run(self)
+        raise ValueError('%s failed' % self.name)
+
+class TestTaskDependencies(BuildTestCase):
+
+    def bound_tasks(self, actions):
+        class P(Project):
+            name = 'p'
+        P.actions = actions
+        self.config.add_section('p')
+        project = P('p', self.maker, self.environ, self.logger, self.config)
+        project.setup_config()
+        return project, project.bind_tasks()
+
+    def test_undeclared_tasks_are_barriers(self):
+        events = []
+        project, bound = self.bound_tasks([
+            Record('seq1', events),
+            Record('a', events).declare(outputs=['x/a']),
+            Record('b', events).declare(outputs=['x/b']),
+            Record('seq2', events),
+            Record('c', events).declare(outputs=['y'])])
+        deps = find_task_dependencies(bound, self.maker)
+        self.assertEqual(deps, [set(), set([0]), set([0]), set([0, 1, 2]), set([3])])
+
+    def test_overlapping_resources(self):
+        events = []
+        project, bound = self.bound_tasks([
+            Record('a', events).declare(outputs=['x/a']),
+            Record('b', events).declare(outputs=['x/b']),
+            # Reads a file inside x/a:
+            Record('c', events).declare(inputs=['x/a/file'], outputs=['y']),
+            # Writes the directory both a and b write into:
+            Record('d', events).declare(outputs=['x']),
+            Record('e', events).declare(after=['b']),
+            Record('f', events).declare(inputs=['config:p.port']),
+            Record('g', events).declare(outputs=['config:p'])])
+        deps = find_task_dependencies(bound, self.maker)
+        self.assertEqual(deps[:5], [set(), set(), set([0]), set([0, 1, 2]), set([1])])
+        self.assertEqual(deps[6], set([5]))
+
+    def test_concurrent_run_respects_dependencies(self):
+        events = []
+        self.maker.task_jobs = 3
+        project, bound = self.bound_tasks([
+            Record('a', events, 0.2).declare(outputs=['x/a']),
+            Record('b', events, 0.2).declare(outputs=['x/b']),
+            Record('c', events).declare(inputs=['x/a'], outputs=['y']),
+            Record('seq', events)])
+        project.run()
+        order = list(events)
+        # a and b ran at the same time:
+        self.assertEqual(set(order[:2]), set([('start', 'a'), ('start', 'b')]))
+        self.assert_(order.index(('start', 'c')) > order.index(('end', 'a')))
+        self.assertEqual(order[-2:], [('start', 'seq'), ('end', 'seq')])
+        self.assertEqual(len(order), 8)
+
+    def test_concurrent_failures(self):
+        events = []
+        handled = []
+        def handle_exception(exc_info, can_continue=False, can_retry=False):
+            handled.append(str(exc_info[1]))
+            return True
+        self.maker.handle_exception = handle_exception
+        self.maker.task_jobs = 2
+        project, bound = self.bound_tasks([
+            Fail('a', events, 0.2).declare(outputs=['x/a']),
+            Fail('b', events, 0.2).declare(outputs=['x/b']),
+            Record('seq', events)])
+        project.run()
+        self.assertEqual(handled, ['a failed', 'b failed'])
+        self.assertEqual(events[-2:], [('start', 'seq'), ('end', 'seq')])
+
+    def test_unmet_dependencies(self):
+        events = []
+        project, bound = self.bound_tasks([Record('a', events), Record('b', events)])
+        scheduler = TaskScheduler(project, bound, 2, dependencies=[set([1]), set([0])])
+        self.assertRaises(RuntimeError, scheduler.run)
+        self.assertEqual(events, [])
@@ -0,0 +1,162 @@
+import os
+import stat
+import tarfile
+from cStringIO import StringIO
+from fassembler import tasks
+from fassembler.download import extract_tarball
+from fassembler.project import Project
+from tests.helpers import BuildTestCase, StandInServer
+
+def make_tarball(members, compression='gz'):
+    """
+    A tarball of ``members``, a list of ``(name, kind, value)``:
+    ``('file', content)``, ``('dir', mode)``, ``('symlink', target)``
+    or ``('hardlink', target)``.
+    """
+    out = StringIO()
+    tar = tarfile.open(fileobj=out, mode='w:' + compression)
+    for name, kind, value in members:
+        info = tarfile.TarInfo(name)
+        data = None
+        if kind == 'file':
+            info.size = len(value)
+            info.mode = 0644
+            data = StringIO(value)
+        elif kind == 'dir':
+            info.type = tarfile.DIRTYPE
+            info.mode = value
+        elif kind == 'symlink':
+            info.type = tarfile.SYMTYPE
+            info.linkname = value
+        elif kind == 'hardlink':
+            info.type = tarfile.LNKTYPE
+            info.linkname = value
+        tar.addfile(info, data)
+    tar.close()
+    return out.getvalue()
+
+class TestExtractTarball(BuildTestCase):
+
+    def setUp(self):
+        BuildTestCase.setUp(self)
+        self.dest = self.path('dest')
+        os.makedirs(self.dest)
+        self.outside = self.path('outside')
+        os.makedirs(self.outside)
+
+    def extract(self, members):
+        extract_tarball(StringIO(make_tarball(members)), self.dest, 'gz')
+
+    def assertRefused(self, members):
+        self.assertRaises(ValueError, self.extract, members)
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_extract(self):
+        self.extract([('pkg', 'dir', 0555),
+                      ('pkg/a.txt', 'file', 'a'),
+                      ('pkg/link', 'symlink', 'a.txt'),
+                      ('pkg/hard', 'hardlink', 'pkg/a.txt')])
+        self.assertEqual(self.read('dest/pkg/a.txt'), 'a')
+        self.assertEqual(os.readlink(self.path('dest/pkg/link')), 'a.txt')
+        self.assertEqual(self.read('dest/pkg/hard'), 'a')
+        # The directory mode is set once its files are in it:
+        self.assertEqual(stat.S_IMODE(os.stat(self.path('dest/pkg')).st_mode), 0555)
+        os.chmod(self.path('dest/pkg'), 0755)
+
+    def test_replaces_files(self):
+        self.extract([('a.txt', 'file', 'old')])
+        self.extract([('a.txt', 'file', 'new')])
+        self.assertEqual(self.read('dest/a.txt'), 'new')
+
+    def test_dotdot(self):
+        self.assertRefused([('../outside/x', 'file', 'no')])
+        self.assertRefused([('pkg/../../outside/x', 'file', 'no')])
+
+    def test_absolute(self):
+        self.assertRefused([(os.path.join(self.outside, 'x'), 'file', 'no')])
+
+    def test_symlink_escape(self):
+        self.assertRefused([('link', 'symlink', self.outside)])
+        self.assertRefused([('link', 'symlink', '../outside')])
+        self.assert_(not os.path.lexists(os.path.join(self.dest, 'link')))
+
+    def test_symlink_swap(self):
+        # A symlink that is already there, pointing outside:
+        os.symlink(self.outside, os.path.join(self.dest, 'pkg'))
+        self.assertRefused([('pkg/x', 'file', 'no')])
+        os.unlink(os.path.join(self.dest, 'pkg'))
+        # A symlink that points inside, replaced by one pointing
+        # outside before a file is written through it:
+        self.assertRefused([('sub', 'dir', 0755),
+                            ('pkg', 'symlink', 'sub'),
+                            ('pkg', 'symlink', '../outside'),
+                            ('pkg/x', 'file', 'no')])
+
+    def test_file_replaces_symlink(self):
+        # A file is written in place of a symlink, not through it:
+        target = os.path.join(self.dest, 'target')
+        open(target, 'w').close()
+        os.symlink('target', os.path.join(self.dest, 'a.txt'))
+        self.extract([('a.txt', 'file', 'new')])
+        self.assert_(not os.path.islink(os.path.join(self.dest, 'a.txt')))
+        self.assertEqual(self.read('dest/target'), '')
+
+    def test_hardlink_outside(self):
+        outside_file = os.path.join(self.outside, 'secret')
+        open(outside_file, 'w').close()
+        self.assertRaises(ValueError, self.extract, [('hard', 'hardlink', outside_file)])
+        self.assertRaises(ValueError, self.extract, [('hard', 'hardlink', '../outside/secret')])
+        self.assertEqual(os.listdir(self.dest), [])
+        self.assertEqual(os.stat(outside_file).st_nlink, 1)
+
+class TestInstallTarball(BuildTestCase):
+
+    def setUp(self):
+        BuildTestCase.setUp(self)
+        self.tarball = make_tarball([('pkg-1.0', 'dir', 0755),
+                                     ('pkg-1.0/README', 'file', 'readme')])
+        self.server = StandInServer({'/pkg-1.0.tar.gz': self.tarball})
+        self.hooks = []
+        self.old_cwd = os.getcwd()
+        # InstallTarball looks for the tarball in the current directory:
+        os.chdir(self.base)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.server.stop()
+        BuildTestCase.tearDown(self)
+
+    def run_install(self):
+        hooks = self.hooks
+        class Install(tasks.InstallTarball):
+            _tarball_url = self.server.url + '/pkg-1.0.tar.gz'
+            _src_name = 'pkg-1.0'
+            def post_unpack_hook(self):
+                hooks.append(os.path.exists(os.path.join(self.dest_path, 'README')))
+        class P(Project):
+            name = 'p'
+            actions = [Install()]
+        self.config.add_section('p')
+        P('p', self.maker, self.environ, self.logger, self.config).run()
+
+    def test_download(self):
+        self.run_install()
+        self.assertEqual(self.read('p/src/pkg-1.0/README'), 'readme')
+        self.assertEqual(self.hooks, [True])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assert_(not os.path.exists(self.path('pkg-1.0.tar.gz')))
+
+    def test_local_tarball(self):
+        self.write('pkg-1.0.tar.gz', self.tarball)
+        self.run_install()
+        self.assertEqual(self.read('p/src/pkg-1.0/README'), 'readme')
+        self.assertEqual(self.hooks, [True])
+        self.assertEqual(self.server.requests, [])
+        # It is deleted once it is unpacked:
+        self.assert_(not os.path.exists(self.path('pkg-1.0.tar.gz')))
+
+    def test_bad_local_tarball(self):
+        self.write('pkg-1.0.tar.gz', make_tarball([('../x', 'file', 'no')]))
+        self.assertRaises(ValueError, self.run_install)
+        self.assertEqual(self.hooks, [])
+        self.assert_(os.path.exists(self.path('pkg-1.0.tar.gz')))
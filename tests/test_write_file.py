@@ -0,0 +1,71 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from fassembler import util
+from fassembler.util import write_file, sync_files
+
+class TestWriteFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='fassembler-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def read(self, name):
+        f = open(self.path(name), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_new_file(self):
+        write_file(self.path('f'), 'content')
+        self.assertEqual(self.read('f'), 'content')
+        self.assertEqual(os.listdir(self.dir), ['f'])
+
+    def test_replaces_the_file(self):
+        write_file(self.path('f'), 'old')
+        reader = open(self.path('f'), 'rb')
+        try:
+            write_file(self.path('f'), 'new')
+            self.assertEqual(self.read('f'), 'new')
+            # The old file was replaced, not written over:
+            self.assertEqual(reader.read(), 'old')
+        finally:
+            reader.close()
+
+    def test_keeps_mode(self):
+        write_file(self.path('f'), 'old')
+        os.chmod(self.path('f'), 0750)
+        write_file(self.path('f'), 'new')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path('f')).st_mode), 0750)
+
+    def test_symlink(self):
+        write_file(self.path('target'), 'old')
+        os.symlink('target', self.path('link'))
+        write_file(self.path('link'), 'new')
+        self.assert_(os.path.islink(self.path('link')))
+        self.assertEqual(self.read('target'), 'new')
+
+    def test_failed_write(self):
+        write_file(self.path('f'), 'old')
+        # Can't be written to a file:
+        self.assertRaises(UnicodeError, write_file, self.path('f'), u'\u1234')
+        self.assertEqual(self.read('f'), 'old')
+        self.assertEqual(os.listdir(self.dir), ['f'])
+
+    def test_sync_files(self):
+        write_file(self.path('f'), 'content')
+        self.assert_(os.path.realpath(self.path('f')) in util._unsynced)
+        sync_files()
+        self.assert_(os.path.realpath(self.path('f')) not in util._unsynced)
+        # Files removed since they were written are skipped:
+        write_file(self.path('g'), 'content')
+        os.unlink(self.path('g'))
+        sync_files()